@@ -9,11 +9,27 @@ We expect the following arguments:
 - K, the number of latent factors
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
     a dictionary defining the priors over tau, U, V.
+- sparse, optional (default False). If True, we store only the observed entries
+    (see observed_entries.py) and compute all updates over those entries, 
+    rather than multiplying by the dense mask M. Useful when few entries are observed.
+    R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+    copies of them, so the memory scales with the number of observed entries.
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the 
+    updates, e.g. numpy.float32 to halve the memory they need. The truncated normal draws are 
+    computed in float64 and stored in this type, and the sums for tau are done in float64.
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
 - init='exp'    -> use the expectation of the priors Exp, Gamma
 Alternatively, you can define your own initial values for U, V, and tau.
+Or we can warm start from the fit <model> of the same model with fewer factors,
+using initialise_warm(model,warm_start,seed), with warm_start='split' or 'prior'
+(see warm_start.py): we copy its U and V, and add the new columns by splitting 
+its columns with the highest variance, or by drawing them from the priors.
+
+The random initialisation and the draws of the sampler use the random state of the
+seed given to initialise(...,seed) (see random_state.py): None for numpy's global 
+random state, an int, or a numpy.random.RandomState.
 
 Usage of class:
     BNMF = bnmf_gibbs(R,M,K,priors)
@@ -27,6 +43,11 @@ This returns a tuple (Us,Vs,taus) of lists of U, V, tau values - of size <iterat
 
 The expectation can be computed by specifying a burn-in and thinning rate, and using:
     BNMF.approx_expectation(burn_in,thinning)
+To avoid keeping all draws in memory, we can instead give the burn-in and thinning
+up front with a SampleStore (see sample_store.py), which keeps running means:
+    BNMF.run(iterations,sample_store=SampleStore(burn_in,thinning))
+approx_expectation, predict and quality then use those means (with the same burn_in 
+and thinning), and the returned lists of draws are None (apart from the taus).
 
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred,burn_in,thinning)
@@ -35,6 +56,11 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+We can choose which performances are computed and printed, and how often, by passing
+a Monitor (see monitor.py) to run(iterations,monitor=monitor).
+run(iterations,resume=True) continues the chain from the current draws, appending to
+the draws and performances of the previous runs (so the burn-in and thinning count
+from the first run). This cannot be combined with a SampleStore.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -44,17 +70,26 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 (we want to maximise these values)
 """
 
-from distributions.exponential import exponential_draw
+from distributions.exponential import exponential_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
+from warm_start import split_sources, extend_columns, copy_columns
 from distributions.gamma import gamma_draw
 from distributions.truncated_normal_vector import TN_vector_draw
 
 import numpy, itertools, math, time
 
 class bnmf_gibbs_optimised:
-    def __init__(self,R,M,K,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,priors,sparse=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
+        self.random_state = random_state(None)
+        self.sample_store = None
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
@@ -62,17 +97,19 @@ class bnmf_gibbs_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
+        self.size_Omega = float(self.omega.size) if self.sparse else self.M.sum(dtype=numpy.float64)
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaU, self.lambdaV = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU']), numpy.array(priors['lambdaV'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU'],dtype=dtype), numpy.array(priors['lambdaV'],dtype=dtype)
         
         # If lambdaU or lambdaV are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaU.shape == ():
-            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
+            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K),dtype=dtype)
         if self.lambdaV.shape == ():
-            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
+            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K),dtype=dtype)
                 
         assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
         assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
@@ -80,8 +117,7 @@ class bnmf_gibbs_optimised:
         
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -91,69 +127,98 @@ class bnmf_gibbs_optimised:
 
 
     # Initialise and run the sampler
-    def train(self,init,iterations):
-        self.initialise(init=init)
+    def train(self,init,iterations,seed=None):
+        self.initialise(init=init,seed=seed)
         return self.run(iterations)
 
 
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
-    def initialise(self,init='random'):
+    def initialise(self,init='random',seed=None):
+        self.random_state = random_state(seed)
         assert init in ['random','exp'], "Unknown initialisation option: %s. Should be 'random' or 'exp'." % init
-        self.U = numpy.zeros((self.I,self.K))
-        self.V = numpy.zeros((self.J,self.K))
-        
         if init == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = exponential_draw(self.lambdaU[i][k])
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = exponential_draw(self.lambdaV[j][k])
+            self.U = exponential_vector_draw(self.lambdaU,self.random_state).astype(self.dtype)
+            self.V = exponential_vector_draw(self.lambdaV,self.random_state).astype(self.dtype)
             
         elif init == 'exp':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = 1.0/self.lambdaU[i][k]
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = 1.0/self.lambdaV[j][k]
+            self.U = 1.0/self.lambdaU
+            self.V = 1.0/self.lambdaV
+        
+        self.tau = self.alpha_s() / self.beta_s()
+        
+
+    # Initialise U, V, and tau from the fit <model> of this model with fewer factors (see warm_start.py)
+    def initialise_warm(self,model,warm_start='split',seed=None):
+        self.random_state = random_state(seed)
+        sources = split_sources(model.U,self.K,warm_start)
+        self.U = extend_columns(model.U,sources,exponential_vector_draw(self.lambdaU,self.random_state),self.random_state).astype(self.dtype)
+        self.V = copy_columns(model.V,sources,exponential_vector_draw(self.lambdaV,self.random_state)).astype(self.dtype)
         
         self.tau = self.alpha_s() / self.beta_s()
         
 
     # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_U = numpy.zeros((iterations,self.I,self.K))  
-        self.all_V = numpy.zeros((iterations,self.J,self.K))   
-        self.all_tau = numpy.zeros(iterations) 
-        self.all_times = [] # to plot performance against time
-        
-        metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
+    def run(self,iterations,stopping_criterion=None,monitor=None,sample_store=None,resume=False):
+        assert not resume or (sample_store is None and self.sample_store is None), "Cannot resume a run that uses a SampleStore."
+        start = len(self.all_tau) if resume else 0 # iterations of the previous runs
+        self.sample_store = sample_store
+        if sample_store is not None:
+            sample_store.initialise(iterations,{'U':(self.I,self.K),'V':(self.J,self.K),'tau':()})
+            (self.all_U, self.all_V) = (None,None)
+        else:
+            self.all_U = numpy.concatenate((self.all_U,numpy.zeros((iterations,self.I,self.K),dtype=self.dtype))) if resume else numpy.zeros((iterations,self.I,self.K),dtype=self.dtype)
+            self.all_V = numpy.concatenate((self.all_V,numpy.zeros((iterations,self.J,self.K),dtype=self.dtype))) if resume else numpy.zeros((iterations,self.J,self.K),dtype=self.dtype)
+        self.all_tau = numpy.concatenate((self.all_tau,numpy.zeros(iterations))) if resume else numpy.zeros(iterations)
+        if not resume:
+            self.all_times = [] # to plot performance against time
+        
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['MSE','R^2','Rp'])
+        if not resume:
+            self.all_iterations = [] # iterations at which we computed the performances
+            self.all_performances = {} # for plotting convergence of metrics
+        for metric in monitor.metrics:
+            self.all_performances.setdefault(metric,[])
+        
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
+        time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
         for it in range(0,iterations):      
             for k in range(0,self.K):   
                 tauUk = self.tauU(k)
                 muUk = self.muU(tauUk,k)
-                self.U[:,k] = TN_vector_draw(muUk,tauUk)
+                self.U[:,k] = TN_vector_draw(muUk,tauUk,self.random_state)
                 
             for k in range(0,self.K):
                 tauVk = self.tauV(k)
                 muVk = self.muV(tauVk,k)
-                self.V[:,k] = TN_vector_draw(muVk,tauVk)
+                self.V[:,k] = TN_vector_draw(muVk,tauVk,self.random_state)
                 
-            self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+            self.tau = gamma_draw(self.alpha_s(),self.beta_s(),self.random_state)
             
-            self.all_U[it], self.all_V[it], self.all_tau[it] = numpy.copy(self.U), numpy.copy(self.V), self.tau
+            self.all_tau[start+it] = self.tau
+            if sample_store is not None:
+                sample_store.add(it,{'U':self.U,'V':self.V,'tau':self.tau})
+            else:
+                self.all_U[start+it], self.all_V[start+it] = numpy.copy(self.U), numpy.copy(self.V)
             
-            perf = self.predict_while_running()
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            evaluate = monitor.evaluate(it,iterations)
+            if evaluate:
+                perf = monitor.performances(self,self.training_predictions)
+                monitor.record(self,start+it+1,perf)
             
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)            
             
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(dict(perf,tau_sample=self.tau)):
+                self.stop_reason = stopping_criterion.reason
+                self.all_tau = self.all_tau[:start+it+1]
+                if sample_store is None:
+                    (self.all_U, self.all_V) = (self.all_U[:start+it+1], self.all_V[:start+it+1])
+                break
+            
         return (self.all_U, self.all_V, self.all_tau)
         
         
@@ -162,24 +227,59 @@ class bnmf_gibbs_optimised:
         return self.alpha + self.size_Omega/2.0
     
     def beta_s(self):   
-        return self.beta + 0.5*(self.M*(self.R-numpy.dot(self.U,self.V.T))**2).sum()
+        if self.sparse:
+            return self.beta + 0.5*((self.omega.values-self.omega.dot(self.U,self.V))**2).sum(dtype=numpy.float64)
+        residual = self.workspace.residual('residual',self.R,self.U,self.V.T)
+        residual **= 2
+        residual *= self.M
+        return self.beta + 0.5*residual.sum(dtype=numpy.float64)
         
     def tauU(self,k):       
-        return self.tau*(self.M*self.V[:,k]**2).sum(axis=1)
+        if self.sparse:
+            return self.tau*self.omega.row_sums(self.V[self.omega.columns,k]**2)
+        return self.tau*self.workspace.multiply('work',self.M,self.V[:,k]**2).sum(axis=1)
         
     def muU(self,tauUk,k):
-        return 1./tauUk * (-self.lambdaU[:,k] + self.tau*(self.M * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k]))*self.V[:,k] )).sum(axis=1)) 
+        if self.sparse:
+            (rows,columns) = (self.omega.rows,self.omega.columns)
+            residual = self.omega.values-self.omega.dot(self.U,self.V)+self.U[rows,k]*self.V[columns,k]
+            return 1./tauUk * (-self.lambdaU[:,k] + self.tau*self.omega.row_sums(residual*self.V[columns,k]))
+        residual = self.residual_k(k)
+        residual *= self.V[:,k]
+        residual *= self.M
+        return 1./tauUk * (-self.lambdaU[:,k] + self.tau*residual.sum(axis=1)) 
         
     def tauV(self,k):
-        return self.tau*(self.M.T*self.U[:,k]**2).T.sum(axis=0)
+        if self.sparse:
+            return self.tau*self.omega.column_sums(self.U[self.omega.rows,k]**2)
+        return self.tau*self.workspace.multiply('work',self.M,(self.U[:,k]**2)[:,None]).sum(axis=0)
         
     def muV(self,tauVk,k):
-        return 1./tauVk * (-self.lambdaV[:,k] + self.tau*(self.M.T * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k])).T*self.U[:,k] )).T.sum(axis=0)) 
+        if self.sparse:
+            (rows,columns) = (self.omega.rows,self.omega.columns)
+            residual = self.omega.values-self.omega.dot(self.U,self.V)+self.U[rows,k]*self.V[columns,k]
+            return 1./tauVk * (-self.lambdaV[:,k] + self.tau*self.omega.column_sums(residual*self.U[rows,k]))
+        residual = self.residual_k(k)
+        residual *= self.U[:,k][:,None]
+        residual *= self.M
+        return 1./tauVk * (-self.lambdaV[:,k] + self.tau*residual.sum(axis=0)) 
+        
+    # Compute R - U V^T + outer(U_.k,V_.k) in the workspace, for the updates of column k
+    def residual_k(self,k):
+        residual = self.workspace.residual('residual',self.R,self.U,self.V.T)
+        residual += self.workspace.outer('work',self.U[:,k],self.V[:,k])
+        return residual
 
 
     # Return the average value for U, V, tau - i.e. our approximation to the expectations. 
     # Throw away the first <burn_in> samples, and then use every <thinning>th after.
     def approx_expectation(self,burn_in,thinning):
+        if self.sample_store is not None:
+            # We only kept the running means of the draws after the burn-in and thinning
+            store = self.sample_store
+            store.check(burn_in,thinning)
+            return (store.mean('U'), store.mean('V'), float(store.mean('tau')))
+        
         indices = range(burn_in,len(self.all_U),thinning)
         exp_U = numpy.array([self.all_U[i] for i in indices]).sum(axis=0) / float(len(indices))      
         exp_V = numpy.array([self.all_V[i] for i in indices]).sum(axis=0) / float(len(indices))  
@@ -187,20 +287,32 @@ class bnmf_gibbs_optimised:
         return (exp_U, exp_V, exp_tau)
 
 
+    # Return (M,R,R_pred) for the training data using the current draws, to monitor the performance while running
+    def training_predictions(self):
+        if self.sparse:
+            return (numpy.ones(self.omega.size),self.omega.values,self.omega.dot(self.U,self.V))
+        return (self.M,self.R,numpy.dot(self.U,self.V.T))
+        
+        
     # Compute the expectation of U and V, and use it to predict missing values
     def predict(self,M_pred,burn_in,thinning):
         (exp_U,exp_V,_) = self.approx_expectation(burn_in,thinning)
-        R_pred = numpy.dot(exp_U,exp_V.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(exp_U,exp_V))
+        else:
+            (R,R_pred) = (self.R,numpy.dot(exp_U,exp_V.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
     def predict_while_running(self):
-        R_pred = numpy.dot(self.U,self.V.T)
-        MSE = self.compute_MSE(self.M,self.R,R_pred)
-        R2 = self.compute_R2(self.M,self.R,R_pred)    
-        Rp = self.compute_Rp(self.M,self.R,R_pred)        
+        (M,R,R_pred) = self.training_predictions()
+        MSE = self.compute_MSE(M,R,R_pred)
+        R2 = self.compute_R2(M,R,R_pred)    
+        Rp = self.compute_Rp(M,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
         
@@ -239,6 +351,8 @@ class bnmf_gibbs_optimised:
             # -2*loglikelihood + 2*no. free parameters
             return - 2 * log_likelihood + 2 * (self.I*self.K+self.J*self.K)
         elif metric == 'MSE':
+            if self.sparse:
+                return ((self.omega.values-self.omega.dot(expU,expV))**2).sum() / float(self.size_Omega)
             R_pred = numpy.dot(expU,expV.T)
             return self.compute_MSE(self.M,self.R,R_pred)
         elif metric == 'ELBO':
@@ -247,5 +361,8 @@ class bnmf_gibbs_optimised:
     def log_likelihood(self,expU,expV,exptau):
         # Return the likelihood of the data given the trained model's parameters
         explogtau = math.log(exptau)
+        if self.sparse:
+            return self.size_Omega / 2. * ( explogtau - math.log(2*math.pi) ) \
+                 - exptau / 2. * ((self.omega.values-self.omega.dot(expU,expV))**2).sum()
         return self.size_Omega / 2. * ( explogtau - math.log(2*math.pi) ) \
              - exptau / 2. * (self.M*( self.R - numpy.dot(expU,expV.T))**2).sum()
\ No newline at end of file
@@ -9,12 +9,32 @@ We expect the following arguments:
 - K, the number of latent factors
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
     a dictionary defining the priors over tau, U, V.
+- sparse, optional (default False). If True, we store only the observed entries
+    (see observed_entries.py) and compute all updates over those entries, 
+    rather than multiplying by the dense mask M. Useful when few entries are observed.
+    R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+    copies of them, so the memory scales with the number of observed entries.
+- batch_columns, optional (default False). If True, we compute the residual M*(R - U V^T) once
+    per sweep over the columns of U (or V), and correct it with a rank-1 update after each 
+    column, rather than recomputing U V^T for every column (see update_U_batch).
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the 
+    updates, e.g. numpy.float32 to halve the memory they need. The truncated normal moments are 
+    computed in float64 and stored in this type, and the sums for tau and the ELBO are done in float64.
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init = 'exp'       -> muU[i,k] = 1/lambdaU[i,k], muV[j,k] = 1/lambdaV[j,k]
        = 'random'    -> muU[i,k] ~ Exp(lambdaU[i,k]), muV[j,k] ~ Exp(lambdaV[j,k]), 
 - tauU[i,k] = tauV[j,k] = 1 if tauUV = {}, else tauU = tauUV['tauU'], tauV = tauUV['tauV']
 - alpha_s, beta_s using updates of model
+Or we can warm start from the fit <model> of the same model with fewer factors,
+using initialise_warm(model,warm_start,seed), with warm_start='split' or 'prior'
+(see warm_start.py): we copy its muU, tauU, muV, tauV, and add the new columns by 
+splitting its columns of muU with the highest variance, or by drawing muU and muV 
+from the priors (with tau = 1).
+
+The random initialisation uses the random state of the seed given to 
+initialise(...,seed) (see random_state.py): None for numpy's global random state, 
+an int, or a numpy.random.RandomState.
 
 Usage of class:
     BNMF = bnmf_vb(R,M,K,priors)
@@ -31,6 +51,10 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+We can choose which performances are computed and printed, and how often, by passing
+a Monitor (see monitor.py) to run(iterations,monitor=monitor).
+run(iterations,resume=True) continues from the current values rather than from the
+initialisation, appending to all_performances, all_iterations and all_times.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -41,19 +65,27 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 (we want to maximise these values)
 """
 
-from distributions.gamma import gamma_expectation, gamma_expectation_log, gamma_draw
-from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
-from distributions.exponential import exponential_draw
+from distributions.gamma import gamma_expectation, gamma_expectation_log
+from distributions.truncated_normal_vector import TN_vector_moments
+from distributions.exponential import exponential_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
+from warm_start import split_sources, extend_columns, copy_columns
 
 import numpy, itertools, math, scipy, time
 from scipy.stats import norm
 import matplotlib.pyplot as plt
 
 class bnmf_vb_optimised:
-    def __init__(self,R,M,K,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,priors,sparse=False,batch_columns=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
+        self.batch_columns = batch_columns
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
@@ -61,17 +93,19 @@ class bnmf_vb_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
+        self.size_Omega = float(self.omega.size) if self.sparse else self.M.sum(dtype=numpy.float64)
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaU, self.lambdaV = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU']), numpy.array(priors['lambdaV'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU'],dtype=dtype), numpy.array(priors['lambdaV'],dtype=dtype)
         
         # If lambdaU or lambdaV are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaU.shape == ():
-            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
+            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K),dtype=dtype)
         if self.lambdaV.shape == ():
-            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
+            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K),dtype=dtype)
         
         assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
         assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
@@ -79,8 +113,7 @@ class bnmf_vb_optimised:
             
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -90,21 +123,36 @@ class bnmf_vb_optimised:
 
 
     # Initialise U, V, and tau. 
-    def initialise(self,init='exp',tauUV={}):
-        self.tauU = tauUV['tauU'] if 'tauU' in tauUV else numpy.ones((self.I,self.K))
-        self.tauV = tauUV['tauV'] if 'tauV' in tauUV else numpy.ones((self.J,self.K))
+    def initialise(self,init='exp',tauUV={},seed=None):
+        self.random_state = random_state(seed)
+        self.tauU = tauUV['tauU'] if 'tauU' in tauUV else numpy.ones((self.I,self.K),dtype=self.dtype)
+        self.tauV = tauUV['tauV'] if 'tauV' in tauUV else numpy.ones((self.J,self.K),dtype=self.dtype)
         
         assert init in ['exp','random'], "Unrecognised init option for F,G: %s." % init
         self.muU, self.muV = 1./self.lambdaU, 1./self.lambdaV
         if init == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.muU[i,k] = exponential_draw(self.lambdaU[i,k])
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.muV[j,k] = exponential_draw(self.lambdaV[j,k])  
+            self.muU = exponential_vector_draw(self.lambdaU,self.random_state).astype(self.dtype)
+            self.muV = exponential_vector_draw(self.lambdaV,self.random_state).astype(self.dtype)
+        
+        self.initialise_expectations()
+        
+        
+    # Initialise muU, tauU, muV, tauV from the fit <model> of this model with fewer factors (see warm_start.py)
+    def initialise_warm(self,model,warm_start='split',seed=None):
+        self.random_state = random_state(seed)
+        sources = split_sources(model.muU,self.K,warm_start)
+        self.muU = extend_columns(model.muU,sources,exponential_vector_draw(self.lambdaU,self.random_state),self.random_state).astype(self.dtype)
+        self.muV = copy_columns(model.muV,sources,exponential_vector_draw(self.lambdaV,self.random_state)).astype(self.dtype)
+        self.tauU = copy_columns(model.tauU,sources,numpy.ones((self.I,self.K))).astype(self.dtype)
+        self.tauV = copy_columns(model.tauV,sources,numpy.ones((self.J,self.K))).astype(self.dtype)
         
-        # Initialise the expectations and variances
-        self.expU, self.varU = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
-        self.expV, self.varV = numpy.zeros((self.J,self.K)), numpy.zeros((self.J,self.K))
+        self.initialise_expectations()
+        
+        
+    # Initialise the expectations and variances of U and V from mu and tau, and then tau
+    def initialise_expectations(self):
+        self.expU, self.varU = numpy.zeros((self.I,self.K),dtype=self.dtype), numpy.zeros((self.I,self.K),dtype=self.dtype)
+        self.expV, self.varV = numpy.zeros((self.J,self.K),dtype=self.dtype), numpy.zeros((self.J,self.K),dtype=self.dtype)
         
         for k in xrange(0,self.K):
             self.update_exp_U(k)
@@ -118,44 +166,60 @@ class bnmf_vb_optimised:
         
 
     # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_exp_tau = []  # to check for convergence 
-        self.all_times = [] # to plot performance against time
+    def run(self,iterations,stopping_criterion=None,monitor=None,resume=False):
+        if not resume:
+            self.all_exp_tau = []  # to check for convergence 
+            self.all_times = [] # to plot performance against time
+        start = len(self.all_exp_tau) # iterations of the previous runs, if we resume
         
-        metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['ELBO','MSE','R^2','Rp'])
+        if not resume:
+            self.all_iterations = [] # iterations at which we computed the performances
+            self.all_performances = {} # for plotting convergence of metrics
+        for metric in monitor.metrics:
+            self.all_performances.setdefault(metric,[])
         
-        time_start = time.time()
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
+        time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
         for it in range(0,iterations):
-            for k in xrange(0,self.K):
-                self.update_U(k)
-                self.update_exp_U(k)    
-                
-            for k in xrange(0,self.K):
-                self.update_V(k)
-                self.update_exp_V(k)
+            if self.batch_columns:
+                self.update_U_batch()
+                self.update_V_batch()
+            else:
+                for k in xrange(0,self.K):
+                    self.update_U(k)
+                    self.update_exp_U(k)    
+                    
+                for k in xrange(0,self.K):
+                    self.update_V(k)
+                    self.update_exp_V(k)
                 
             self.update_tau()
             self.update_exp_tau()
             self.all_exp_tau.append(self.exptau)
             
-            perf, elbo = self.predict(self.M), self.elbo()
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+            evaluate = monitor.evaluate(it,iterations)
+            if evaluate:
+                perf = monitor.performances(self,self.training_predictions,{'ELBO':self.elbo})
+                monitor.record(self,start+it+1,perf)
             
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)            
             
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(dict(perf,tau=self.exptau)):
+                self.stop_reason = stopping_criterion.reason
+                break
+            
         return
         
         
     # Method for doing both initialise() and run() 
-    def train(self,iterations,init_UV='random'):
-        self.initialise(init_UV=init_UV) 
+    def train(self,init,iterations,seed=None):
+        self.initialise(init=init,seed=seed)
         self.run(iterations=iterations)    
         
         
@@ -163,18 +227,18 @@ class bnmf_vb_optimised:
     def elbo(self):
         return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
              - self.exptau / 2. * self.exp_square_diff() \
-             + numpy.log(self.lambdaU).sum() - ( self.lambdaU * self.expU ).sum() \
-             + numpy.log(self.lambdaV).sum() - ( self.lambdaV * self.expV ).sum() \
+             + numpy.log(self.lambdaU).sum(dtype=numpy.float64) - ( self.lambdaU * self.expU ).sum(dtype=numpy.float64) \
+             + numpy.log(self.lambdaV).sum(dtype=numpy.float64) - ( self.lambdaV * self.expV ).sum(dtype=numpy.float64) \
              + self.alpha * math.log(self.beta) - scipy.special.gammaln(self.alpha) \
              + (self.alpha - 1.)*self.explogtau - self.beta * self.exptau \
              - self.alpha_s * math.log(self.beta_s) + scipy.special.gammaln(self.alpha_s) \
              - (self.alpha_s - 1.)*self.explogtau + self.beta_s * self.exptau \
-             - .5*numpy.log(self.tauU).sum() + self.I*self.K/2.*math.log(2*math.pi) \
-             + numpy.log(0.5*scipy.special.erfc(-self.muU*numpy.sqrt(self.tauU)/math.sqrt(2))).sum() \
-             + ( self.tauU / 2. * ( self.varU + (self.expU - self.muU)**2 ) ).sum() \
-             - .5*numpy.log(self.tauV).sum() + self.J*self.K/2.*math.log(2*math.pi) \
-             + numpy.log(0.5*scipy.special.erfc(-self.muV*numpy.sqrt(self.tauV)/math.sqrt(2))).sum() \
-             + ( self.tauV / 2. * ( self.varV + (self.expV - self.muV)**2 ) ).sum()
+             - .5*numpy.log(self.tauU).sum(dtype=numpy.float64) + self.I*self.K/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muU.astype(numpy.float64)*numpy.sqrt(self.tauU)/math.sqrt(2))).sum(dtype=numpy.float64) \
+             + ( self.tauU / 2. * ( self.varU + (self.expU - self.muU)**2 ) ).sum(dtype=numpy.float64) \
+             - .5*numpy.log(self.tauV).sum(dtype=numpy.float64) + self.J*self.K/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muV.astype(numpy.float64)*numpy.sqrt(self.tauV)/math.sqrt(2))).sum(dtype=numpy.float64) \
+             + ( self.tauV / 2. * ( self.varV + (self.expV - self.muV)**2 ) ).sum(dtype=numpy.float64)
         
         
     # Update the parameters for the distributions
@@ -183,44 +247,134 @@ class bnmf_vb_optimised:
         self.beta_s = self.beta + 0.5*self.exp_square_diff()
         
     def exp_square_diff(self): # Compute: sum_Omega E_q(U,V) [ ( Rij - Ui Vj )^2 ]
-        return(self.M *( ( self.R - numpy.dot(self.expU,self.expV.T) )**2 + \
-                         ( numpy.dot(self.varU+self.expU**2, (self.varV+self.expV**2).T) - numpy.dot(self.expU**2,(self.expV**2).T) ) ) ).sum()
+        if self.sparse:
+            return ( ( self.omega.values - self.omega.dot(self.expU,self.expV) )**2 + \
+                     ( self.omega.dot(self.varU+self.expU**2, self.varV+self.expV**2) - self.omega.dot(self.expU**2,self.expV**2) ) ).sum(dtype=numpy.float64)
+        residual = self.workspace.residual('residual',self.R,self.expU,self.expV.T)
+        residual **= 2
+        work = self.workspace.dot('work',self.varU+self.expU**2,(self.varV+self.expV**2).T)
+        work -= self.workspace.dot('outer',self.expU**2,(self.expV**2).T)
+        residual += work
+        residual *= self.M
+        return residual.sum(dtype=numpy.float64)
         
     def update_U(self,k):       
-        self.tauU[:,k] = self.exptau*(self.M*( self.varV[:,k] + self.expV[:,k]**2 )).sum(axis=1) #sum over j, so rows
-        self.muU[:,k] = 1./self.tauU[:,k] * (-self.lambdaU[:,k] + self.exptau*(self.M * ( (self.R-numpy.dot(self.expU,self.expV.T)+numpy.outer(self.expU[:,k],self.expV[:,k]))*self.expV[:,k] )).sum(axis=1)) 
+        if self.sparse:
+            return self.update_U_sparse(k)
+        self.tauU[:,k] = self.exptau*self.workspace.multiply('work',self.M,self.varV[:,k] + self.expV[:,k]**2).sum(axis=1) #sum over j, so rows
+        residual = self.residual_k(k)
+        residual *= self.expV[:,k]
+        residual *= self.M
+        self.muU[:,k] = 1./self.tauU[:,k] * (-self.lambdaU[:,k] + self.exptau*residual.sum(axis=1)) 
         
     def update_V(self,k):
-        self.tauV[:,k] = self.exptau*(self.M.T*( self.varU[:,k] + self.expU[:,k]**2 )).T.sum(axis=0) #sum over i, so columns
-        self.muV[:,k] = 1./self.tauV[:,k] * (-self.lambdaV[:,k] + self.exptau*(self.M.T * ( (self.R-numpy.dot(self.expU,self.expV.T)+numpy.outer(self.expU[:,k],self.expV[:,k])).T*self.expU[:,k] )).T.sum(axis=0)) 
+        if self.sparse:
+            return self.update_V_sparse(k)
+        self.tauV[:,k] = self.exptau*self.workspace.multiply('work',self.M,(self.varU[:,k] + self.expU[:,k]**2)[:,None]).sum(axis=0) #sum over i, so columns
+        residual = self.residual_k(k)
+        residual *= self.expU[:,k][:,None]
+        residual *= self.M
+        self.muV[:,k] = 1./self.tauV[:,k] * (-self.lambdaV[:,k] + self.exptau*residual.sum(axis=0)) 
+        
+    # Compute R - U V^T + outer(U_.k,V_.k) in the workspace, for the updates of column k
+    def residual_k(self,k):
+        residual = self.workspace.residual('residual',self.R,self.expU,self.expV.T)
+        residual += self.workspace.outer('work',self.expU[:,k],self.expV[:,k])
+        return residual
+        
+    # Same updates, but computed over the observed entries only
+    def update_U_sparse(self,k):
+        (rows,columns) = (self.omega.rows,self.omega.columns)
+        self.tauU[:,k] = self.exptau*self.omega.row_sums( self.varV[columns,k] + self.expV[columns,k]**2 )
+        residual = self.omega.values - self.omega.dot(self.expU,self.expV) + self.expU[rows,k]*self.expV[columns,k]
+        self.muU[:,k] = 1./self.tauU[:,k] * (-self.lambdaU[:,k] + self.exptau*self.omega.row_sums( residual*self.expV[columns,k] ))
+        
+    def update_V_sparse(self,k):
+        (rows,columns) = (self.omega.rows,self.omega.columns)
+        self.tauV[:,k] = self.exptau*self.omega.column_sums( self.varU[rows,k] + self.expU[rows,k]**2 )
+        residual = self.omega.values - self.omega.dot(self.expU,self.expV) + self.expU[rows,k]*self.expV[columns,k]
+        self.muV[:,k] = 1./self.tauV[:,k] * (-self.lambdaV[:,k] + self.exptau*self.omega.column_sums( residual*self.expU[rows,k] ))
+        
+    # Update all columns of U (and their expectations and variances) in one sweep. Since V is fixed,
+    # tauU = exptau * M (varV + expV^2) for all columns at once. We compute the residual E = M*(R - U V^T)
+    # once, and then for column k:
+    #   sum_j M_ij (R_ij - U_i V_j + U_ik V_jk) V_jk = (E V_.k)_i + U_ik (M V_.k^2)_i,
+    # after which we correct E by -M*outer(change in U_.k, V_.k).
+    def update_U_batch(self):
+        (mask,residual) = self.mask_residual()
+        self.tauU = self.exptau*mask.dot(self.varV+self.expV**2)
+        squares = mask.dot(self.expV**2)
+        for k in xrange(0,self.K):
+            residual_V = self.omega.row_sums(residual*self.expV[self.omega.columns,k]) if self.sparse else numpy.dot(residual,self.expV[:,k])
+            self.muU[:,k] = 1./self.tauU[:,k] * (-self.lambdaU[:,k] + self.exptau*( residual_V + self.expU[:,k]*squares[:,k] ))
+            
+            old_expU_k = numpy.copy(self.expU[:,k])
+            self.update_exp_U(k)
+            change = self.expU[:,k] - old_expU_k
+            if self.sparse:
+                residual -= self.omega.outer(change,self.expV[:,k])
+            else:
+                outer = self.workspace.outer('outer',change,self.expV[:,k])
+                outer *= self.M
+                residual -= outer
+            
+    def update_V_batch(self):
+        (mask,residual) = self.mask_residual()
+        self.tauV = self.exptau*mask.T.dot(self.varU+self.expU**2)
+        squares = mask.T.dot(self.expU**2)
+        for k in xrange(0,self.K):
+            residual_U = self.omega.column_sums(residual*self.expU[self.omega.rows,k]) if self.sparse else numpy.dot(residual.T,self.expU[:,k])
+            self.muV[:,k] = 1./self.tauV[:,k] * (-self.lambdaV[:,k] + self.exptau*( residual_U + self.expV[:,k]*squares[:,k] ))
+            
+            old_expV_k = numpy.copy(self.expV[:,k])
+            self.update_exp_V(k)
+            change = self.expV[:,k] - old_expV_k
+            if self.sparse:
+                residual -= self.omega.outer(self.expU[:,k],change)
+            else:
+                outer = self.workspace.outer('outer',self.expU[:,k],change)
+                outer *= self.M
+                residual -= outer
+            
+    # Return the mask (sparse if self.sparse) and the residual M*(R - U V^T) (over the observed entries if self.sparse)
+    def mask_residual(self):
+        if self.sparse:
+            mask = self.omega.matrix(numpy.ones(self.omega.size,dtype=self.dtype))
+            return (mask,self.omega.values-self.omega.dot(self.expU,self.expV))
+        return (self.M,self.workspace.masked_residual('residual',self.M,self.R,self.expU,self.expV))
+        
         
         
     # Update the expectations and variances
     def update_exp_U(self,k):
-        #tn = TruncatedNormalVector(self.muU[:,k],self.tauU[:,k])
-        #self.expU[:,k] = tn.expectation()
-        #self.varU[:,k] = tn.variance()
-        self.expU[:,k] = TN_vector_expectation(self.muU[:,k],self.tauU[:,k])
-        self.varU[:,k] = TN_vector_variance(self.muU[:,k],self.tauU[:,k])
+        self.expU[:,k], self.varU[:,k] = TN_vector_moments(self.muU[:,k],self.tauU[:,k])
         
     def update_exp_V(self,k):
-        #tn = TruncatedNormalVector(self.muV[:,k],self.tauV[:,k])
-        #self.expV[:,k] = tn.expectation()
-        #self.varV[:,k] = tn.variance()
-        self.expV[:,k] = TN_vector_expectation(self.muV[:,k],self.tauV[:,k])
-        self.varV[:,k] = TN_vector_variance(self.muV[:,k],self.tauV[:,k])
+        self.expV[:,k], self.varV[:,k] = TN_vector_moments(self.muV[:,k],self.tauV[:,k])
         
     def update_exp_tau(self):
         self.exptau = gamma_expectation(self.alpha_s,self.beta_s)
         self.explogtau = gamma_expectation_log(self.alpha_s,self.beta_s)
 
 
+    # Return (M,R,R_pred) for the training data, to monitor the performance while running
+    def training_predictions(self):
+        if self.sparse:
+            return (numpy.ones(self.omega.size),self.omega.values,self.omega.dot(self.expU,self.expV))
+        return (self.M,self.R,numpy.dot(self.expU,self.expV.T))
+        
+        
     # Compute the expectation of U and V, and use it to predict missing values
     def predict(self,M_pred):
-        R_pred = numpy.dot(self.expU,self.expV.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(self.expU,self.expV))
+        else:
+            (R,R_pred) = (self.R,numpy.dot(self.expU,self.expV.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
         
@@ -256,6 +410,8 @@ class bnmf_vb_optimised:
             # -2*loglikelihood + 2*no. free parameters
             return - 2 * log_likelihood + 2 * (self.I*self.K+self.J*self.K)
         elif metric == 'MSE':
+            if self.sparse:
+                return ( ( self.omega.values - self.omega.dot(self.expU,self.expV) )**2 ).sum() / float(self.size_Omega)
             R_pred = numpy.dot(self.expU,self.expV.T)
             return self.compute_MSE(self.M,self.R,R_pred)
         elif metric == 'ELBO':
@@ -263,5 +419,8 @@ class bnmf_vb_optimised:
         
     def log_likelihood(self):
         # Return the likelihood of the data given the trained model's parameters
+        if self.sparse:
+            return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
+                 - self.exptau / 2. * ( ( self.omega.values - self.omega.dot(self.expU,self.expV) )**2 ).sum()
         return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
              - self.exptau / 2. * (self.M*( self.R - numpy.dot(self.expU,self.expV.T))**2).sum()
\ No newline at end of file
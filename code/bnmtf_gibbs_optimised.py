@@ -9,11 +9,36 @@ We expect the following arguments:
 - L, the number of column clusters
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaF' = [[lambdaFik]], 'lambdaS' = [[lambdaSkl]], 'lambdaG' = [[lambdaGjl]] },
     a dictionary defining the priors over tau, F, S, G.
+- sparse, optional (default False). If True, we store only the observed entries
+    (see observed_entries.py) and compute all updates over those entries, 
+    rather than multiplying by the dense mask M. Useful when few entries are observed.
+    R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+    copies of them, so the memory scales with the number of observed entries.
+- cache_residual, optional (default False). If True, we maintain the residual R - F S G^T and the
+    products F S, G S^T throughout each iteration using rank-1 corrections, rather than recomputing
+    them for every update of a column of F, G, or entry of S.
+- batch_S, optional (default False). If True, we update all entries of S in one sweep over a 
+    small K x L system, using precomputed Gram-like tensors (see update_S_batch), rather than
+    doing several passes over the I x J matrix for each entry of S.
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the 
+    updates, e.g. numpy.float32 to halve the memory they need. The truncated normal draws are 
+    computed in float64 and stored in this type, and the sums for tau are done in float64.
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
 - init='exp'    -> use the expectation of the priors Exp, Gamma
 Alternatively, you can define your own initial values for F, S, G, and tau.
+Or we can warm start from the fit <model> of the same model with fewer factors,
+using initialise_warm(model,warm_start,seed), with warm_start='split' or 'prior'
+(see warm_start.py): we copy its F, S, G, and add the new columns of F and G by 
+splitting its columns with the highest variance (copying the rows and columns of 
+S), or by drawing them and the new entries of S from the priors. This avoids 
+repeating a KMeans initialisation for each K and L in a model selection.
+
+The random initialisation and the draws of the sampler use the random state of the
+seed given to initialise(...,seed) (see random_state.py): None for numpy's global 
+random state, an int, or a numpy.random.RandomState.
+The KMeans initialisation still uses the random state of the kmeans library.
 
 Usage of class:
     BNMF = bnmf_gibbs(R,M,K,L,priors)
@@ -27,6 +52,11 @@ This returns a tuple (Fs,Ss,Gs,taus) of lists of F, S, G, tau values - of size <
 
 The expectation can be computed by specifying a burn-in and thinning rate, and using:
     BNMF.approx_expectation(burn_in,thinning)
+To avoid keeping all draws in memory, we can instead give the burn-in and thinning
+up front with a SampleStore (see sample_store.py), which keeps running means:
+    BNMF.run(iterations,sample_store=SampleStore(burn_in,thinning))
+approx_expectation, predict and quality then use those means (with the same burn_in 
+and thinning), and the returned lists of draws are None (apart from the taus).
 
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred,burn_in,thinning)
@@ -35,6 +65,11 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+We can choose which performances are computed and printed, and how often, by passing
+a Monitor (see monitor.py) to run(iterations,monitor=monitor).
+run(iterations,resume=True) continues the chain from the current draws, appending to
+the draws and performances of the previous runs (so the burn-in and thinning count
+from the first run). This cannot be combined with a SampleStore.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -48,19 +83,30 @@ import sys
 sys.path.append("/home/tab43/Documents/Projects/libraries/")
 from kmeans_missing.code.kmeans import KMeans
 
-from distributions.exponential import exponential_draw
+from distributions.exponential import exponential_vector_draw
 from distributions.gamma import gamma_draw
 from distributions.truncated_normal import TN_draw
 from distributions.truncated_normal_vector import TN_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
+from warm_start import split_sources, extend_columns, copy_columns
 
 import numpy, itertools, math, time
 
 class bnmtf_gibbs_optimised:
-    def __init__(self,R,M,K,L,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,priors,sparse=False,cache_residual=False,batch_S=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K
         self.L = L
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
+        self.random_state = random_state(None)
+        self.sample_store = None
+        self.cache_residual = cache_residual
+        self.batch_S = batch_S
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
@@ -68,19 +114,21 @@ class bnmtf_gibbs_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
+        self.size_Omega = float(self.omega.size) if self.sparse else self.M.sum(dtype=numpy.float64)
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaF, self.lambdaS, self.lambdaG = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF']), numpy.array(priors['lambdaS']), numpy.array(priors['lambdaG'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF'],dtype=dtype), numpy.array(priors['lambdaS'],dtype=dtype), numpy.array(priors['lambdaG'],dtype=dtype)
         
         # If lambdaF, lambdaS, or lambdaG are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaF.shape == ():
-            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
+            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K),dtype=dtype)
         if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
+            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L),dtype=dtype)
         if self.lambdaG.shape == ():
-            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
+            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L),dtype=dtype)
         
         assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
         assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
@@ -89,8 +137,7 @@ class bnmtf_gibbs_optimised:
         
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -100,86 +147,137 @@ class bnmtf_gibbs_optimised:
 
 
     # Initialise and run the sampler
-    def train(self,init,iterations):
-        self.initialise(init=init)
+    def train(self,init,iterations,seed=None):
+        self.initialise(init=init,seed=seed)
         return self.run(iterations)
 
 
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
-    def initialise(self,init_S='random',init_FG='random'):
+    def initialise(self,init_S='random',init_FG='random',seed=None):
+        self.random_state = random_state(seed)
         assert init_S in ['random','exp'], "Unknown initialisation option for S: %s. Should be 'random' or 'exp'." % init_S
         assert init_FG in ['random','exp','kmeans'], "Unknown initialisation option for S: %s. Should be 'random', 'exp', or 'kmeans." % init_FG
         
         self.S = 1./self.lambdaS
         if init_S == 'random':
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):  
-                self.S[k,l] = exponential_draw(self.lambdaS[k,l])
+            self.S = exponential_vector_draw(self.lambdaS,self.random_state).astype(self.dtype)
                 
         self.F, self.G = 1./self.lambdaF, 1./self.lambdaG
         if init_FG == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.F[i,k] = exponential_draw(self.lambdaF[i,k])
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.G[j,l] = exponential_draw(self.lambdaG[j,l])
+            self.F = exponential_vector_draw(self.lambdaF,self.random_state).astype(self.dtype)
+            self.G = exponential_vector_draw(self.lambdaG,self.random_state).astype(self.dtype)
         elif init_FG == 'kmeans':
+            (R,M) = self.omega.dense() if self.sparse else (self.R,self.M) # KMeans needs the dense matrices
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
+            kmeans_F = KMeans(R,M,self.K)
             kmeans_F.initialise()
             kmeans_F.cluster()
-            self.F = kmeans_F.clustering_results + 0.2            
+            self.F = (kmeans_F.clustering_results + 0.2).astype(self.dtype)            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
+            kmeans_G = KMeans(R.T,M.T,self.L)   
             kmeans_G.initialise()
             kmeans_G.cluster()
-            self.G = kmeans_G.clustering_results + 0.2
+            self.G = (kmeans_G.clustering_results + 0.2).astype(self.dtype)
 
+        self.initialise_residual()
+        self.tau = self.alpha_s() / self.beta_s()
+
+
+    # Initialise F, S, G, and tau from the fit <model> of this model with fewer factors (see warm_start.py)
+    def initialise_warm(self,model,warm_start='split',seed=None):
+        self.random_state = random_state(seed)
+        sources_F = split_sources(model.F,self.K,warm_start)
+        sources_G = split_sources(model.G,self.L,warm_start)
+        self.F = extend_columns(model.F,sources_F,exponential_vector_draw(self.lambdaF,self.random_state),self.random_state).astype(self.dtype)
+        self.G = extend_columns(model.G,sources_G,exponential_vector_draw(self.lambdaG,self.random_state),self.random_state).astype(self.dtype)
+        
+        # Copy the rows of S for the new columns of F, and then its columns for the new columns of G
+        default_S = exponential_vector_draw(self.lambdaS,self.random_state)
+        S = copy_columns(model.S.T,sources_F,default_S[:,:model.L].T).T
+        self.S = copy_columns(S,sources_G,default_S).astype(self.dtype)
+        
+        self.initialise_residual()
         self.tau = self.alpha_s() / self.beta_s()
 
 
     # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_F = numpy.zeros((iterations,self.I,self.K))  
-        self.all_S = numpy.zeros((iterations,self.K,self.L))   
-        self.all_G = numpy.zeros((iterations,self.J,self.L))  
-        self.all_tau = numpy.zeros(iterations)
-        self.all_times = [] # to plot performance against time
-        
-        metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
+    def run(self,iterations,stopping_criterion=None,monitor=None,sample_store=None,resume=False):
+        assert not resume or (sample_store is None and self.sample_store is None), "Cannot resume a run that uses a SampleStore."
+        start = len(self.all_tau) if resume else 0 # iterations of the previous runs
+        self.sample_store = sample_store
+        if sample_store is not None:
+            sample_store.initialise(iterations,{'F':(self.I,self.K),'S':(self.K,self.L),'G':(self.J,self.L),'tau':()})
+            (self.all_F, self.all_S, self.all_G) = (None,None,None)
+        else:
+            self.all_F = numpy.concatenate((self.all_F,numpy.zeros((iterations,self.I,self.K),dtype=self.dtype))) if resume else numpy.zeros((iterations,self.I,self.K),dtype=self.dtype)
+            self.all_S = numpy.concatenate((self.all_S,numpy.zeros((iterations,self.K,self.L),dtype=self.dtype))) if resume else numpy.zeros((iterations,self.K,self.L),dtype=self.dtype)
+            self.all_G = numpy.concatenate((self.all_G,numpy.zeros((iterations,self.J,self.L),dtype=self.dtype))) if resume else numpy.zeros((iterations,self.J,self.L),dtype=self.dtype)
+        self.all_tau = numpy.concatenate((self.all_tau,numpy.zeros(iterations))) if resume else numpy.zeros(iterations)
+        if not resume:
+            self.all_times = [] # to plot performance against time
+        
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['MSE','R^2','Rp'])
+        if not resume:
+            self.all_iterations = [] # iterations at which we computed the performances
+            self.all_performances = {} # for plotting convergence of metrics
+        for metric in monitor.metrics:
+            self.all_performances.setdefault(metric,[])
+        
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
+        time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
         for it in range(0,iterations):            
+            # Recompute the residual each iteration, so rounding errors do not build up
+            self.initialise_residual()
+            
             for k in range(0,self.K):
                 tauFk = self.tauF(k)
                 muFk = self.muF(tauFk,k)
-                self.F[:,k] = TN_vector_draw(muFk,tauFk)
+                self.F[:,k] = TN_vector_draw(muFk,tauFk,self.random_state)
+                self.update_residual_F(k)
                 
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                tauSkl = self.tauS(k,l)
-                muSkl = self.muS(tauSkl,k,l)
-                self.S[k,l] = TN_draw(muSkl,tauSkl)
+            if self.batch_S:
+                self.update_S_batch()
+            else:
+                for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                    tauSkl = self.tauS(k,l)
+                    muSkl = self.muS(tauSkl,k,l)
+                    self.S[k,l] = TN_draw(muSkl,tauSkl,self.random_state)
+                    self.update_residual_S(k,l)
                 
             for l in range(0,self.L):
                 tauGl = self.tauG(l)
                 muGl = self.muG(tauGl,l)
-                self.G[:,l] = TN_vector_draw(muGl,tauGl)
+                self.G[:,l] = TN_vector_draw(muGl,tauGl,self.random_state)
+                self.update_residual_G(l)
                 
-            self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+            self.tau = gamma_draw(self.alpha_s(),self.beta_s(),self.random_state)
             
-            self.all_F[it], self.all_S[it], self.all_G[it], self.all_tau[it] = numpy.copy(self.F), numpy.copy(self.S), numpy.copy(self.G), self.tau
+            self.all_tau[start+it] = self.tau
+            if sample_store is not None:
+                sample_store.add(it,{'F':self.F,'S':self.S,'G':self.G,'tau':self.tau})
+            else:
+                self.all_F[start+it], self.all_S[start+it], self.all_G[start+it] = numpy.copy(self.F), numpy.copy(self.S), numpy.copy(self.G)
             
-            perf = self.predict_while_running()
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            evaluate = monitor.evaluate(it,iterations)
+            if evaluate:
+                perf = monitor.performances(self,self.training_predictions)
+                monitor.record(self,start+it+1,perf)
         
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)            
             
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(dict(perf,tau_sample=self.tau)):
+                self.stop_reason = stopping_criterion.reason
+                self.all_tau = self.all_tau[:start+it+1]
+                if sample_store is None:
+                    (self.all_F, self.all_S, self.all_G) = (self.all_F[:start+it+1], self.all_S[:start+it+1], self.all_G[:start+it+1])
+                break
+            
         return (self.all_F, self.all_S, self.all_G, self.all_tau)
         
 
@@ -193,30 +291,156 @@ class bnmtf_gibbs_optimised:
         return self.alpha + self.size_Omega/2.0
     
     def beta_s(self):   
-        return self.beta + 0.5*(self.M*(self.R-self.triple_dot(self.F,self.S,self.G.T))**2).sum()
+        (residual,_,_) = self.residual_products()
+        if self.sparse:
+            return self.beta + 0.5*(residual**2).sum(dtype=numpy.float64)
+        square = numpy.square(residual,out=self.workspace.get('work',residual.shape))
+        square *= self.M
+        return self.beta + 0.5*square.sum(dtype=numpy.float64)
         
     def tauF(self,k):       
-        return self.tau * ( self.M * numpy.dot(self.S[k],self.G.T)**2 ).sum(axis=1)
+        if self.sparse:
+            return self.tau * self.omega.row_sums( numpy.dot(self.G,self.S[k])[self.omega.columns]**2 )
+        return self.tau * self.workspace.multiply('work',self.M,numpy.dot(self.S[k],self.G.T)**2).sum(axis=1)
         
     def muF(self,tauFk,k):
-        return 1./tauFk * (-self.lambdaF[:,k] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(self.F[:,k],numpy.dot(self.S[k],self.G.T)))*numpy.dot(self.S[k],self.G.T) )).sum(axis=1)) 
+        (residual,_,GS) = self.residual_products()
+        if self.sparse:
+            SGk = GS[self.omega.columns,k]
+            return 1./tauFk * (-self.lambdaF[:,k] + self.tau*self.omega.row_sums((residual+self.F[self.omega.rows,k]*SGk)*SGk))
+        work = self.workspace.outer('work',self.F[:,k],GS[:,k])
+        numpy.add(residual,work,out=work)
+        work *= GS[:,k]
+        work *= self.M
+        return 1./tauFk * (-self.lambdaF[:,k] + self.tau*work.sum(axis=1)) 
         
     def tauS(self,k,l):       
-        return self.tau * ( self.M * numpy.outer(self.F[:,k]**2,self.G[:,l]**2) ).sum()
+        if self.sparse:
+            return self.tau * self.omega.outer(self.F[:,k]**2,self.G[:,l]**2).sum()
+        work = self.workspace.outer('work',self.F[:,k]**2,self.G[:,l]**2)
+        work *= self.M
+        return self.tau * work.sum()
         
     def muS(self,tauSkl,k,l):
-        return 1./tauSkl * (-self.lambdaS[k,l] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+self.S[k,l]*numpy.outer(self.F[:,k],self.G[:,l]))*numpy.outer(self.F[:,k],self.G[:,l]) )).sum()) 
+        (residual,_,_) = self.residual_products()
+        if self.sparse:
+            FkGl = self.omega.outer(self.F[:,k],self.G[:,l])
+            return 1./tauSkl * (-self.lambdaS[k,l] + self.tau*((residual+self.S[k,l]*FkGl)*FkGl).sum())
+        FkGl = self.workspace.outer('outer',self.F[:,k],self.G[:,l])
+        work = numpy.multiply(self.S[k,l],FkGl,out=self.workspace.get('work',FkGl.shape))
+        numpy.add(residual,work,out=work)
+        work *= FkGl
+        work *= self.M
+        return 1./tauSkl * (-self.lambdaS[k,l] + self.tau*work.sum()) 
         
     def tauG(self,l):       
-        return self.tau * ( self.M.T * numpy.dot(self.F,self.S[:,l])**2 ).T.sum(axis=0)
+        if self.sparse:
+            return self.tau * self.omega.column_sums( numpy.dot(self.F,self.S[:,l])[self.omega.rows]**2 )
+        return self.tau * self.workspace.multiply('work',self.M,(numpy.dot(self.F,self.S[:,l])**2)[:,None]).sum(axis=0)
         
     def muG(self,tauGl,l):
-        return 1./tauGl * (-self.lambdaG[:,l] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(numpy.dot(self.F,self.S[:,l]),self.G[:,l])).T * numpy.dot(self.F,self.S[:,l]) ).T).sum(axis=0)) 
+        (residual,FS,_) = self.residual_products()
+        if self.sparse:
+            FSl = FS[self.omega.rows,l]
+            return 1./tauGl * (-self.lambdaG[:,l] + self.tau*self.omega.column_sums((residual+FSl*self.G[self.omega.columns,l])*FSl))
+        work = self.workspace.outer('work',FS[:,l],self.G[:,l])
+        numpy.add(residual,work,out=work)
+        work *= FS[:,l][:,None]
+        work *= self.M
+        return 1./tauGl * (-self.lambdaG[:,l] + self.tau*work.sum(axis=0)) 
+        
+        
+    # Return the residual R - F S G^T (only over Omega in sparse mode), and the products F S and G S^T.
+    # If cache_residual, we use the values maintained below.
+    def residual_products(self):
+        if self.cache_residual:
+            return (self.residual,self.FS,self.GS)
+        return self.compute_residual_products()
+    
+    def compute_residual_products(self):
+        (FS,GS) = (numpy.dot(self.F,self.S),numpy.dot(self.G,self.S.T))
+        residual = self.omega.values - self.omega.dot(self.F,GS) if self.sparse \
+                   else self.workspace.residual('residual',self.R,self.F,numpy.dot(self.S,self.G.T))
+        return (residual,FS,GS)
+        
+    # Maintain the residual and products using rank-1 corrections, each time a column of F or G, 
+    # or an entry of S, has changed. We store the values of F, S, G that the residual corresponds to.
+    def initialise_residual(self):
+        if not self.cache_residual:
+            return
+        (self.cached_F,self.cached_S,self.cached_G) = (numpy.copy(self.F),numpy.copy(self.S),numpy.copy(self.G))
+        (self.residual,self.FS,self.GS) = self.compute_residual_products()
+        
+    def update_residual_F(self,k):
+        if not self.cache_residual:
+            return
+        delta = self.F[:,k] - self.cached_F[:,k]
+        self.residual -= self.omega.outer(delta,self.GS[:,k]) if self.sparse else self.workspace.outer('outer',delta,self.GS[:,k])
+        self.FS += numpy.outer(delta,self.cached_S[k])
+        self.cached_F[:,k] = self.F[:,k]
+        
+    def update_residual_S(self,k,l):
+        if not self.cache_residual:
+            return
+        delta = self.S[k,l] - self.cached_S[k,l]
+        if self.sparse:
+            self.residual -= delta * self.omega.outer(self.cached_F[:,k],self.cached_G[:,l])
+        else:
+            outer = self.workspace.outer('outer',self.cached_F[:,k],self.cached_G[:,l])
+            outer *= delta
+            self.residual -= outer
+        self.FS[:,l] += delta * self.cached_F[:,k]
+        self.GS[:,k] += delta * self.cached_G[:,l]
+        self.cached_S[k,l] = self.S[k,l]
+        
+    def update_residual_G(self,l):
+        if not self.cache_residual:
+            return
+        delta = self.G[:,l] - self.cached_G[:,l]
+        self.residual -= self.omega.outer(self.FS[:,l],delta) if self.sparse else self.workspace.outer('outer',self.FS[:,l],delta)
+        self.GS += numpy.outer(delta,self.cached_S[:,l])
+        self.cached_G[:,l] = self.G[:,l]
+        
+        
+    # Update all entries of S in one sweep. Writing the residual as R - sum_k'l' S_k'l' F_.k' G_.l', 
+    # muS[k,l] only depends on B[k,l] and the sum over k',l' of C[k,l,k',l'] S[k',l'], which we
+    # maintain as CS, and tauS[k,l] = tau * C[k,l,k,l]. So no work over the I x J matrix is needed.
+    def update_S_batch(self):
+        (B,C) = self.gram_tensors(self.F,self.G)
+        CS = numpy.einsum('klpq,pq->kl',C,self.S)
+        tauS = self.tau * numpy.einsum('klkl->kl',C)
+        for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+            tauSkl = tauS[k,l]
+            muSkl = 1./tauSkl * (-self.lambdaS[k,l] + self.tau*(B[k,l] - CS[k,l] + self.S[k,l]*C[k,l,k,l]))
+            new_Skl = TN_draw(muSkl,tauSkl,self.random_state)
+            CS += (new_Skl - self.S[k,l]) * C[:,:,k,l]
+            self.S[k,l] = new_Skl
+        self.initialise_residual()
+        
+    # Compute M dot Y, or (M * R) dot Y if weighted, using the sparse representation in sparse mode
+    def mask_dot(self,Y,weighted=False):
+        if self.sparse:
+            return self.omega.matrix(self.omega.values if weighted else numpy.ones(self.omega.size,dtype=self.dtype)).dot(Y)
+        return numpy.dot(self.M*self.R if weighted else self.M, Y)
+        
+    # Compute B[k,l] = sum_ij M_ij R_ij F_ik G_jl, and C[k,l,k',l'] = sum_ij M_ij F_ik F_ik' G_jl G_jl'
+    def gram_tensors(self,F,G):
+        FF = (F[:,:,None]*F[:,None,:]).reshape((self.I,self.K*self.K))
+        GG = (G[:,:,None]*G[:,None,:]).reshape((self.J,self.L*self.L))
+        B = numpy.dot(F.T,self.mask_dot(G,weighted=True))
+        C = numpy.dot(FF.T,self.mask_dot(GG)).reshape((self.K,self.K,self.L,self.L)).transpose((0,2,1,3))
+        return (B,C)
         
 
     # Return the average value for U, V, tau - i.e. our approximation to the expectations. 
     # Throw away the first <burn_in> samples, and then use every <thinning>th after.
     def approx_expectation(self,burn_in,thinning):
+        if self.sample_store is not None:
+            # We only kept the running means of the draws after the burn-in and thinning
+            store = self.sample_store
+            store.check(burn_in,thinning)
+            return (store.mean('F'), store.mean('S'), store.mean('G'), float(store.mean('tau')))
+        
         indices = range(burn_in,len(self.all_F),thinning)
         exp_F = numpy.array([self.all_F[i] for i in indices]).sum(axis=0) / float(len(indices))      
         exp_S = numpy.array([self.all_S[i] for i in indices]).sum(axis=0) / float(len(indices))   
@@ -225,20 +449,35 @@ class bnmtf_gibbs_optimised:
         return (exp_F, exp_S, exp_G, exp_tau)
 
 
+    # Return (M,R,R_pred) for the training data using the current draws, to monitor the performance while running.
+    # If we cache the residual we already have R - R_pred, so we avoid recomputing the prediction.
+    def training_predictions(self):
+        (M,R) = (numpy.ones(self.omega.size),self.omega.values) if self.sparse else (self.M,self.R)
+        if self.cache_residual:
+            return (M,R,R-self.residual)
+        R_pred = self.omega.dot(self.F,numpy.dot(self.G,self.S.T)) if self.sparse else self.triple_dot(self.F,self.S,self.G.T)
+        return (M,R,R_pred)
+        
+        
     # Compute the expectation of U and V, and use it to predict missing values
     def predict(self,M_pred,burn_in,thinning):
         (exp_F,exp_S,exp_G,_) = self.approx_expectation(burn_in,thinning)
-        R_pred = self.triple_dot(exp_F,exp_S,exp_G.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(exp_F,numpy.dot(exp_G,exp_S.T)))
+        else:
+            (R,R_pred) = (self.R,self.triple_dot(exp_F,exp_S,exp_G.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
     def predict_while_running(self):
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        MSE = self.compute_MSE(self.M,self.R,R_pred)
-        R2 = self.compute_R2(self.M,self.R,R_pred)    
-        Rp = self.compute_Rp(self.M,self.R,R_pred)        
+        (M,R,R_pred) = self.training_predictions()
+        MSE = self.compute_MSE(M,R,R_pred)
+        R2 = self.compute_R2(M,R,R_pred)    
+        Rp = self.compute_Rp(M,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
         
@@ -277,6 +516,8 @@ class bnmtf_gibbs_optimised:
             # -2*loglikelihood + 2*no. free parameters
             return - 2 * log_likelihood + 2 * (self.I*self.K+self.K*self.L+self.J*self.L)
         elif metric == 'MSE':
+            if self.sparse:
+                return ((self.omega.values-self.omega.dot(expF,numpy.dot(expG,expS.T)))**2).sum() / float(self.size_Omega)
             R_pred = self.triple_dot(expF,expS,expG.T)
             return self.compute_MSE(self.M,self.R,R_pred)
         elif metric == 'ELBO':
@@ -285,5 +526,8 @@ class bnmtf_gibbs_optimised:
     def log_likelihood(self,expF,expS,expG,exptau):
         # Return the likelihood of the data given the trained model's parameters
         explogtau = math.log(exptau)
+        if self.sparse:
+            return self.size_Omega / 2. * ( explogtau - math.log(2*math.pi) ) \
+                 - exptau / 2. * ((self.omega.values-self.omega.dot(expF,numpy.dot(expG,expS.T)))**2).sum()
         return self.size_Omega / 2. * ( explogtau - math.log(2*math.pi) ) \
              - exptau / 2. * (self.M*( self.R - self.triple_dot(expF,expS,expG.T) )**2).sum()
\ No newline at end of file
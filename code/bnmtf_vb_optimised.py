@@ -10,6 +10,20 @@ We expect the following arguments:
 - L, the number of column clusters
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaF' = [[lambdaFik]], 'lambdaS' = [[lambdaSkl]], 'lambdaG' = [[lambdaGjl]] },
     a dictionary defining the priors over tau, F, S, G.
+- sparse, optional (default False). If True, we store only the observed entries
+    (see observed_entries.py) and compute all updates over those entries, 
+    rather than multiplying by the dense mask M. Useful when few entries are observed.
+    R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+    copies of them, so the memory scales with the number of observed entries.
+- cache_residual, optional (default False). If True, we maintain the residual R - F S G^T and the
+    products F S, G S^T throughout each iteration using rank-1 corrections, rather than recomputing
+    them for every update of a column of F, G, or entry of S.
+- batch_S, optional (default False). If True, we update all entries of S in one sweep over a 
+    small K x L system, using precomputed Gram-like tensors (see update_S_batch), rather than
+    doing several passes over the I x J matrix for each entry of S.
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the 
+    updates, e.g. numpy.float32 to halve the memory they need. The truncated normal moments are 
+    computed in float64 and stored in this type, and the sums for tau and the ELBO are done in float64.
     
 Initialisation can be done by running the initialise(init_S,init_FG,tauFSG) function, with argument 
 init_S for S, and init_FG for F and G:
@@ -20,7 +34,18 @@ init_S for S, and init_FG for F and G:
           = 'kmeans'    -> muF = KMeans(R,rows)+0.2, muG = KMeans(R,columns)+0.2
 - tauF[i,k] = tauS[k,l] = tauG[j,l] = 1 if tauFSG = {}, else tauF = tauFSG['tauF'], etc.
 - alpha_s, beta_s using updates of model
+Or we can warm start from the fit <model> of the same model with fewer factors,
+using initialise_warm(model,warm_start,seed), with warm_start='split' or 'prior'
+(see warm_start.py): we copy its muF, muS, muG and taus, and add the new columns 
+of muF and muG by splitting its columns with the highest variance (copying the 
+rows and columns of muS), or by drawing them and the new entries of muS from the 
+priors (with tau = 1). This avoids repeating a KMeans initialisation for each K 
+and L in a model selection.
 
+The random initialisation uses the random state of the seed given to 
+initialise(...,seed) (see random_state.py): None for numpy's global random state, 
+an int, or a numpy.random.RandomState.
+The KMeans initialisation still uses the random state of the kmeans library.
 
 Usage of class:
     BNMF = bnmf_vb(R,M,K,L,priors)
@@ -37,6 +62,10 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+We can choose which performances are computed and printed, and how often, by passing
+a Monitor (see monitor.py) to run(iterations,monitor=monitor).
+run(iterations,resume=True) continues from the current values rather than from the
+initialisation, appending to all_performances, all_iterations and all_times.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -53,19 +82,28 @@ from kmeans_missing.code.kmeans import KMeans
 
 from distributions.gamma import gamma_expectation, gamma_expectation_log
 from distributions.truncated_normal import TN_expectation, TN_variance
-from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
-from distributions.exponential import exponential_draw
+from distributions.truncated_normal_vector import TN_vector_moments
+from distributions.exponential import exponential_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
+from warm_start import split_sources, extend_columns, copy_columns
 
 import numpy, itertools, math, scipy, time
 from scipy.stats import norm
 import matplotlib.pyplot as plt
 
 class bnmtf_vb_optimised:
-    def __init__(self,R,M,K,L,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,priors,sparse=False,cache_residual=False,batch_S=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K
         self.L = L
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
+        self.cache_residual = cache_residual
+        self.batch_S = batch_S
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
@@ -73,19 +111,21 @@ class bnmtf_vb_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
+        self.size_Omega = float(self.omega.size) if self.sparse else self.M.sum(dtype=numpy.float64)
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaF, self.lambdaS, self.lambdaG = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF']), numpy.array(priors['lambdaS']), numpy.array(priors['lambdaG'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF'],dtype=dtype), numpy.array(priors['lambdaS'],dtype=dtype), numpy.array(priors['lambdaG'],dtype=dtype)
         
         # If lambdaF, lambdaS, or lambdaG are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaF.shape == ():
-            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
+            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K),dtype=dtype)
         if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
+            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L),dtype=dtype)
         if self.lambdaG.shape == ():
-            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
+            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L),dtype=dtype)
         
         assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
         assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
@@ -94,8 +134,7 @@ class bnmtf_vb_optimised:
             
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -105,47 +144,70 @@ class bnmtf_vb_optimised:
 
 
     # Initialise and run the sampler
-    def train(self,init_S,init_FG,iterations):
-        self.initialise(init_S,init_FG)
+    def train(self,init_S,init_FG,iterations,seed=None):
+        self.initialise(init_S,init_FG,seed=seed)
         return self.run(iterations)
 
 
     # Initialise U, V, and tau. 
-    def initialise(self,init_S='random',init_FG='random',tauFSG={}):
-        self.tauF = tauFSG['tauF'] if 'tauF' in tauFSG else numpy.ones((self.I,self.K))
-        self.tauS = tauFSG['tauS'] if 'tauS' in tauFSG else numpy.ones((self.K,self.L))
-        self.tauG = tauFSG['tauG'] if 'tauG' in tauFSG else numpy.ones((self.J,self.L))
+    def initialise(self,init_S='random',init_FG='random',tauFSG={},seed=None):
+        self.random_state = random_state(seed)
+        self.tauF = tauFSG['tauF'] if 'tauF' in tauFSG else numpy.ones((self.I,self.K),dtype=self.dtype)
+        self.tauS = tauFSG['tauS'] if 'tauS' in tauFSG else numpy.ones((self.K,self.L),dtype=self.dtype)
+        self.tauG = tauFSG['tauG'] if 'tauG' in tauFSG else numpy.ones((self.J,self.L),dtype=self.dtype)
         
         assert init_S in ['exp','random'], "Unrecognised init option for S: %s." % init_S
         self.muS = 1./self.lambdaS
         if init_S == 'random':
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):  
-                self.muS[k,l] = exponential_draw(self.lambdaS[k,l])
+            self.muS = exponential_vector_draw(self.lambdaS,self.random_state).astype(self.dtype)
         
         assert init_FG in ['exp','random','kmeans'], "Unrecognised init option for F,G: %s." % init_FG
         self.muF, self.muG = 1./self.lambdaF, 1./self.lambdaG
         if init_FG == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.muF[i,k] = exponential_draw(self.lambdaF[i,k])
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.muG[j,l] = exponential_draw(self.lambdaG[j,l])
+            self.muF = exponential_vector_draw(self.lambdaF,self.random_state).astype(self.dtype)
+            self.muG = exponential_vector_draw(self.lambdaG,self.random_state).astype(self.dtype)
         elif init_FG == 'kmeans':
+            (R,M) = self.omega.dense() if self.sparse else (self.R,self.M) # KMeans needs the dense matrices
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
+            kmeans_F = KMeans(R,M,self.K)
             kmeans_F.initialise()
             kmeans_F.cluster()
             self.muF = kmeans_F.clustering_results #+ 0.2            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
+            kmeans_G = KMeans(R.T,M.T,self.L)   
             kmeans_G.initialise()
             kmeans_G.cluster()
             self.muG = kmeans_G.clustering_results #+ 0.2
         
-        # Initialise the expectations and variances
-        self.expF, self.varF = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
-        self.expS, self.varS = numpy.zeros((self.K,self.L)), numpy.zeros((self.K,self.L))
-        self.expG, self.varG = numpy.zeros((self.J,self.L)), numpy.zeros((self.J,self.L))
+        self.initialise_expectations()
+        
+        
+    # Initialise muF, muS, muG and their taus from the fit <model> of this model with fewer factors (see warm_start.py)
+    def initialise_warm(self,model,warm_start='split',seed=None):
+        self.random_state = random_state(seed)
+        sources_F = split_sources(model.muF,self.K,warm_start)
+        sources_G = split_sources(model.muG,self.L,warm_start)
+        self.muF = extend_columns(model.muF,sources_F,exponential_vector_draw(self.lambdaF,self.random_state),self.random_state).astype(self.dtype)
+        self.muG = extend_columns(model.muG,sources_G,exponential_vector_draw(self.lambdaG,self.random_state),self.random_state).astype(self.dtype)
+        self.tauF = copy_columns(model.tauF,sources_F,numpy.ones((self.I,self.K))).astype(self.dtype)
+        self.tauG = copy_columns(model.tauG,sources_G,numpy.ones((self.J,self.L))).astype(self.dtype)
+        
+        # Copy the rows of muS and tauS for the new columns of F, and then their columns for the new columns of G
+        default_S = exponential_vector_draw(self.lambdaS,self.random_state)
+        muS = copy_columns(model.muS.T,sources_F,default_S[:,:model.L].T).T
+        self.muS = copy_columns(muS,sources_G,default_S).astype(self.dtype)
+        tauS = copy_columns(model.tauS.T,sources_F,numpy.ones((model.L,self.K))).T
+        self.tauS = copy_columns(tauS,sources_G,numpy.ones((self.K,self.L))).astype(self.dtype)
+        
+        self.initialise_expectations()
+        
+        
+    # Initialise the expectations and variances of F, S, G from mu and tau, and then tau
+    def initialise_expectations(self):
+        self.expF, self.varF = numpy.zeros((self.I,self.K),dtype=self.dtype), numpy.zeros((self.I,self.K),dtype=self.dtype)
+        self.expS, self.varS = numpy.zeros((self.K,self.L),dtype=self.dtype), numpy.zeros((self.K,self.L),dtype=self.dtype)
+        self.expG, self.varG = numpy.zeros((self.J,self.L),dtype=self.dtype), numpy.zeros((self.J,self.L),dtype=self.dtype)
         
         for k in range(0,self.K):
             self.update_exp_F(k)
@@ -155,70 +217,91 @@ class bnmtf_vb_optimised:
             self.update_exp_G(l)
             
         # Initialise tau using the updates
+        self.initialise_residual()
         self.update_tau()
         #self.alpha_s, self.beta_s = self.alpha, self.beta
         self.update_exp_tau()
 
 
     # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_exp_tau = []  # to check for convergence 
-        self.all_times = [] # to plot performance against time    
+    def run(self,iterations,stopping_criterion=None,monitor=None,resume=False):
+        if not resume:
+            self.all_exp_tau = []  # to check for convergence 
+            self.all_times = [] # to plot performance against time    
+        start = len(self.all_exp_tau) # iterations of the previous runs, if we resume
         
-        metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['ELBO','MSE','R^2','Rp'])
+        if not resume:
+            self.all_iterations = [] # iterations at which we computed the performances
+            self.all_performances = {} # for plotting convergence of metrics
+        for metric in monitor.metrics:
+            self.all_performances.setdefault(metric,[])
         
-        time_start = time.time()
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
+        time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
         for it in range(0,iterations):         
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                self.update_S(k,l)
-                self.update_exp_S(k,l)
+            # Recompute the residual each iteration, so rounding errors do not build up
+            self.initialise_residual()
+            
+            if self.batch_S:
+                self.update_S_batch()
+            else:
+                for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                    self.update_S(k,l)
+                    self.update_exp_S(k,l)
+                    self.update_residual_S(k,l)
                 
             for k in range(0,self.K):
                 self.update_F(k)
                 self.update_exp_F(k)
+                self.update_residual_F(k)
                 
             for l in range(0,self.L):
                 self.update_G(l)
                 self.update_exp_G(l)
+                self.update_residual_G(l)
                 
             self.update_tau()
             self.update_exp_tau()
             self.all_exp_tau.append(self.exptau)
             
-            perf, elbo = self.predict(self.M), self.elbo()
-            
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+            evaluate = monitor.evaluate(it,iterations)
+            if evaluate:
+                perf = monitor.performances(self,self.training_predictions,{'ELBO':self.elbo})
+                monitor.record(self,start+it+1,perf)
                         
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)            
             
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(dict(perf,tau=self.exptau)):
+                self.stop_reason = stopping_criterion.reason
+                break
+            
         
     # Compute the ELBO
     def elbo(self):
         return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
              - self.exptau / 2. * self.exp_square_diff() \
-             + numpy.log(self.lambdaF).sum() - ( self.lambdaF * self.expF ).sum() \
-             + numpy.log(self.lambdaS).sum() - ( self.lambdaS * self.expS ).sum() \
-             + numpy.log(self.lambdaG).sum() - ( self.lambdaG * self.expG ).sum() \
+             + numpy.log(self.lambdaF).sum(dtype=numpy.float64) - ( self.lambdaF * self.expF ).sum(dtype=numpy.float64) \
+             + numpy.log(self.lambdaS).sum(dtype=numpy.float64) - ( self.lambdaS * self.expS ).sum(dtype=numpy.float64) \
+             + numpy.log(self.lambdaG).sum(dtype=numpy.float64) - ( self.lambdaG * self.expG ).sum(dtype=numpy.float64) \
              + self.alpha * math.log(self.beta) - scipy.special.gammaln(self.alpha) \
              + (self.alpha - 1.)*self.explogtau - self.beta * self.exptau \
              - self.alpha_s * math.log(self.beta_s) + scipy.special.gammaln(self.alpha_s) \
              - (self.alpha_s - 1.)*self.explogtau + self.beta_s * self.exptau \
-             - .5*numpy.log(self.tauF).sum() + self.I*self.K/2.*math.log(2*math.pi) \
-             + numpy.log(0.5*scipy.special.erfc(-self.muF*numpy.sqrt(self.tauF)/math.sqrt(2))).sum() \
-             + ( self.tauF / 2. * ( self.varF + (self.expF - self.muF)**2 ) ).sum() \
-             - .5*numpy.log(self.tauS).sum() + self.K*self.L/2.*math.log(2*math.pi) \
-             + numpy.log(0.5*scipy.special.erfc(-self.muS*numpy.sqrt(self.tauS)/math.sqrt(2))).sum() \
-             + ( self.tauS / 2. * ( self.varS + (self.expS - self.muS)**2 ) ).sum() \
-             - .5*numpy.log(self.tauG).sum() + self.J*self.L/2.*math.log(2*math.pi) \
-             + numpy.log(0.5*scipy.special.erfc(-self.muG*numpy.sqrt(self.tauG)/math.sqrt(2))).sum() \
-             + ( self.tauG / 2. * ( self.varG + (self.expG - self.muG)**2 ) ).sum()
+             - .5*numpy.log(self.tauF).sum(dtype=numpy.float64) + self.I*self.K/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muF.astype(numpy.float64)*numpy.sqrt(self.tauF)/math.sqrt(2))).sum(dtype=numpy.float64) \
+             + ( self.tauF / 2. * ( self.varF + (self.expF - self.muF)**2 ) ).sum(dtype=numpy.float64) \
+             - .5*numpy.log(self.tauS).sum(dtype=numpy.float64) + self.K*self.L/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muS.astype(numpy.float64)*numpy.sqrt(self.tauS)/math.sqrt(2))).sum(dtype=numpy.float64) \
+             + ( self.tauS / 2. * ( self.varS + (self.expS - self.muS)**2 ) ).sum(dtype=numpy.float64) \
+             - .5*numpy.log(self.tauG).sum(dtype=numpy.float64) + self.J*self.L/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muG.astype(numpy.float64)*numpy.sqrt(self.tauG)/math.sqrt(2))).sum(dtype=numpy.float64) \
+             + ( self.tauG / 2. * ( self.varG + (self.expG - self.muG)**2 ) ).sum(dtype=numpy.float64)
         
 
     # Compute the dot product of three matrices
@@ -232,17 +315,46 @@ class bnmtf_vb_optimised:
         self.beta_s = self.beta + 0.5*self.exp_square_diff()
         
     def exp_square_diff(self): # Compute: sum_Omega E_q(F,S,G) [ ( Rij - Fi S Gj )^2 ]
-        return (self.M*( self.R - self.triple_dot(self.expF,self.expS,self.expG.T) )**2).sum() + \
-               (self.M*( self.triple_dot(self.varF+self.expF**2, self.varS+self.expS**2, (self.varG+self.expG**2).T ) - self.triple_dot(self.expF**2,self.expS**2,(self.expG**2).T) )).sum() + \
-               (self.M*( numpy.dot(self.varF, ( numpy.dot(self.expS,self.expG.T)**2 - numpy.dot(self.expS**2,self.expG.T**2) ) ) )).sum() + \
-               (self.M*( numpy.dot( numpy.dot(self.expF,self.expS)**2 - numpy.dot(self.expF**2,self.expS**2), self.varG.T ) )).sum()
+        if self.sparse:
+            return self.exp_square_diff_sparse()
+        (residual,_,_) = self.residual_products()
+        (work,outer) = (self.workspace.get('work',residual.shape),self.workspace.get('outer',residual.shape))
+        numpy.square(residual,out=work)
+        work *= self.M
+        square_residual = work.sum(dtype=numpy.float64)
+        
+        numpy.dot(self.varF+self.expF**2, numpy.dot(self.varS+self.expS**2, (self.varG+self.expG**2).T), out=work)
+        numpy.dot(self.expF**2, numpy.dot(self.expS**2, (self.expG**2).T), out=outer)
+        work -= outer
+        work *= self.M
+        var_FSG = work.sum(dtype=numpy.float64)
+        
+        numpy.dot(self.varF, ( numpy.dot(self.expS,self.expG.T)**2 - numpy.dot(self.expS**2,self.expG.T**2) ), out=work)
+        work *= self.M
+        var_F = work.sum(dtype=numpy.float64)
+        
+        numpy.dot( numpy.dot(self.expF,self.expS)**2 - numpy.dot(self.expF**2,self.expS**2), self.varG.T, out=work)
+        work *= self.M
+        var_G = work.sum(dtype=numpy.float64)
+        return square_residual + var_FSG + var_F + var_G
     
     def update_F(self,k):  
+        if self.sparse:
+            return self.update_F_sparse(k)
+        (residual,FS,GS) = self.residual_products()
         varSkG = numpy.dot( self.varS[k]+self.expS[k]**2 , (self.varG+self.expG**2).T ) - numpy.dot( self.expS[k]**2 , (self.expG**2).T ) # Vector of size J
-        self.tauF[:,k] = self.exptau * numpy.dot( varSkG + ( numpy.dot(self.expS[k],self.expG.T) )**2 , self.M.T ) 
+        self.tauF[:,k] = self.exptau * numpy.dot( varSkG + ( GS[:,k] )**2 , self.M.T ) 
+        
+        work = self.workspace.outer('work',self.expF[:,k],GS[:,k])
+        numpy.add(residual,work,out=work)
+        work *= GS[:,k]
+        work *= self.M
+        diff_term = work.sum(axis=1)
         
-        diff_term = (self.M * ( (self.R-self.triple_dot(self.expF,self.expS,self.expG.T)+numpy.outer(self.expF[:,k],numpy.dot(self.expS[k],self.expG.T)) ) * numpy.dot(self.expS[k],self.expG.T) )).sum(axis=1)        
-        cov_term = ( self.M * ( ( numpy.dot(self.expS[k]*numpy.dot(self.expF,self.expS), self.varG.T) - numpy.outer(self.expF[:,k], numpy.dot( self.expS[k]**2, self.varG.T )) ) ) ).sum(axis=1)
+        work = self.workspace.dot('work',self.expS[k]*FS,self.varG.T)
+        work -= self.workspace.outer('outer',self.expF[:,k],numpy.dot( self.expS[k]**2, self.varG.T ))
+        work *= self.M
+        cov_term = work.sum(axis=1)
         self.muF[:,k] = 1./self.tauF[:,k] * (
             - self.lambdaF[:,k]
             + self.exptau * diff_term
@@ -250,11 +362,19 @@ class bnmtf_vb_optimised:
         ) 
         
     def update_S(self,k,l):       
-        self.tauS[k,l] = self.exptau*(self.M*( numpy.outer( self.varF[:,k]+self.expF[:,k]**2 , self.varG[:,l]+self.expG[:,l]**2 ) )).sum()
+        if self.sparse:
+            return self.update_S_sparse(k,l)
+        (residual,FS,GS) = self.residual_products()
+        self.tauS[k,l] = self.exptau*self.masked_outer_sum( self.varF[:,k]+self.expF[:,k]**2 , self.varG[:,l]+self.expG[:,l]**2 )
         
-        diff_term = (self.M * ( (self.R-self.triple_dot(self.expF,self.expS,self.expG.T)+self.expS[k,l]*numpy.outer(self.expF[:,k],self.expG[:,l]) ) * numpy.outer(self.expF[:,k],self.expG[:,l]) )).sum()
-        cov_term_G = (self.M * numpy.outer( self.expF[:,k] * ( numpy.dot(self.expF,self.expS[:,l]) - self.expF[:,k]*self.expS[k,l] ), self.varG[:,l] )).sum()
-        cov_term_F = (self.M * numpy.outer( self.varF[:,k], self.expG[:,l]*(numpy.dot(self.expS[k],self.expG.T) - self.expS[k,l]*self.expG[:,l]) )).sum()        
+        FkGl = self.workspace.outer('outer',self.expF[:,k],self.expG[:,l])
+        work = numpy.multiply(self.expS[k,l],FkGl,out=self.workspace.get('work',FkGl.shape))
+        numpy.add(residual,work,out=work)
+        work *= FkGl
+        work *= self.M
+        diff_term = work.sum()
+        cov_term_G = self.masked_outer_sum( self.expF[:,k] * ( FS[:,l] - self.expF[:,k]*self.expS[k,l] ), self.varG[:,l] )
+        cov_term_F = self.masked_outer_sum( self.varF[:,k], self.expG[:,l]*(GS[:,k] - self.expS[k,l]*self.expG[:,l]) )
         self.muS[k,l] = 1./self.tauS[k,l] * (
             - self.lambdaS[k,l] 
             + self.exptau * diff_term
@@ -263,41 +383,227 @@ class bnmtf_vb_optimised:
         ) 
         
     def update_G(self,l):  
+        if self.sparse:
+            return self.update_G_sparse(l)
+        (residual,FS,GS) = self.residual_products()
         varFSl = numpy.dot( self.varF+self.expF**2 , self.varS[:,l]+self.expS[:,l]**2 ) - numpy.dot( self.expF**2 , self.expS[:,l]**2 ) # Vector of size I
-        self.tauG[:,l] = self.exptau * numpy.dot( ( varFSl + ( numpy.dot(self.expF,self.expS[:,l]) )**2 ).T, self.M) #sum over i, so columns        
+        self.tauG[:,l] = self.exptau * numpy.dot( ( varFSl + ( FS[:,l] )**2 ).T, self.M) #sum over i, so columns        
         
-        diff_term = (self.M * ( (self.R-self.triple_dot(self.expF,self.expS,self.expG.T)+numpy.outer(numpy.dot(self.expF,self.expS[:,l]), self.expG[:,l]) ).T * numpy.dot(self.expF,self.expS[:,l]) ).T ).sum(axis=0)
-        cov_term = (self.M * ( numpy.dot(self.varF, (self.expS[:,l]*numpy.dot(self.expS,self.expG.T).T).T) - numpy.outer(numpy.dot(self.varF,self.expS[:,l]**2), self.expG[:,l]) )).sum(axis=0)
+        work = self.workspace.outer('work',FS[:,l],self.expG[:,l])
+        numpy.add(residual,work,out=work)
+        work *= FS[:,l][:,None]
+        work *= self.M
+        diff_term = work.sum(axis=0)
+        
+        work = self.workspace.dot('work',self.varF,(self.expS[:,l]*GS).T)
+        work -= self.workspace.outer('outer',numpy.dot(self.varF,self.expS[:,l]**2),self.expG[:,l])
+        work *= self.M
+        cov_term = work.sum(axis=0)
         self.muG[:,l] = 1./self.tauG[:,l] * (
             - self.lambdaG[:,l] 
             + self.exptau * diff_term
             - self.exptau * cov_term
         )
+        
+    # Compute (M * numpy.outer(a,b)).sum() in the workspace
+    def masked_outer_sum(self,a,b):
+        work = self.workspace.outer('work',a,b)
+        work *= self.M
+        return work.sum()
+        
+    # Same updates, but computed over the observed entries only
+    def exp_square_diff_sparse(self):
+        (residual,FS,GS) = self.residual_products()
+        (expF2,expS2,expG2) = (self.expF**2,self.expS**2,self.expG**2)
+        return ( residual**2 + \
+                 ( self.omega.dot(self.varF+expF2, numpy.dot(self.varG+expG2,(self.varS+expS2).T)) - self.omega.dot(expF2,numpy.dot(expG2,expS2.T)) ) + \
+                 ( self.omega.dot(self.varF, GS**2 - numpy.dot(expG2,expS2.T)) ) + \
+                 ( self.omega.dot(FS**2 - numpy.dot(expF2,expS2), self.varG) ) ).sum(dtype=numpy.float64)
+        
+    def update_F_sparse(self,k):
+        (rows,columns) = (self.omega.rows,self.omega.columns)
+        (residual,FS,GS) = self.residual_products()
+        SGk = GS[:,k] # Vector of size J
+        varSkG = numpy.dot( self.varG+self.expG**2, self.varS[k]+self.expS[k]**2 ) - numpy.dot( self.expG**2, self.expS[k]**2 ) # Vector of size J
+        self.tauF[:,k] = self.exptau * self.omega.row_sums( (varSkG + SGk**2)[columns] )
+        
+        diff_term = self.omega.row_sums( (residual + self.expF[rows,k]*SGk[columns])*SGk[columns] )
+        cov_term = self.omega.row_sums( self.omega.dot(self.expS[k]*FS, self.varG) - self.expF[rows,k]*numpy.dot(self.varG,self.expS[k]**2)[columns] )
+        self.muF[:,k] = 1./self.tauF[:,k] * (
+            - self.lambdaF[:,k]
+            + self.exptau * diff_term
+            - self.exptau * cov_term
+        ) 
+        
+    def update_S_sparse(self,k,l):
+        (residual,FS,GS) = self.residual_products()
+        self.tauS[k,l] = self.exptau*self.omega.outer( self.varF[:,k]+self.expF[:,k]**2 , self.varG[:,l]+self.expG[:,l]**2 ).sum()
+        
+        FkGl = self.omega.outer(self.expF[:,k],self.expG[:,l])
+        diff_term = ((residual + self.expS[k,l]*FkGl)*FkGl).sum()
+        cov_term_G = self.omega.outer( self.expF[:,k] * ( FS[:,l] - self.expF[:,k]*self.expS[k,l] ), self.varG[:,l] ).sum()
+        cov_term_F = self.omega.outer( self.varF[:,k], self.expG[:,l]*(GS[:,k] - self.expS[k,l]*self.expG[:,l]) ).sum()
+        self.muS[k,l] = 1./self.tauS[k,l] * (
+            - self.lambdaS[k,l] 
+            + self.exptau * diff_term
+            - self.exptau * cov_term_G
+            - self.exptau * cov_term_F
+        ) 
+        
+    def update_G_sparse(self,l):
+        (rows,columns) = (self.omega.rows,self.omega.columns)
+        (residual,FS,GS) = self.residual_products()
+        FSl = FS[:,l] # Vector of size I
+        varFSl = numpy.dot( self.varF+self.expF**2 , self.varS[:,l]+self.expS[:,l]**2 ) - numpy.dot( self.expF**2 , self.expS[:,l]**2 ) # Vector of size I
+        self.tauG[:,l] = self.exptau * self.omega.column_sums( (varFSl + FSl**2)[rows] )
+        
+        diff_term = self.omega.column_sums( (residual + FSl[rows]*self.expG[columns,l])*FSl[rows] )
+        cov_term = self.omega.column_sums( self.omega.dot(self.varF*self.expS[:,l], GS) - numpy.dot(self.varF,self.expS[:,l]**2)[rows]*self.expG[columns,l] )
+        self.muG[:,l] = 1./self.tauG[:,l] * (
+            - self.lambdaG[:,l] 
+            + self.exptau * diff_term
+            - self.exptau * cov_term
+        )
+        
+    # Return the residual R - F S G^T (only over Omega in sparse mode), and the products F S and G S^T,
+    # using the expectations of F, S, G. If cache_residual, we use the values maintained below.
+    def residual_products(self):
+        if self.cache_residual:
+            return (self.residual,self.FS,self.GS)
+        return self.compute_residual_products()
+    
+    def compute_residual_products(self):
+        (FS,GS) = (numpy.dot(self.expF,self.expS),numpy.dot(self.expG,self.expS.T))
+        residual = self.omega.values - self.omega.dot(self.expF,GS) if self.sparse \
+                   else self.workspace.residual('residual',self.R,self.expF,numpy.dot(self.expS,self.expG.T))
+        return (residual,FS,GS)
+        
+    # Maintain the residual and products using rank-1 corrections, each time a column of F or G, 
+    # or an entry of S, has changed. We store the values of F, S, G that the residual corresponds to.
+    def initialise_residual(self):
+        if not self.cache_residual:
+            return
+        (self.cached_F,self.cached_S,self.cached_G) = (numpy.copy(self.expF),numpy.copy(self.expS),numpy.copy(self.expG))
+        (self.residual,self.FS,self.GS) = self.compute_residual_products()
+        
+    def update_residual_F(self,k):
+        if not self.cache_residual:
+            return
+        delta = self.expF[:,k] - self.cached_F[:,k]
+        self.residual -= self.omega.outer(delta,self.GS[:,k]) if self.sparse else self.workspace.outer('outer',delta,self.GS[:,k])
+        self.FS += numpy.outer(delta,self.cached_S[k])
+        self.cached_F[:,k] = self.expF[:,k]
+        
+    def update_residual_S(self,k,l):
+        if not self.cache_residual:
+            return
+        delta = self.expS[k,l] - self.cached_S[k,l]
+        if self.sparse:
+            self.residual -= delta * self.omega.outer(self.cached_F[:,k],self.cached_G[:,l])
+        else:
+            outer = self.workspace.outer('outer',self.cached_F[:,k],self.cached_G[:,l])
+            outer *= delta
+            self.residual -= outer
+        self.FS[:,l] += delta * self.cached_F[:,k]
+        self.GS[:,k] += delta * self.cached_G[:,l]
+        self.cached_S[k,l] = self.expS[k,l]
+        
+    def update_residual_G(self,l):
+        if not self.cache_residual:
+            return
+        delta = self.expG[:,l] - self.cached_G[:,l]
+        self.residual -= self.omega.outer(self.FS[:,l],delta) if self.sparse else self.workspace.outer('outer',self.FS[:,l],delta)
+        self.GS += numpy.outer(delta,self.cached_S[:,l])
+        self.cached_G[:,l] = self.expG[:,l]
+        
+        
+    # Update all entries of S in one sweep. Writing the residual as R - sum_k'l' S_k'l' F_.k' G_.l', 
+    # the terms in muS[k,l] become sums over k',l' of the Gram-like tensors below, times expS:
+    # - C[k,l,k',l'] = sum_ij M_ij F_ik F_ik' G_jl G_jl' (diff_term), maintained as CS
+    # - D[k,k',l] = sum_ij M_ij F_ik F_ik' varG_jl (cov_term_G), maintained as DS
+    # - E[k,l,l'] = sum_ij M_ij varF_ik G_jl G_jl' (cov_term_F), maintained as ES
+    # and tauS does not depend on S. So no work over the I x J matrix is needed inside the sweep.
+    def update_S_batch(self):
+        (B,C) = self.gram_tensors(self.expF,self.expG)
+        FF = (self.expF[:,:,None]*self.expF[:,None,:]).reshape((self.I,self.K*self.K))
+        GG = (self.expG[:,:,None]*self.expG[:,None,:]).reshape((self.J,self.L*self.L))
+        D = numpy.dot(FF.T,self.mask_dot(self.varG)).reshape((self.K,self.K,self.L))
+        E = numpy.dot(self.varF.T,self.mask_dot(GG)).reshape((self.K,self.L,self.L))
+        
+        self.tauS = self.exptau * numpy.dot( (self.varF+self.expF**2).T, self.mask_dot(self.varG+self.expG**2) )
+        CS = numpy.einsum('klpq,pq->kl',C,self.expS)
+        DS = numpy.einsum('kpl,pl->kl',D,self.expS)
+        ES = numpy.einsum('klq,kq->kl',E,self.expS)
+        for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+            diff_term = B[k,l] - CS[k,l] + self.expS[k,l]*C[k,l,k,l]
+            cov_term_G = DS[k,l] - self.expS[k,l]*D[k,k,l]
+            cov_term_F = ES[k,l] - self.expS[k,l]*E[k,l,l]
+            self.muS[k,l] = 1./self.tauS[k,l] * (
+                - self.lambdaS[k,l] 
+                + self.exptau * diff_term
+                - self.exptau * cov_term_G
+                - self.exptau * cov_term_F
+            ) 
+            
+            old_expSkl = self.expS[k,l]
+            self.update_exp_S(k,l)
+            delta = self.expS[k,l] - old_expSkl
+            CS += delta * C[:,:,k,l]
+            DS[:,l] += delta * D[:,k,l]
+            ES[k,:] += delta * E[k,:,l]
+        self.initialise_residual()
+        
+    # Compute M dot Y, or (M * R) dot Y if weighted, using the sparse representation in sparse mode
+    def mask_dot(self,Y,weighted=False):
+        if self.sparse:
+            return self.omega.matrix(self.omega.values if weighted else numpy.ones(self.omega.size,dtype=self.dtype)).dot(Y)
+        return numpy.dot(self.M*self.R if weighted else self.M, Y)
+        
+    # Compute B[k,l] = sum_ij M_ij R_ij F_ik G_jl, and C[k,l,k',l'] = sum_ij M_ij F_ik F_ik' G_jl G_jl'
+    def gram_tensors(self,F,G):
+        FF = (F[:,:,None]*F[:,None,:]).reshape((self.I,self.K*self.K))
+        GG = (G[:,:,None]*G[:,None,:]).reshape((self.J,self.L*self.L))
+        B = numpy.dot(F.T,self.mask_dot(G,weighted=True))
+        C = numpy.dot(FF.T,self.mask_dot(GG)).reshape((self.K,self.K,self.L,self.L)).transpose((0,2,1,3))
+        return (B,C)
 
     # Update the expectations and variances
     def update_exp_F(self,k):
-        self.expF[:,k] = TN_vector_expectation(self.muF[:,k],self.tauF[:,k])
-        self.varF[:,k] = TN_vector_variance(self.muF[:,k],self.tauF[:,k])
+        self.expF[:,k], self.varF[:,k] = TN_vector_moments(self.muF[:,k],self.tauF[:,k])
         
     def update_exp_S(self,k,l):
         self.expS[k,l] = TN_expectation(self.muS[k,l],self.tauS[k,l])
         self.varS[k,l] = TN_variance(self.muS[k,l],self.tauS[k,l])
         
     def update_exp_G(self,l):
-        self.expG[:,l] = TN_vector_expectation(self.muG[:,l],self.tauG[:,l])
-        self.varG[:,l] = TN_vector_variance(self.muG[:,l],self.tauG[:,l])
+        self.expG[:,l], self.varG[:,l] = TN_vector_moments(self.muG[:,l],self.tauG[:,l])
         
     def update_exp_tau(self):
         self.exptau = gamma_expectation(self.alpha_s,self.beta_s)
         self.explogtau = gamma_expectation_log(self.alpha_s,self.beta_s)
 
 
+    # Return (M,R,R_pred) for the training data, to monitor the performance while running.
+    # If we cache the residual we already have R - R_pred, so we avoid recomputing the prediction.
+    def training_predictions(self):
+        (M,R) = (numpy.ones(self.omega.size),self.omega.values) if self.sparse else (self.M,self.R)
+        if self.cache_residual:
+            return (M,R,R-self.residual)
+        R_pred = self.omega.dot(self.expF,numpy.dot(self.expG,self.expS.T)) if self.sparse else self.triple_dot(self.expF,self.expS,self.expG.T)
+        return (M,R,R_pred)
+        
+        
     # Compute the expectation of U and V, and use it to predict missing values
     def predict(self,M_pred):
-        R_pred = self.triple_dot(self.expF,self.expS,self.expG.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(self.expF,numpy.dot(self.expG,self.expS.T)))
+        else:
+            (R,R_pred) = (self.R,self.triple_dot(self.expF,self.expS,self.expG.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
         
@@ -333,6 +639,8 @@ class bnmtf_vb_optimised:
             # -2*loglikelihood + 2*no. free parameters
             return - 2 * log_likelihood + 2 * (self.I*self.K+self.K*self.L+self.J*self.L)
         elif metric == 'MSE':
+            if self.sparse:
+                return ( ( self.omega.values - self.omega.dot(self.expF,numpy.dot(self.expG,self.expS.T)) )**2 ).sum() / float(self.size_Omega)
             R_pred = self.triple_dot(self.expF,self.expS,self.expG.T)
             return self.compute_MSE(self.M,self.R,R_pred)
         elif metric == 'ELBO':
@@ -340,5 +648,8 @@ class bnmtf_vb_optimised:
         
     def log_likelihood(self):
         # Return the likelihood of the data given the trained model's parameters
+        if self.sparse:
+            return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
+                 - self.exptau / 2. * ( ( self.omega.values - self.omega.dot(self.expF,numpy.dot(self.expG,self.expS.T)) )**2 ).sum()
         return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
              - self.exptau / 2. * (self.M*( self.R - self.triple_dot(self.expF,self.expS,self.expG.T) )**2).sum()
\ No newline at end of file
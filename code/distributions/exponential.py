@@ -1,12 +1,20 @@
 """
 Class representing an exponential distribution, allowing us to sample from it.
+
+The draws take an optional random_state (a numpy.random.RandomState), and use
+numpy's global random state if it is not given.
 """
-from numpy.random import exponential
+import numpy
 
 # Exponential draws
-def exponential_draw(lambdax):
+def exponential_draw(lambdax,random_state=numpy.random):
     scale = 1.0 / lambdax
-    return exponential(scale=scale,size=None)
+    return random_state.exponential(scale=scale,size=None)
+    
+# Exponential draws for an entire array of lambda values at once
+def exponential_vector_draw(lambdas,random_state=numpy.random):
+    scales = 1.0 / numpy.array(lambdas,dtype=float)
+    return random_state.exponential(scale=scales,size=scales.shape)
         
 '''
 # Do 1000 draws and plot them
@@ -1,17 +1,19 @@
 """
 Class representing a gamma distribution, allowing us to sample from it, 
 and compute the expectation and the expectation of the log.
+
+The draws take an optional random_state (a numpy.random.RandomState), and use
+numpy's global random state if it is not given.
 """
-import math
+import math, numpy
 from scipy.special import psi as digamma
-from numpy.random import gamma
 
 
 # Gamma draws
-def gamma_draw(alpha,beta):       
+def gamma_draw(alpha,beta,random_state=numpy.random):       
     shape = float(alpha)
     scale = 1.0 / float(beta)
-    return gamma(shape=shape,scale=scale,size=None)
+    return random_state.gamma(shape=shape,scale=scale,size=None)
         
 # Gamma expectation
 def gamma_expectation(alpha,beta): 
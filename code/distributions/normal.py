@@ -1,13 +1,15 @@
 """
 Class representing an normal distribution, allowing us to sample from it.
+
+The draws take an optional random_state (a numpy.random.RandomState), and use
+numpy's global random state if it is not given.
 """
-from numpy.random import normal
 import numpy, math
 
 # Draw a value for tau ~ Gamma(alpha,beta)
-def normal_draw(mu,tau):
+def normal_draw(mu,tau,random_state=numpy.random):
     sigma = numpy.float64(1.0) / math.sqrt(tau)
-    return normal(loc=mu,scale=sigma,size=None)
+    return random_state.normal(loc=mu,scale=sigma,size=None)
     
        
 '''
@@ -10,10 +10,11 @@ Created on Mon Aug 12 13:48:22 2013
 @author: Christoph Lassner
 """
 from scipy.special import erf
-from numpy.random import uniform as rand, normal as randn, randint as randi
-from numpy import sqrt, pi, exp, log, floor, array
+from numpy import random
+from numpy import sqrt, pi, exp, log, floor, array, empty, zeros, arange, \
+    broadcast_arrays, errstate, minimum, where
 
-def rtnorm(a, b, mu=0., sigma=1., size=1, probabilities=False):
+def rtnorm(a, b, mu=0., sigma=1., size=1, probabilities=False, random_state=random):
     r"""
     Pseudorandom numbers from a truncated Gaussian distribution.
  
@@ -27,6 +28,8 @@ def rtnorm(a, b, mu=0., sigma=1., size=1, probabilities=False):
  
     The parameter size allows to specify a vector length and if probabilities
     is set to True, the function also returns the vector of probabilities of X.
+    The draws use random_state (a numpy.random.RandomState) if it is given, and
+    numpy's global random state otherwise.
 
     This implements an extension of Chopin's algorithm detailed in
     N. Chopin, "Fast simulation of truncated Gaussian distributions", Stat
@@ -70,8 +73,11 @@ def rtnorm(a, b, mu=0., sigma=1., size=1, probabilities=False):
         a = (a-mu) / sigma
         b = (b-mu) / sigma
 
-    # Generate the random variables
-    r = array([rtstdnorm(a, b) for x in range(size)])
+    # Generate the random variables - in one batch if we need more than one
+    if size == 1:
+        r = array([rtstdnorm(a, b, random_state)])
+    else:
+        r = rtstdnorm_vector(zeros(size)+a, zeros(size)+b, random_state)
 
     # Scaling
     if not mu == 0. or not sigma == 1.:
@@ -87,11 +93,13 @@ def rtnorm(a, b, mu=0., sigma=1., size=1, probabilities=False):
         return r
 
 
-def rtstdnorm(a, b):
+def rtstdnorm(a, b, random_state=random):
     r"""
     RTNORM    Pseudorandom numbers from a truncated (normalized) Gaussian
     distribution (i.e. rtnorm(a,b,0,1)).
     """
+    rand, randn, randi = random_state.uniform, random_state.normal, random_state.randint
+    
     # Left and right limits
     xmin = -2.00443204036
     xmax = 3.48672170399
@@ -101,7 +109,7 @@ def rtstdnorm(a, b):
         raise Exception('For a truncated ndst in [a,b] b must be greater than a.')    
     # Check if |a| < |b|
     elif abs(a) > abs(b):
-        r = -rtstdnorm(-b, -a)
+        r = -rtstdnorm(-b, -a, random_state)
     # If a in the right tail (a > xmax), use rejection algorithm with
     # a truncated exponential proposal
     elif a > xmax:
@@ -218,6 +226,140 @@ def rtstdnorm(a, b):
     return r
 
 
+def rtstdnorm_vector(a, b, random_state=random):
+    r"""
+    Vectorised version of rtstdnorm: returns an array of pseudorandom numbers
+    from truncated (normalized) Gaussian distributions, where entry n is 
+    truncated to the interval [a[n],b[n]].
+    
+    Each entry uses the same case as rtstdnorm would. Uniforms and box indices 
+    are drawn in bulk for all remaining entries, whole blocks are accepted or
+    rejected at once, and only the rejected positions are redrawn.
+    """
+    (a, b) = broadcast_arrays(array(a, dtype=float), array(b, dtype=float))
+    a, b = a.flatten(), b.flatten()
+    
+    # Check if a < b
+    if (a >= b).any():
+        raise Exception('For a truncated ndst in [a,b] b must be greater than a.')
+    
+    # Make sure |a| < |b| by drawing from [-b,-a] and flipping the sign after
+    flip = abs(a) > abs(b)
+    a[flip], b[flip] = -b[flip], -a[flip]
+    
+    # Compute ka and kb for the entries where we use Chopin's algorithm
+    left, right = (a < XMIN), (a > XMAX)
+    chopin = ~left & ~right
+    ka, kb = zeros(len(a), dtype=int), zeros(len(a), dtype=int)
+    ka[chopin] = ncell[(I0 + floor(a[chopin]*INVH)).astype(int)]
+    kb[chopin] = N
+    inner = chopin & (b < XMAX)
+    kb[inner] = ncell[(I0 + floor(b[inner]*INVH)).astype(int)]
+    
+    # If |b-a| is small, use rejection algorithm with a truncated exponential proposal
+    small = chopin & (abs(kb-ka) < KMIN)
+    boxes = chopin & ~small
+    
+    r = empty(len(a))
+    r[left] = _normal_rejection(a[left], b[left], random_state)
+    r[right | small] = _exponential_rejection(a[right | small], b[right | small], random_state)
+    r[boxes] = _chopin_boxes(a[boxes], b[boxes], ka[boxes], kb[boxes], random_state)
+    r[flip] = -r[flip]
+    return r
+    
+    
+def _normal_rejection(a, b, random_state):
+    # Rejection algorithm with a Gaussian proposal, for a in the left tail
+    r = empty(len(a))
+    todo = arange(len(a))
+    while len(todo) > 0:
+        sim = random_state.normal(size=len(todo))
+        accept = (sim >= a[todo]) & (sim <= b[todo])
+        r[todo[accept]] = sim[accept]
+        todo = todo[~accept]
+    return r
+    
+    
+def _exponential_rejection(a, b, random_state):
+    # Rejection algorithm with a truncated exponential proposal, for a in the
+    # right tail or |b-a| small
+    r = empty(len(a))
+    twoasq = 2*a**2
+    expab = exp(-a*(b-a)) - 1
+    todo = arange(len(a))
+    while len(todo) > 0:
+        z = log(1 + random_state.uniform(low=1E-15, size=len(todo))*expab[todo])
+        e = -log(random_state.uniform(low=1E-15, size=len(todo)))
+        accept = (twoasq[todo]*e > z**2)
+        r[todo[accept]] = a[todo[accept]] - z[accept]/a[todo[accept]]
+        todo = todo[~accept]
+    return r
+    
+    
+def _chopin_boxes(a, b, ka, kb, random_state):
+    # Chopin's algorithm, sampling a box between ka and kb for each entry
+    r = empty(len(a))
+    todo = arange(len(a))
+    while len(todo) > 0:
+        at, bt, kat, kbt = a[todo], b[todo], ka[todo], kb[todo]
+        n = len(todo)
+        
+        # Sample integers between ka and kb (inclusive), and the uniforms
+        k = kat + floor(random_state.uniform(size=n)*(kbt-kat+1)).astype(int)
+        k = minimum(k, kbt)
+        u1, u2 = random_state.uniform(size=n), random_state.uniform(size=n)
+        
+        xk, xk1, yuk = x[k], x[minimum(k+1, N+1)], yu[minimum(k, N)]
+        ylk = where(k <= 1954, yu[k-1], yu[minimum(k+1, N)])
+        ylk[k == N] = YLN
+        
+        accept = zeros(n, dtype=bool)
+        sim = empty(n)
+        
+        with errstate(divide='ignore', invalid='ignore'):
+            # Right tail
+            tail = (k == N)
+            lbound = x[-1]
+            z = -log(u1[tail]) / lbound
+            e = -log(u2[tail])
+            accept[tail] = (z**2 <= 2*e) & (z < bt[tail]-lbound)
+            sim[tail] = lbound + z
+            
+            # Two leftmost and rightmost regions
+            edge = ~tail & ((k <= kat+2) | ((k >= kbt) & (bt < XMAX)))
+            ylk_edge = where(k[edge] == 0, YL0, ylk[edge])
+            sim[edge] = xk[edge] + (xk1[edge]-xk[edge]) * u1[edge]
+            simy = yuk[edge] * u2[edge]
+            accept[edge] = (sim[edge] >= at[edge]) & (sim[edge] <= bt[edge]) & \
+                ((simy < ylk_edge) | (sim[edge]**2 + 2*log(simy) + ALPHA < 0))
+                
+            # All the other boxes
+            other = ~tail & ~edge
+            ylk_other = where(k[other] == 1, YL0, ylk[other])
+            d = xk1[other] - xk[other]
+            simy = yuk[other] * u1[other]
+            below = simy < ylk_other    # That's what happens most of the time 
+            sim_other = where(below, xk[other] + u1[other]*d*yuk[other]/ylk_other, xk[other] + d*u2[other])
+            accept[other] = below | (sim_other**2 + 2*log(simy) + ALPHA < 0)
+            sim[other] = sim_other
+        
+        r[todo[accept]] = sim[accept]
+        todo = todo[~accept]
+    return r
+
+
+# Design variables for Chopin's algorithm (see rtstdnorm)
+XMIN = -2.00443204036           # Left limit
+XMAX = 3.48672170399            # Right limit
+KMIN = 5                        # if kb-ka < kmin then use a rejection algorithm
+INVH = 1631.73284006            # 1/h, h being the minimal interval range
+I0 = 3271                       # = - floor(x(1)/h)
+ALPHA = 1.837877066409345       # = log(2*pi)
+N = 4000                        # Index of the right tail
+YL0 = 0.053513975472            # y_l of the leftmost rectangle
+YLN = 0.000914116389555         # y_l of the rightmost rectangle
+
+
         # Tables
 x = array([
     -2.00443204036, -1.99990455547, -1.99541747213, -1.99096998962, \
@@ -8,6 +8,9 @@ truncnorm: a, b = (myclip_a - my_mean) / my_std, (myclip_b - my_mean) / my_std
 We get efficient draws using the library rtnorm by C. Lassner, from:
     http://miv.u-strasbg.fr/mazet/rtnorm/
 This gives more efficient single draws than scipy.stats.truncnorm.    
+
+The draws take an optional random_state (a numpy.random.RandomState), and use
+numpy's global random state if it is not given.
     
 We compute the expectation and variance ourselves - note that we use the
 complementary error function for 1-cdf(x) = 0.5*erfc(x/sqrt(2)), as for large
@@ -34,11 +37,11 @@ import rtnorm
 
 
 # TN draws     
-def TN_draw(mu,tau):
+def TN_draw(mu,tau,random_state=numpy.random):
     sigma = numpy.float64(1.0) / math.sqrt(tau)
     if tau == 0.:
         return 0.
-    d = rtnorm.rtnorm(a=0., b=numpy.inf, mu=mu, sigma=sigma)[0]
+    d = rtnorm.rtnorm(a=0., b=numpy.inf, mu=mu, sigma=sigma, random_state=random_state)[0]
     #a,b = -mu/sigma, numpy.inf
     #d = truncnorm(a, b, loc=mu, scale=sigma).rvs(1)[0]
     return d if (d >= 0. and d != numpy.inf and d != -numpy.inf and not numpy.isnan(d)) else 0.
@@ -8,93 +8,122 @@ for multiple independent variables - i.e. mu and tau are vectors.
 truncnorm: a, b = (myclip_a - my_mean) / my_std, (myclip_b - my_mean) / my_std
            loc, scale = mu, sigma
            
-We get efficient draws using the library rtnorm by C. Lassner, from:
-    http://miv.u-strasbg.fr/mazet/rtnorm/
-We compute the expectation and variance ourselves - note that we use the
-complementary error function for 1-cdf(x) = 0.5*erfc(x/sqrt(2)), as for large
-x (>8), cdf(x)=1., so we get 0. instead of something like n*e^-n.
+We draw all values at once, using inverse-CDF sampling when -mu/sigma is below
+TAIL_THRESHOLD, and rejection sampling with an exponential proposal (Robert, 
+1995) in the right tail, where the inverse-CDF loses accuracy.
 
-As mu gets lower (negative), and tau higher, we get draws and expectations that
-are closer to an exponential distribution with scale parameter mu * tau.
+We compute the expectation and variance ourselves, in one pass using 
+TN_vector_moments. Computing the inverse Mills ratio as pdf(x)/(0.5*erfc(x/sqrt(2)))
+fails for large x (about 38, i.e. mu < -38 * std) as both terms underflow, 
+which previously meant switching to the mean and variance of an exponential 
+when mu < -30 * std. Instead we use the scaled complementary error function
+erfcx(x) = exp(x^2)*erfc(x), giving lambda(x) = sqrt(2/pi) / erfcx(x/sqrt(2)).
+As mu gets lower (negative), and tau higher, the moments then smoothly approach
+those of an exponential distribution with scale parameter mu * tau.
 
-The draws in this case work effectively, but computing the mean and variance
-fails due to numerical errors. As a result, the mean and variance go to 0 after
-a certain point.
-This point is: -38 * std.
+For x > ASYMPTOTIC_THRESHOLD the expectation mu + sigma*lambda(x) and variance 
+sigma^2*(1 - lambda(x)*(lambda(x)-x)) subtract two nearly equal numbers, losing
+most of their precision (the variance becomes exactly 0 around x = 1e4). There 
+we use the asymptotic series in 1/x instead:
+    lambda(x) - x                   = 1/x - 2/x^3 + 10/x^5 - 74/x^7 + 706/x^9 - ...
+    1 - lambda(x)*(lambda(x)-x)     = 1/x^2 - 6/x^4 + 50/x^6 - 518/x^8 + 6354/x^10 - ...
+whose truncation error at x = 50 is below 1e-12 relative.
 
-This means that we need to use the mean and variance of an exponential when
-|mu| gets close to 38*std.
-Therefore we use it when |mu| < 30*std.
+The draws take an optional random_state (a numpy.random.RandomState), and use
+numpy's global random state if it is not given.
 """
 import math, numpy, time
 import matplotlib.pyplot as plt
 from scipy.stats import truncnorm, norm
-from scipy.special import erfc
-import rtnorm
+from scipy.special import erfc, erfcx, ndtri
+
+# Same boundary as the right tail in rtnorm (xmax)
+TAIL_THRESHOLD = 3.48672170399
+
+# Above this x = -mu/sigma we use the asymptotic series for the moments
+ASYMPTOTIC_THRESHOLD = 50.
 
 
 # TN draws
-def TN_vector_draw(mus,taus):
-    sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
-    draws = []
-    for (mu,sigma,tau) in zip(mus,sigmas,taus):
-        if tau == 0.:
-            draws.append(0)
-        else:
-            d = rtnorm.rtnorm(a=0., b=numpy.inf, mu=mu, sigma=sigma)[0]
-            d = d if (d >= 0. and d != numpy.inf and d != -numpy.inf and not numpy.isnan(d)) else 0.
-            draws.append(d)   
-    '''
-    draws = parallel_draw(self.mu,self.sigma,self.tau)
-    '''     
-    return draws           
+def TN_vector_draw(mus,taus,random_state=numpy.random):
+    mus, taus = numpy.array(mus,dtype=float), numpy.array(taus,dtype=float)
+    draws = numpy.zeros(mus.shape)
+    
+    # Entries with tau = 0 or non-finite parameters are set to 0, as before
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
+        a = - mus / sigmas
+        valid = (taus != 0.) & numpy.isfinite(mus) & ~numpy.isnan(taus) & ~numpy.isnan(a) & (a != numpy.inf)
+    
+        # Standardised lower bound a = -mu/sigma; use inverse-CDF sampling below 
+        # the tail threshold, and exponential-proposal rejection above it
+        tail = valid & (a > TAIL_THRESHOLD)
+        safe = valid & ~tail
+    
+    z = numpy.zeros(mus.shape)
+    z[safe] = TN_standard_draw_inverse_cdf(a[safe],random_state)
+    z[tail] = TN_standard_draw_tail(a[tail],random_state)
+    
+    with numpy.errstate(invalid='ignore'):
+        draws[valid] = mus[valid] + sigmas[valid] * z[valid]
+        draws[~(numpy.isfinite(draws) & (draws >= 0.))] = 0.
+    return draws
+    
+# Inverse-CDF draws from N(0,1) truncated to [a,inf). We compute the upper tail
+# mass 1-cdf(a) = 0.5*erfcx(a/sqrt(2))*exp(-a^2/2) for a > 0, and invert 
+# u*(1-cdf(a)). For a <= 0 the mass is in [0.5,1] and erfc is accurate.
+def TN_standard_draw_inverse_cdf(a,random_state=numpy.random):
+    u = random_state.rand(len(a))
+    positive = a > 0.
+    tail_mass = 0.5 * erfc(a/math.sqrt(2))
+    tail_mass[positive] = 0.5 * erfcx(a[positive]/math.sqrt(2)) * numpy.exp(-a[positive]**2/2.)
+    z = - ndtri(u * tail_mass)
+    return numpy.maximum(z,a)
+    
+# Rejection sampling for N(0,1) truncated to [a,inf) with a in the right tail,
+# using the optimal exponential proposal of Robert (1995). We draw all values
+# at once, and redraw only the rejected positions.
+def TN_standard_draw_tail(a,random_state=numpy.random):
+    rate = ( a + numpy.sqrt(a**2 + 4.) ) / 2.
+    z = numpy.empty(len(a))
+    todo = numpy.arange(len(a))
+    while len(todo) > 0:
+        proposal = a[todo] + random_state.exponential(size=len(todo)) / rate[todo]
+        accept = random_state.rand(len(todo)) <= numpy.exp( -(proposal - rate[todo])**2 / 2. )
+        z[todo[accept]] = proposal[accept]
+        todo = todo[~accept]
+    return z
+       
+# TN expectation and variance, computed in one pass. The inverse Mills ratio
+# lambda(x) = pdf(x)/(1-cdf(x)) = sqrt(2/pi)/erfcx(x/sqrt(2)) does not underflow,
+# and for x > ASYMPTOTIC_THRESHOLD we use the asymptotic series to avoid cancellation.
+def TN_vector_moments(mus,taus):
+    mus, taus = numpy.float64(mus), numpy.float64(taus)
+    with numpy.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
+        x = - mus / sigmas
+        lambdax = math.sqrt(2./math.pi) / erfcx(x/math.sqrt(2))
+        exp = mus + sigmas * lambdax
+        var = sigmas**2 * ( 1 - lambdax*(lambdax-x) )
+        
+        t = 1. / x**2
+        asymptotic = x > ASYMPTOTIC_THRESHOLD
+        exp = numpy.where(asymptotic, sigmas / x * (1 + t*(-2 + t*(10 + t*(-74 + t*(706 - t*8162))))), exp)
+        var = numpy.where(asymptotic, sigmas**2 * t * (1 + t*(-6 + t*(50 + t*(-518 + t*6354)))), var)
+        
+        exp = numpy.where(numpy.isfinite(exp) & (exp >= 0.0), exp, 0.)
+        var = numpy.where(numpy.isfinite(var) & (var >= 0.0), var, 0.)
+    return (exp,var)
        
 # TN expectation    
 def TN_vector_expectation(mus,taus):
-    sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
-    x = - numpy.float64(mus) / sigmas
-    lambdax = norm.pdf(x)/(0.5*erfc(x/math.sqrt(2)))
-    exp = mus + sigmas * lambdax
-    
-    # Exp expectation - overwrite value if mu < -30*sigma
-    exp = [1./(numpy.abs(mu)*tau) if mu < -30 * sigma else v for v,mu,tau,sigma in zip(exp,mus,taus,sigmas)]
-    return [v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0. for v in exp]
+    return TN_vector_moments(mus,taus)[0]
     
 # TN variance
 def TN_vector_variance(mus,taus):
-    sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
-    x = - numpy.float64(mus) / sigmas
-    lambdax = norm.pdf(x)/(0.5*erfc(x/math.sqrt(2)))
-    deltax = lambdax*(lambdax-x)
-    var = sigmas**2 * ( 1 - deltax )
-    
-    # Exp variance - overwrite value if mu < -30*sigma
-    var = [(1./(numpy.abs(mu)*tau))**2 if mu < -30 * sigma else v for v,mu,tau,sigma in zip(var,mus,taus,sigmas)]
-    return [v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0. for v in var]      
+    return TN_vector_moments(mus,taus)[1]
        
 # TN mode
 def TN_vector_mode(mus):
     zeros = numpy.zeros(len(mus))
-    return numpy.maximum(zeros,mus)   
-       
-
-""" Methods for parallel draws """
-'''
-from joblib import Parallel, delayed
-import itertools
-import multiprocessing
-
-def draw(mu,sigma,tau):
-    if tau == 0.:
-        return 0
-    else:
-        d = rtnorm.rtnorm(a=0., b=numpy.inf, mu=mu, sigma=sigma)[0]
-        d = d if (d >= 0. and d != numpy.inf and d != -numpy.inf and not numpy.isnan(d)) else 0.
-        return d
-        
-def parallel_draw(mus,sigmas,taus):
-    draws = Parallel(n_jobs=-1)( #-1 = no. of machine cores
-        delayed(draw)(mu,sigma,tau) for (mu,sigma,tau) in itertools.izip(mus,sigmas,taus)
-    )
-    return draws
-'''
\ No newline at end of file
+    return numpy.maximum(zeros,mus)
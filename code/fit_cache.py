@@ -0,0 +1,119 @@
+"""
+Class for an on-disk cache of model fits, so that the model selection (see
+grid_search) and the cross-validation can reuse fits from previous runs rather
+than training them again, e.g. when we rerun a search script after changing a
+plot.
+
+Each fit is identified by a key: the SHA-1 of the JSON of the hashes of the
+dataset R and mask M (their shape, type and values), and the settings of the fit
+(the classifier, K, L, priors, initialisation, seed, iterations, and the
+arguments for run and quality). Arrays in the settings are replaced by their
+hash. For each key we store two files in the folder:
+- <key>.npz, with the final factor moments of the model: the expectations and
+    variances for VB (expU, varU, ..., exptau), the final values for ICM (U, V,
+    ..., tau), and for Gibbs the final draws as well as the expectations over
+    the draws (expU, ..., exptau) if we are given a burn-in and thinning.
+- <key>.json, with the record of the fit:
+    { 'qualities' : {<metric> : <value>}, 'performances' : <all_performances>,
+      'iterations' : <all_iterations>, 'predictions' : {<hash of test mask> : <performances on the test set>} }
+Both are written to a temporary file first and then renamed, so a crash cannot
+leave a partial fit in the cache. The .json file is written last, so a fit is
+only in the cache once both are.
+
+Fits are only reproducible if they are seeded, so the drivers only use the cache
+for fits with an integer seed (see code/random_state.py). The arrays are hashed
+once per object, so they should not be changed in place while the cache is used.
+
+Usage:
+    cache = FitCache('fits')
+    key = cache.key(R,M,classifier=bnmf_vb_optimised,K=K,priors=priors,init='random',seed=seed,iterations=1000)
+    cache.get(key)                              -> record, or None if we have not seen the fit
+    cache.add(key,model,qualities,predictions)  -> store the fit
+    cache.moments(key)                          -> { name : array } of the factor moments
+"""
+
+import numpy, json, hashlib, os, tempfile
+
+moment_names = ['expU','varU','expV','varV','expF','varF','expS','varS','expG','varG','exptau','vartau','U','V','F','S','G','tau']
+
+class FitCache:
+    def __init__(self,folder):
+        self.folder = folder
+        self.hashes = {}    # Map from id of an array to (array,hash), so we hash each array once
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    # Do not send the hashes to other processes
+    def __getstate__(self):
+        return { 'folder' : self.folder, 'hashes' : {} }
+
+
+    # Return the hash identifying an array: the SHA-1 of its shape, type and values
+    def hash_array(self,A):
+        if id(A) not in self.hashes:
+            A_contiguous = numpy.ascontiguousarray(A)
+            digest = hashlib.sha1("%s %s " % (A_contiguous.shape,A_contiguous.dtype.str))
+            digest.update(A_contiguous.data)
+            self.hashes[id(A)] = (A,digest.hexdigest())
+        return self.hashes[id(A)][1]
+
+    # Return the value in a form we can store as JSON: the hash of arrays, the name of
+    # classes, and the Python value of numpy scalars
+    def JSON_value(self,value):
+        if isinstance(value,numpy.ndarray):
+            return self.hash_array(value)
+        if isinstance(value,numpy.generic):
+            return value.item()
+        if hasattr(value,'__name__'):
+            return value.__name__
+        raise TypeError("Cannot store %s in the fit cache." % repr(value))
+
+    # Return the key of the fit of a model with the given settings to R and M
+    def key(self,R,M,**settings):
+        description = { 'R' : self.hash_array(R), 'M' : self.hash_array(M), 'settings' : settings }
+        return hashlib.sha1(json.dumps(description,sort_keys=True,default=self.JSON_value)).hexdigest()
+
+
+    # Return the record of the fit with the given key, or None if it is not in the cache
+    def get(self,key):
+        filename = os.path.join(self.folder,key+'.json')
+        if not os.path.exists(filename):
+            return None
+        with open(filename,'r') as fin:
+            return json.load(fin,object_hook=lambda record: { str(name) : value for (name,value) in record.items() })
+
+    # Return the factor moments of the fit with the given key, as a dictionary from name to array
+    def moments(self,key):
+        with numpy.load(os.path.join(self.folder,key+'.npz')) as data:
+            return { name : data[name] for name in data.files }
+
+    # Add the fit of the model with the given key, its qualities for each metric, and
+    # optionally its performances on a test set (a map from the hash of the test mask
+    # to the performances), which are added to the ones we already have for the key
+    def add(self,key,model,qualities,predictions={},quality_args={}):
+        moments = { name : getattr(model,name) for name in moment_names if getattr(model,name,None) is not None }
+        if quality_args and hasattr(model,'approx_expectation'):
+            expectations = model.approx_expectation(**quality_args)
+            names = ['expU','expV','exptau'] if len(expectations) == 3 else ['expF','expS','expG','exptau']
+            moments.update(zip(names,expectations))
+
+        previous = self.get(key)
+        record = {
+            'qualities' : qualities,
+            'performances' : getattr(model,'all_performances',{}),
+            'iterations' : getattr(model,'all_iterations',[]),
+            'predictions' : dict(previous['predictions'] if previous is not None else {},**predictions)
+        }
+        self.write(key+'.npz',lambda fout: numpy.savez(fout,**moments))
+        self.write(key+'.json',lambda fout: fout.write(json.dumps(record,sort_keys=True,default=self.JSON_value)))
+
+    # Write a file in the folder using write(fout), to a temporary file that we then rename
+    def write(self,filename,write):
+        (fd,temporary) = tempfile.mkstemp(dir=self.folder,suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as fout:
+                write(fout)
+            os.rename(temporary,os.path.join(self.folder,filename))
+        except:
+            os.remove(temporary)
+            raise
@@ -0,0 +1,78 @@
+"""
+Class for monitoring the performance of the inference methods while they run.
+
+By default the methods evaluate the MSE, R^2 and Rp on the training data after
+every iteration (plus the ELBO for VB, and the I-divergence for the
+non-probabilistic methods), and print them. Passing a Monitor to run() lets us
+change this, with the following optional arguments:
+- interval (default 1). Only evaluate the model every <interval> iterations, and
+    after the last one.
+- metrics (default None, meaning all the metrics of the model). Which metrics to
+    compute, out of 'MSE', 'R^2', 'Rp', 'ELBO' (VB only), 'I-divergence' (NP only).
+- callback (default None). A function called as callback(iteration,performances)
+    each time we evaluate the model, with performances a dictionary from metric to value.
+- silent (default False). If True, we do not print anything.
+
+The performances are stored in model.all_performances, a dictionary from metric
+to a list of values, and the iterations at which they were computed in
+model.all_iterations. If a stopping criterion is given (see stopping_criterion.py),
+it is checked each time we evaluate the model.
+
+Usage:
+    monitor = Monitor(interval=10,metrics=['MSE'],silent=True)
+    BNMF.run(iterations=1000,monitor=monitor)
+"""
+
+prediction_metrics = ['MSE','R^2','Rp']
+
+class Monitor:
+    def __init__(self,interval=1,metrics=None,callback=None,silent=False):
+        assert interval >= 1, "Evaluation interval should be at least 1, but is %s." % interval
+        self.interval = interval
+        self.requested_metrics = metrics
+        self.callback = callback
+        self.silent = silent
+
+
+    # Set the metrics we compute, given the ones this model can provide
+    def initialise(self,model_metrics):
+        if self.requested_metrics is None:
+            self.metrics = list(model_metrics)
+        else:
+            for metric in self.requested_metrics:
+                assert metric in model_metrics, "Metric %s is not available for this model. Should be one of %s." % (metric,model_metrics)
+            self.metrics = list(self.requested_metrics)
+
+
+    # Return True if we should evaluate the model after iteration <iteration> (counting from 0)
+    def evaluate(self,iteration,iterations):
+        return (iteration+1) % self.interval == 0 or iteration+1 == iterations
+
+
+    # Compute the performances. <predictions> is a function returning (M,R,R_pred) for the
+    # training data, which we only call if we need one of MSE, R^2, Rp, and <other_metrics>
+    # is a dictionary from the other metrics to functions computing them.
+    def performances(self,model,predictions,other_metrics={}):
+        performances = {}
+        if any([metric in self.metrics for metric in prediction_metrics]):
+            (M,R,R_pred) = predictions()
+            compute = { 'MSE' : model.compute_MSE, 'R^2' : model.compute_R2, 'Rp' : model.compute_Rp }
+            for metric in prediction_metrics:
+                if metric in self.metrics:
+                    performances[metric] = compute[metric](M,R,R_pred)
+        for metric,function in other_metrics.items():
+            if metric in self.metrics:
+                performances[metric] = function()
+        return performances
+
+
+    # Store the performances in the model, print them, and pass them to the callback
+    def record(self,model,iteration,performances):
+        model.all_iterations.append(iteration)
+        for metric in self.metrics:
+            model.all_performances[metric].append(performances[metric])
+
+        if not self.silent:
+            print "Iteration %s. %s" % (iteration," ".join(["%s: %s." % (metric,performances[metric]) for metric in self.metrics]))
+        if self.callback is not None:
+            self.callback(iteration,performances)
@@ -7,11 +7,26 @@ We expect the following arguments:
 - K, the number of latent factors
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
     a dictionary defining the priors over tau, U, V.
+- sparse, optional (default False). If True, we store only the observed entries
+    (see observed_entries.py) and compute all updates over those entries, 
+    rather than multiplying by the dense mask M. Useful when few entries are observed.
+    R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+    copies of them, so the memory scales with the number of observed entries.
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the 
+    updates, e.g. numpy.float32 to halve the memory they need. The sums for tau are done in float64.
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
 - init='exp'    -> use the expectation of the priors Exp, Gamma
 Alternatively, you can define your own initial values for U, V, and tau.
+Or we can warm start from the fit <model> of the same model with fewer factors,
+using initialise_warm(model,warm_start,seed), with warm_start='split' or 'prior'
+(see warm_start.py): we copy its U and V, and add the new columns by splitting 
+its columns with the highest variance, or by drawing them from the priors.
+
+The random initialisation uses the random state of the seed given to 
+initialise(...,seed) (see random_state.py): None for numpy's global random state, 
+an int, or a numpy.random.RandomState.
 
 Usage of class:
     NMF = nmf_icm(R,M,K,priors)
@@ -28,6 +43,10 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in NMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+We can choose which performances are computed and printed, and how often, by passing
+a Monitor (see monitor.py) to run(iterations,monitor=monitor).
+run(iterations,resume=True) continues from the current values rather than from the
+initialisation, appending to all_tau, all_performances, all_iterations and all_times.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -37,17 +56,24 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 (we want to maximise these values)
 """
 
-from distributions.exponential import exponential_draw
+from distributions.exponential import exponential_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
+from warm_start import split_sources, extend_columns, copy_columns
 from distributions.gamma import gamma_mode
 from distributions.truncated_normal_vector import TN_vector_mode
 
 import numpy, itertools, math, time
 
 class nmf_icm:
-    def __init__(self,R,M,K,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,priors,sparse=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
@@ -55,17 +81,19 @@ class nmf_icm:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
+        self.size_Omega = float(self.omega.size) if self.sparse else self.M.sum(dtype=numpy.float64)
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaU, self.lambdaV = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU']), numpy.array(priors['lambdaV'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU'],dtype=dtype), numpy.array(priors['lambdaV'],dtype=dtype)
         
         # If lambdaU or lambdaV are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaU.shape == ():
-            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
+            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K),dtype=dtype)
         if self.lambdaV.shape == ():
-            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
+            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K),dtype=dtype)
         
         assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
         assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
@@ -73,8 +101,7 @@ class nmf_icm:
         
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -84,43 +111,56 @@ class nmf_icm:
 
 
     # Initialise and run the sampler
-    def train(self,init,iterations):
-        self.initialise(init=init)
+    def train(self,init,iterations,seed=None):
+        self.initialise(init=init,seed=seed)
         return self.run(iterations)
 
 
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
-    def initialise(self,init='random'):
+    def initialise(self,init='random',seed=None):
+        self.random_state = random_state(seed)
         assert init in ['random','exp'], "Unknown initialisation option: %s. Should be 'random' or 'exp'." % init
-        self.U = numpy.zeros((self.I,self.K))
-        self.V = numpy.zeros((self.J,self.K))
-        
         if init == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = exponential_draw(self.lambdaU[i][k])
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = exponential_draw(self.lambdaV[j][k])
+            self.U = exponential_vector_draw(self.lambdaU,self.random_state).astype(self.dtype)
+            self.V = exponential_vector_draw(self.lambdaV,self.random_state).astype(self.dtype)
             
         elif init == 'exp':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = 1.0/self.lambdaU[i][k]
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = 1.0/self.lambdaV[j][k]
+            self.U = 1.0/self.lambdaU
+            self.V = 1.0/self.lambdaV
         
         self.tau = gamma_mode(self.alpha_s(), self.beta_s())
        
 
+    # Initialise U, V, and tau from the fit <model> of this model with fewer factors (see warm_start.py)
+    def initialise_warm(self,model,warm_start='split',seed=None):
+        self.random_state = random_state(seed)
+        sources = split_sources(model.U,self.K,warm_start)
+        self.U = extend_columns(model.U,sources,exponential_vector_draw(self.lambdaU,self.random_state),self.random_state).astype(self.dtype)
+        self.V = copy_columns(model.V,sources,exponential_vector_draw(self.lambdaV,self.random_state)).astype(self.dtype)
+        
+        self.tau = gamma_mode(self.alpha_s(), self.beta_s())
+        
+
     # Run the Gibbs sampler
-    def run(self,iterations,minimum_TN=0.):   
-        self.all_tau = numpy.zeros(iterations) # to plot convergence
-        self.all_times = [] # to plot performance against time
+    def run(self,iterations,minimum_TN=0.,stopping_criterion=None,monitor=None,resume=False):
+        start = len(self.all_tau) if resume else 0 # iterations of the previous runs
+        self.all_tau = numpy.concatenate((self.all_tau,numpy.zeros(iterations))) if resume else numpy.zeros(iterations) # to plot convergence
+        if not resume:
+            self.all_times = [] # to plot performance against time
         
-        metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['MSE','R^2','Rp'])
+        if not resume:
+            self.all_iterations = [] # iterations at which we computed the performances
+            self.all_performances = {} # for plotting convergence of metrics
+        for metric in monitor.metrics:
+            self.all_performances.setdefault(metric,[])
         
-        time_start = time.time()
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
+        time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
         for it in range(0,iterations):      
             for k in range(0,self.K):   
                 tauUk = self.tauU(k)
@@ -135,17 +175,21 @@ class nmf_icm:
                 self.V[:,k] = numpy.maximum(self.V[:,k],minimum_TN*numpy.ones(self.J))
                 
             self.tau = gamma_mode(self.alpha_s(),self.beta_s())
-            self.all_tau[it] = self.tau
+            self.all_tau[start+it] = self.tau
             
-            perf = self.predict(self.M)
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            evaluate = monitor.evaluate(it,iterations)
+            if evaluate:
+                perf = monitor.performances(self,self.training_predictions)
+                monitor.record(self,start+it+1,perf)
             
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)            
             
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(dict(perf,tau=self.tau)):
+                self.stop_reason = stopping_criterion.reason
+                self.all_tau = self.all_tau[:start+it+1]
+                break
+            
         return
         
         
@@ -154,27 +198,68 @@ class nmf_icm:
         return self.alpha + self.size_Omega/2.0
     
     def beta_s(self):   
-        return self.beta + 0.5*(self.M*(self.R-numpy.dot(self.U,self.V.T))**2).sum()
+        if self.sparse:
+            return self.beta + 0.5*((self.omega.values-self.omega.dot(self.U,self.V))**2).sum(dtype=numpy.float64)
+        residual = self.workspace.residual('residual',self.R,self.U,self.V.T)
+        residual **= 2
+        residual *= self.M
+        return self.beta + 0.5*residual.sum(dtype=numpy.float64)
         
     def tauU(self,k):       
-        return self.tau*(self.M*self.V[:,k]**2).sum(axis=1)
+        if self.sparse:
+            return self.tau*self.omega.row_sums(self.V[self.omega.columns,k]**2)
+        return self.tau*self.workspace.multiply('work',self.M,self.V[:,k]**2).sum(axis=1)
         
     def muU(self,tauUk,k):
-        return 1./tauUk * (-self.lambdaU[:,k] + self.tau*(self.M * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k]))*self.V[:,k] )).sum(axis=1)) 
+        if self.sparse:
+            (rows,columns) = (self.omega.rows,self.omega.columns)
+            residual = self.omega.values-self.omega.dot(self.U,self.V)+self.U[rows,k]*self.V[columns,k]
+            return 1./tauUk * (-self.lambdaU[:,k] + self.tau*self.omega.row_sums(residual*self.V[columns,k]))
+        residual = self.residual_k(k)
+        residual *= self.V[:,k]
+        residual *= self.M
+        return 1./tauUk * (-self.lambdaU[:,k] + self.tau*residual.sum(axis=1)) 
         
     def tauV(self,k):
-        return self.tau*(self.M.T*self.U[:,k]**2).T.sum(axis=0)
+        if self.sparse:
+            return self.tau*self.omega.column_sums(self.U[self.omega.rows,k]**2)
+        return self.tau*self.workspace.multiply('work',self.M,(self.U[:,k]**2)[:,None]).sum(axis=0)
         
     def muV(self,tauVk,k):
-        return 1./tauVk * (-self.lambdaV[:,k] + self.tau*(self.M.T * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k])).T*self.U[:,k] )).T.sum(axis=0)) 
+        if self.sparse:
+            (rows,columns) = (self.omega.rows,self.omega.columns)
+            residual = self.omega.values-self.omega.dot(self.U,self.V)+self.U[rows,k]*self.V[columns,k]
+            return 1./tauVk * (-self.lambdaV[:,k] + self.tau*self.omega.column_sums(residual*self.U[rows,k]))
+        residual = self.residual_k(k)
+        residual *= self.U[:,k][:,None]
+        residual *= self.M
+        return 1./tauVk * (-self.lambdaV[:,k] + self.tau*residual.sum(axis=0)) 
+        
+    # Compute R - U V^T + outer(U_.k,V_.k) in the workspace, for the updates of column k
+    def residual_k(self,k):
+        residual = self.workspace.residual('residual',self.R,self.U,self.V.T)
+        residual += self.workspace.outer('work',self.U[:,k],self.V[:,k])
+        return residual
 
 
+    # Return (M,R,R_pred) for the training data, to monitor the performance while running
+    def training_predictions(self):
+        if self.sparse:
+            return (numpy.ones(self.omega.size),self.omega.values,self.omega.dot(self.U,self.V))
+        return (self.M,self.R,numpy.dot(self.U,self.V.T))
+        
+        
     # Compute the expectation of U and V, and use it to predict missing values
     def predict(self,M_pred):
-        R_pred = numpy.dot(self.U,self.V.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(self.U,self.V))
+        else:
+            (R,R_pred) = (self.R,numpy.dot(self.U,self.V.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
         
@@ -211,10 +296,15 @@ class nmf_icm:
             # -2*loglikelihood + 2*no. free parameters
             return - 2 * log_likelihood + 2 * (self.I*self.K+self.J*self.K)
         elif metric == 'MSE':
+            if self.sparse:
+                return ((self.omega.values-self.omega.dot(self.U,self.V))**2).sum() / float(self.size_Omega)
             R_pred = numpy.dot(self.U,self.V.T)
             return self.compute_MSE(self.M,self.R,R_pred)
         
     def log_likelihood(self):
         # Return the likelihood of the data given the trained model's parameters
+        if self.sparse:
+            return self.size_Omega / 2. * ( math.log(self.tau) - math.log(2*math.pi) ) \
+                 - self.tau / 2. * ((self.omega.values-self.omega.dot(self.U,self.V))**2).sum()
         return self.size_Omega / 2. * ( math.log(self.tau) - math.log(2*math.pi) ) \
              - self.tau / 2. * (self.M*( self.R - numpy.dot(self.U,self.V.T))**2).sum()
\ No newline at end of file
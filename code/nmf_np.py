@@ -18,22 +18,42 @@ We expect the following arguments:
 - R, the matrix
 - M, the mask matrix indicating observed values (1) and unobserved ones (0)
 - K, the number of latent factors
+- sparse, optional (default False). If True, we store only the observed entries
+  (see observed_entries.py) and compute the updates over those entries only.
+  R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+  copies of them, so the memory scales with the number of observed entries.
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the
+  updates, e.g. numpy.float32 to halve the memory they need. The I-divergence is summed in float64.
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init_UV = 'ones'          -> U[i,k] = V[j,k] = 1
           = 'random'        -> U[i,k] ~ U(0,1), V[j,k] ~ U(0,1), 
           = 'exponential'   -> U[i,k] ~ Exp(expo_prior), V[j,k] ~ Exp(expo_prior) 
   where expo_prior is an additional parameter (default 1)
+
+The random initialisation uses the random state of the seed given to 
+initialise(...,seed) (see random_state.py): None for numpy's global random state, 
+an int, or a numpy.random.RandomState.
+
+The performances (I-divergence, MSE, R^2, Rp on the training data) are stored in 
+all_performances each iteration. We can choose which are computed and printed, 
+and how often, by passing a Monitor (see monitor.py) to run(iterations,monitor=monitor).
 """
 
-from distributions.exponential import exponential_draw
-import numpy, math, itertools, time
+from distributions.exponential import exponential_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
+import numpy, math, time
 
 class NMF:
-    def __init__(self,R,M,K):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,sparse=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K                     
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
         
         self.metrics = ['MSE','R^2','Rp']
                 
@@ -44,18 +64,19 @@ class NMF:
             
         (self.I,self.J) = self.R.shape
         
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
         self.check_empty_rows_columns() 
         
-        # For computing the I-div it is better if unknown values are 1's, not 0's
-        self.R_excl_unknown = numpy.empty((self.I,self.J))
-        for i,j in itertools.product(range(0,self.I),range(0,self.J)):
-            self.R_excl_unknown[i,j] = self.R[i,j] if self.M[i,j] else 1.
+        # For computing the I-div it is better if unknown values are 1's, not 0's (in sparse mode 
+        # we only use the observed entries)
+        if not self.sparse:
+            self.R_excl_unknown = numpy.where(self.M != 0, self.R, 1.).astype(dtype)
                  
                  
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -65,32 +86,37 @@ class NMF:
 
 
     """ Initialise U and V """    
-    def initialise(self,init_UV='random',expo_prior=1.):
+    def initialise(self,init_UV='random',expo_prior=1.,seed=None):
+        self.random_state = random_state(seed)
         assert init_UV in ['ones','random','exponential'], "Unrecognised init option for U,V: %s." % init_UV
         if init_UV == 'ones':
-            self.U = numpy.ones((self.I,self.K))
-            self.V = numpy.ones((self.J,self.K))
+            self.U = numpy.ones((self.I,self.K),dtype=self.dtype)
+            self.V = numpy.ones((self.J,self.K),dtype=self.dtype)
         elif init_UV == 'random':
-            self.U = numpy.random.rand(self.I,self.K)
-            self.V = numpy.random.rand(self.J,self.K)
+            self.U = self.random_state.rand(self.I,self.K).astype(self.dtype)
+            self.V = self.random_state.rand(self.J,self.K).astype(self.dtype)
         elif init_UV == 'exponential':
-            self.U = numpy.empty((self.I,self.K))
-            self.V = numpy.empty((self.J,self.K))
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.U[i,k] = exponential_draw(expo_prior)
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = exponential_draw(expo_prior)
+            self.U = exponential_vector_draw(expo_prior*numpy.ones((self.I,self.K)),self.random_state).astype(self.dtype)
+            self.V = exponential_vector_draw(expo_prior*numpy.ones((self.J,self.K)),self.random_state).astype(self.dtype)
     
     
     """ Update U and V for a number of iterations, printing the MSE and divergence each iteration. """
-    def run(self,iterations):
+    def run(self,iterations,stopping_criterion=None,monitor=None):
         assert hasattr(self,'U') and hasattr(self,'V'), "U and V have not been initialised - please run NMF.initialise() first."        
         
         self.all_times = [] # to plot performance against time
+        
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['I-divergence']+self.metrics)
+        self.all_iterations = [] # iterations at which we computed the performances
         self.all_performances = {} # for plotting convergence of metrics
-        for metric in self.metrics:
+        for metric in monitor.metrics:
             self.all_performances[metric] = []
             
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
         time_start = time.time()
         for it in range(1,iterations+1):
             for k in range(0,self.K):
@@ -98,32 +124,66 @@ class NMF:
             for k in range(0,self.K):
                 self.update_V(k)
             
-            self.give_update(it)
+            evaluate = monitor.evaluate(it-1,iterations)
+            if evaluate:
+                perf = self.give_update(it,monitor)
             
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)   
+            
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(perf):
+                self.stop_reason = stopping_criterion.reason
+                break
         
         
     """ Method for doing both initialise() and run() """
-    def train(self,iterations,init_UV='random',expo_prior=1.):
-        self.initialise(init_UV=init_UV,expo_prior=expo_prior) 
+    def train(self,iterations,init_UV='random',expo_prior=1.,seed=None):
+        self.initialise(init_UV=init_UV,expo_prior=expo_prior,seed=seed) 
         self.run(iterations=iterations)         
             
 
     """ Updates for U and V """    
     def update_U(self,k):
-        self.U[:,k] = self.U[:,k] * (self.M * (self.V[:,k] * ( self.R / numpy.dot(self.U,self.V.T) ) )).sum(axis=1) / (self.M * self.V[:,k]).sum(axis=1)
+        if self.sparse:
+            ratio = self.omega.values / self.omega.dot(self.U,self.V)
+            Vk = self.V[self.omega.columns,k]
+            self.U[:,k] = self.U[:,k] * self.omega.row_sums(Vk*ratio) / self.omega.row_sums(Vk)
+            return
+        ratio = self.ratio()
+        ratio *= self.V[:,k]
+        ratio *= self.M
+        numerator = ratio.sum(axis=1)
+        self.U[:,k] = self.U[:,k] * numerator / self.workspace.multiply('work',self.M,self.V[:,k]).sum(axis=1)
         
     def update_V(self,k):
-        self.V[:,k] = self.V[:,k] * ( (self.U[:,k] * ( self.R / numpy.dot(self.U,self.V.T) ).T ).T * self.M ).sum(axis=0) / (self.U[:,k] * self.M.T).T.sum(axis=0)
+        if self.sparse:
+            ratio = self.omega.values / self.omega.dot(self.U,self.V)
+            Uk = self.U[self.omega.rows,k]
+            self.V[:,k] = self.V[:,k] * self.omega.column_sums(Uk*ratio) / self.omega.column_sums(Uk)
+            return
+        ratio = self.ratio()
+        ratio *= self.U[:,k][:,None]
+        ratio *= self.M
+        numerator = ratio.sum(axis=0)
+        self.V[:,k] = self.V[:,k] * numerator / self.workspace.multiply('work',self.M,self.U[:,k][:,None]).sum(axis=0)
+        
+    # Compute R / (U V^T) in the workspace
+    def ratio(self):
+        ratio = self.workspace.dot('ratio',self.U,self.V.T)
+        return numpy.divide(self.R,ratio,out=ratio)
         
         
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def predict(self,M_pred):
-        R_pred = numpy.dot(self.U,self.V.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(self.U,self.V))
+        else:
+            (R,R_pred) = (self.R,numpy.dot(self.U,self.V.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}        
         
     def compute_MSE(self,M,R,R_pred):
@@ -144,16 +204,22 @@ class NMF:
         return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))   
         
     def compute_I_div(self):    
+        if self.sparse:
+            (R,R_pred) = (self.omega.values,self.omega.dot(self.U,self.V))
+            return ( R * numpy.log( R / R_pred ) - R + R_pred ).sum(dtype=numpy.float64)
         R_pred = numpy.dot(self.U, self.V.T)
-        return (self.M * ( self.R_excl_unknown * numpy.log( self.R_excl_unknown / R_pred ) - self.R_excl_unknown + R_pred ) ).sum()        
+        return (self.M * ( self.R_excl_unknown * numpy.log( self.R_excl_unknown / R_pred ) - self.R_excl_unknown + R_pred ) ).sum(dtype=numpy.float64)        
         
         
     """ Give updates and store performances """
-    def give_update(self,iteration):    
-        perf = self.predict(self.M)
-        i_div = self.compute_I_div()
-        
-        for metric in self.metrics:
-            self.all_performances[metric].append(perf[metric])
-               
-        print "Iteration %s. I-divergence: %s. MSE: %s. R^2: %s. Rp: %s." % (iteration,i_div,perf['MSE'],perf['R^2'],perf['Rp'])
+    def give_update(self,iteration,monitor):    
+        perf = monitor.performances(self,self.training_predictions,{'I-divergence':self.compute_I_div})
+        monitor.record(self,iteration,perf)
+        return perf
+        
+        
+    """ Return (M,R,R_pred) for the training data, to monitor the performance while running """
+    def training_predictions(self):
+        if self.sparse:
+            return (numpy.ones(self.omega.size),self.omega.values,self.omega.dot(self.U,self.V))
+        return (self.M,self.R,numpy.dot(self.U,self.V.T))
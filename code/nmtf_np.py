@@ -19,6 +19,12 @@ We expect the following arguments:
 - M, the mask matrix indicating observed values (1) and unobserved ones (0)
 - K, the number of row latent factors
 - L, the number of column latent factors
+- sparse, optional (default False). If True, we store only the observed entries
+  (see observed_entries.py) and compute the updates over those entries only.
+  R and M can then also be scipy.sparse matrices, and we do not make dense I x J
+  copies of them, so the memory scales with the number of observed entries.
+- dtype, optional (default float). The type of R, M, the factor matrices and the buffers of the
+  updates, e.g. numpy.float32 to halve the memory they need. The I-divergence is summed in float64.
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init_S = 'ones'          -> S[i,k] = 1
@@ -29,22 +35,37 @@ Initialisation can be done by running the initialise(init,tauUV) function. We in
           = 'exponential'   -> F[i,k] ~ Exp(expo_prior), G[j,l] ~ Exp(expo_prior) 
           = 'kmeans'        -> F = KMeans(R,rows)+0.2, G = KMeans(R,columns)+0.2
   where expo_prior is an additional parameter (default 1)
+
+The random initialisation uses the random state of the seed given to 
+initialise(...,seed) (see random_state.py): None for numpy's global random state, 
+an int, or a numpy.random.RandomState.
+The KMeans initialisation still uses the random state of the kmeans library.
+
+The performances (I-divergence, MSE, R^2, Rp on the training data) are stored in 
+all_performances each iteration. We can choose which are computed and printed, 
+and how often, by passing a Monitor (see monitor.py) to run(iterations,monitor=monitor).
 """
 
 import sys
 sys.path.append("/home/tab43/Documents/Projects/libraries/")#("/home/thomas/Documenten/PhD/")#
 from kmeans_missing.code.kmeans import KMeans
 
-from distributions.exponential import exponential_draw
+from distributions.exponential import exponential_vector_draw
+from observed_entries import ObservedEntries, sparse_inputs
+from workspace import Workspace
+from monitor import Monitor
+from random_state import random_state
 
 import numpy,itertools,math,time
 
 class NMTF:
-    def __init__(self,R,M,K,L):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,sparse=False,dtype=float):
+        (self.R,self.M) = sparse_inputs(R,M) if sparse else (numpy.array(R,dtype=dtype),numpy.array(M,dtype=dtype))
         self.K = K            
         self.L = L    
+        self.sparse = sparse
+        self.dtype = dtype
+        self.workspace = Workspace(self.dtype)
         
         self.metrics = ['MSE','R^2','Rp']
                 
@@ -55,18 +76,19 @@ class NMTF:
         
         (self.I,self.J) = self.R.shape
         
+        if self.sparse:
+            self.omega = ObservedEntries(self.R,self.M,self.dtype)
         self.check_empty_rows_columns() 
         
-        # For computing the I-div it is better if unknown values are 1's, not 0's
-        self.R_excl_unknown = numpy.empty((self.I,self.J))
-        for i,j in itertools.product(range(0,self.I),range(0,self.J)):
-            self.R_excl_unknown[i,j] = self.R[i,j] if self.M[i,j] else 1.
+        # For computing the I-div it is better if unknown values are 1's, not 0's (in sparse mode 
+        # we only use the observed entries)
+        if not self.sparse:
+            self.R_excl_unknown = numpy.where(self.M != 0, self.R, 1.).astype(dtype)
                  
                  
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        (sums_rows,sums_columns) = self.omega.counts() if self.sparse else (self.M.sum(axis=1),self.M.sum(axis=0))
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
@@ -76,56 +98,60 @@ class NMTF:
                  
 
     """ Initialise F, S and G """    
-    def initialise(self,init_S='random',init_FG='random',expo_prior=1.):
+    def initialise(self,init_S='random',init_FG='random',expo_prior=1.,seed=None):
+        self.random_state = random_state(seed)
         assert init_S in ['ones','random','exponential'], "Unrecognised init option for S: %s." % init_S
         assert init_FG in ['ones','random','exponential','kmeans'], "Unrecognised init option for F,G: %s." % init_FG
         
         if init_S == 'ones':
-            self.S = numpy.ones((self.K,self.L))
+            self.S = numpy.ones((self.K,self.L),dtype=self.dtype)
         elif init_S == 'random':
-            self.S = numpy.random.rand(self.K,self.L)
+            self.S = self.random_state.rand(self.K,self.L).astype(self.dtype)
         elif init_S == 'exponential':
-            self.S = numpy.empty((self.K,self.L))
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):        
-                self.S[k,l] = exponential_draw(expo_prior)
+            self.S = exponential_vector_draw(expo_prior*numpy.ones((self.K,self.L)),self.random_state).astype(self.dtype)
         
         if init_FG == 'ones':
-            self.F = numpy.ones((self.I,self.K))
-            self.G = numpy.ones((self.J,self.L))
+            self.F = numpy.ones((self.I,self.K),dtype=self.dtype)
+            self.G = numpy.ones((self.J,self.L),dtype=self.dtype)
         elif init_FG == 'random':
-            self.F = numpy.random.rand(self.I,self.K)
-            self.G = numpy.random.rand(self.J,self.L)
+            self.F = self.random_state.rand(self.I,self.K).astype(self.dtype)
+            self.G = self.random_state.rand(self.J,self.L).astype(self.dtype)
         elif init_FG == 'exponential':
-            self.F = numpy.empty((self.I,self.K))
-            self.G = numpy.empty((self.J,self.L))
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.F[i,k] = exponential_draw(expo_prior)
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.G[j,l] = exponential_draw(expo_prior)
+            self.F = exponential_vector_draw(expo_prior*numpy.ones((self.I,self.K)),self.random_state).astype(self.dtype)
+            self.G = exponential_vector_draw(expo_prior*numpy.ones((self.J,self.L)),self.random_state).astype(self.dtype)
         elif init_FG == 'kmeans':
+            (R,M) = self.omega.dense() if self.sparse else (self.R,self.M) # KMeans needs the dense matrices
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
+            kmeans_F = KMeans(R,M,self.K)
             kmeans_F.initialise()
             kmeans_F.cluster()
-            self.F = kmeans_F.clustering_results + 0.2            
+            self.F = (kmeans_F.clustering_results + 0.2).astype(self.dtype)            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
+            kmeans_G = KMeans(R.T,M.T,self.L)   
             kmeans_G.initialise()
             kmeans_G.cluster()
-            self.G = kmeans_G.clustering_results + 0.2
+            self.G = (kmeans_G.clustering_results + 0.2).astype(self.dtype)
         
         
     """ Update F, S, G for a number of iterations, printing the performances each iteration. """
-    def run(self,iterations):
+    def run(self,iterations,stopping_criterion=None,monitor=None):
         assert hasattr(self,'F') and hasattr(self,'S') and hasattr(self,'G'), \
             "F, S and G have not been initialised - please run NMTF.initialise() first."        
         
         self.all_times = [] # to plot performance against time
+        
+        monitor = monitor if monitor is not None else Monitor()
+        monitor.initialise(['I-divergence']+self.metrics)
+        self.all_iterations = [] # iterations at which we computed the performances
         self.all_performances = {} # for plotting convergence of metrics
-        for metric in self.metrics:
+        for metric in monitor.metrics:
             self.all_performances[metric] = []
             
+        self.stop_reason = "Reached the maximum number of iterations (%s)." % iterations
+        if stopping_criterion is not None:
+            stopping_criterion.initialise()
+            
         time_start = time.time()
         for it in range(1,iterations+1):
             # Doing S first gives more interpretable results (F,G ~= [0,1] rather than [0,20])
@@ -138,15 +164,21 @@ class NMTF:
             for l in range(0,self.L):
                 self.update_G(l)
                
-            self.give_update(it)
+            evaluate = monitor.evaluate(it-1,iterations)
+            if evaluate:
+                perf = self.give_update(it,monitor)
             
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)  
+            
+            if stopping_criterion is not None and evaluate and stopping_criterion.check(perf):
+                self.stop_reason = stopping_criterion.reason
+                break
         
         
     """ Method for doing both initialise() and run() """
-    def train(self,iterations,init_S='random',init_FG='random',expo_prior=1.):
-        self.initialise(init_S=init_S,init_FG=init_FG,expo_prior=expo_prior) 
+    def train(self,iterations,init_S='random',init_FG='random',expo_prior=1.,seed=None):
+        self.initialise(init_S=init_S,init_FG=init_FG,expo_prior=expo_prior,seed=seed) 
         self.run(iterations=iterations)
         
                 
@@ -156,33 +188,65 @@ class NMTF:
         return numpy.dot(M1,numpy.dot(M2,M3))
         
     def update_F(self,k):
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
+        if self.sparse:
+            ratio = self.omega.values / self.omega.dot(self.F,numpy.dot(self.G,self.S.T))
+            SG = numpy.dot(self.S[k],self.G.T)[self.omega.columns]
+            self.F[:,k] = self.F[:,k] * self.omega.row_sums(ratio*SG) / self.omega.row_sums(SG)
+            return
         SG = numpy.dot(self.S[k],self.G.T)
-        numerator = (self.M * self.R / R_pred * SG).sum(axis=1)
-        denominator = (self.M * SG).sum(axis=1)
+        ratio = self.masked_ratio()
+        ratio *= SG
+        numerator = ratio.sum(axis=1)
+        denominator = self.workspace.multiply('work',self.M,SG).sum(axis=1)
         self.F[:,k] = self.F[:,k] * numerator / denominator
         
     def update_G(self,l):
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
+        if self.sparse:
+            ratio = self.omega.values / self.omega.dot(self.F,numpy.dot(self.G,self.S.T))
+            FS = numpy.dot(self.F,self.S[:,l])[self.omega.rows]
+            self.G[:,l] = self.G[:,l] * self.omega.column_sums(ratio*FS) / self.omega.column_sums(FS)
+            return
         FS = numpy.dot(self.F,self.S[:,l])
-        numerator = ((self.M * self.R / R_pred).T * FS).T.sum(axis=0)
-        denominator = (self.M.T * FS).T.sum(axis=0)
+        ratio = self.masked_ratio()
+        ratio *= FS[:,None]
+        numerator = ratio.sum(axis=0)
+        denominator = self.workspace.multiply('work',self.M,FS[:,None]).sum(axis=0)
         self.G[:,l] = self.G[:,l] * numerator / denominator
         
     def update_S(self,k,l):
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        F_times_G = self.M * numpy.outer(self.F[:,k], self.G[:,l])   
-        numerator = (self.R * F_times_G / R_pred).sum()
+        if self.sparse:
+            ratio = self.omega.values / self.omega.dot(self.F,numpy.dot(self.G,self.S.T))
+            F_times_G = self.omega.outer(self.F[:,k], self.G[:,l])
+            self.S[k,l] = self.S[k,l] * (ratio * F_times_G).sum() / F_times_G.sum()
+            return
+        R_pred = self.workspace.dot('prediction',self.F,numpy.dot(self.S,self.G.T))
+        F_times_G = self.workspace.outer('outer',self.F[:,k], self.G[:,l])
+        F_times_G *= self.M
+        work = self.workspace.multiply('work',self.R,F_times_G)
+        work /= R_pred
+        numerator = work.sum()
         denominator = F_times_G.sum()
         self.S[k,l] = self.S[k,l] * numerator / denominator
            
            
+    # Compute M * R / (F S G^T) in the workspace
+    def masked_ratio(self):
+        R_pred = self.workspace.dot('prediction',self.F,numpy.dot(self.S,self.G.T))
+        ratio = self.workspace.multiply('ratio',self.M,self.R)
+        return numpy.divide(ratio,R_pred,out=ratio)
+        
+        
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def predict(self,M_pred):
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
+        if self.sparse:
+            # Only compute the predictions for the entries in M_pred
+            omega_pred = ObservedEntries(self.R,M_pred,self.dtype)
+            (M_pred,R,R_pred) = (numpy.ones(omega_pred.size),omega_pred.values,omega_pred.dot(self.F,numpy.dot(self.G,self.S.T)))
+        else:
+            (R,R_pred) = (self.R,self.triple_dot(self.F,self.S,self.G.T))
+        MSE = self.compute_MSE(M_pred,R,R_pred)
+        R2 = self.compute_R2(M_pred,R,R_pred)    
+        Rp = self.compute_Rp(M_pred,R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}        
         
     def compute_MSE(self,M,R,R_pred):
@@ -203,16 +267,22 @@ class NMTF:
         return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))   
         
     def compute_I_div(self):    
+        if self.sparse:
+            (R,R_pred) = (self.omega.values,self.omega.dot(self.F,numpy.dot(self.G,self.S.T)))
+            return ( R * numpy.log( R / R_pred ) - R + R_pred ).sum(dtype=numpy.float64)
         R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        return (self.M * ( self.R_excl_unknown * numpy.log( self.R_excl_unknown / R_pred ) - self.R_excl_unknown + R_pred ) ).sum()        
+        return (self.M * ( self.R_excl_unknown * numpy.log( self.R_excl_unknown / R_pred ) - self.R_excl_unknown + R_pred ) ).sum(dtype=numpy.float64)        
         
         
     """ Give updates and store performances """
-    def give_update(self,iteration):    
-        perf = self.predict(self.M)
-        i_div = self.compute_I_div()
+    def give_update(self,iteration,monitor):    
+        perf = monitor.performances(self,self.training_predictions,{'I-divergence':self.compute_I_div})
+        monitor.record(self,iteration,perf)
+        return perf
         
-        for metric in self.metrics:
-            self.all_performances[metric].append(perf[metric])
-               
-        print "Iteration %s. I-divergence: %s. MSE: %s. R^2: %s. Rp: %s." % (iteration,i_div,perf['MSE'],perf['R^2'],perf['Rp'])
+        
+    """ Return (M,R,R_pred) for the training data, to monitor the performance while running """
+    def training_predictions(self):
+        if self.sparse:
+            return (numpy.ones(self.omega.size),self.omega.values,self.omega.dot(self.F,numpy.dot(self.G,self.S.T)))
+        return (self.M,self.R,self.triple_dot(self.F,self.S,self.G.T))
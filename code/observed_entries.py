@@ -0,0 +1,96 @@
+"""
+Class storing only the observed entries (i,j,R[i,j]) of a matrix R with mask M,
+allowing the models to compute their updates over Omega = {(i,j) | M[i,j] = 1}
+rather than over the full I x J matrix.
+
+The entries are stored in CSR (row-major) order:
+- rows, columns - arrays of size |Omega| giving the indices (i,j) of each entry
+- values        - array of size |Omega| with the values R[i,j]
+
+Any masked expression (M * X) for an I x J matrix X is then represented by the
+vector of X[i,j] values for (i,j) in Omega, and we replace:
+- (M * X).sum(axis=1)   -> row_sums(x), a segment sum over each row
+- (M * X).sum(axis=0)   -> column_sums(x), a segment sum over each column
+- (M * X).sum()         -> x.sum()
+- M * numpy.dot(A,B.T)  -> dot(A,B), computing only the observed entries
+- M * numpy.outer(a,b)  -> outer(a,b)
+- numpy.dot(M * X, Y)   -> matrix(x).dot(Y), a sparse-dense matrix product
+so that the cost of each update scales with |Omega|*K rather than I*J*K.
+
+The values are stored with the given dtype (default float), as the models do for R.
+
+R and M can be dense arrays or scipy.sparse matrices (e.g. built from the (i,j,R_ij)
+triples with scipy.sparse.coo_matrix((values,(rows,columns)),shape=(I,J))). For a
+sparse M the observed entries are its nonzero entries, and for a sparse R entries 
+that are not stored are 0. We do not make dense I x J copies of either, so the
+memory we need scales with |Omega|. The models in sparse mode keep R and M as
+given by sparse_inputs(R,M), and count the entries per row and column with counts().
+
+Usage:
+    omega = ObservedEntries(R,M)
+    tauUk = tau * omega.row_sums(V[omega.columns,k]**2)
+"""
+
+import numpy, scipy.sparse
+
+# Return R and M without making dense copies: scipy.sparse matrices in CSR format, and arrays as they are
+def sparse_inputs(R,M):
+    return tuple(scipy.sparse.csr_matrix(A) if scipy.sparse.issparse(A) else numpy.asarray(A) for A in (R,M))
+
+# Return the indices (rows,columns) of the nonzero entries of M, in row-major order
+def nonzero_entries(M):
+    if not scipy.sparse.issparse(M):
+        return numpy.nonzero(M)
+    M = scipy.sparse.csr_matrix(M,copy=True)
+    M.eliminate_zeros()
+    M.sort_indices()
+    return (numpy.repeat(numpy.arange(M.shape[0]),numpy.diff(M.indptr)),M.indices)
+
+# Return the values R[i,j] for the given indices
+def entry_values(R,rows,columns):
+    if not scipy.sparse.issparse(R):
+        return numpy.asarray(R)[rows,columns]
+    if len(rows) == 0:
+        return numpy.zeros(0,dtype=R.dtype)
+    return numpy.asarray(scipy.sparse.csr_matrix(R)[rows,columns]).ravel()
+
+class ObservedEntries:
+    def __init__(self,R,M,dtype=float):
+        (R,M) = sparse_inputs(R,M)
+        assert R.shape == M.shape, "Input matrix R is not of the same size as " \
+            "the indicator matrix M: %s and %s respectively." % (R.shape,M.shape)
+
+        (self.I,self.J) = R.shape
+        (self.rows,self.columns) = nonzero_entries(M)
+        self.values = entry_values(R,self.rows,self.columns).astype(dtype)
+        self.size = len(self.values)
+
+
+    # Return the number of observed entries in each row and each column
+    def counts(self):
+        return (numpy.bincount(self.rows,minlength=self.I),numpy.bincount(self.columns,minlength=self.J))
+
+    # Return dense copies of R (with 0 for the unobserved entries) and of M, for the few places that need them
+    def dense(self):
+        return (self.matrix(self.values).toarray(),self.matrix(numpy.ones(self.size,dtype=self.values.dtype)).toarray())
+
+
+    # Sum the entry values x over each row (i) or column (j)
+    def row_sums(self,x):
+        return numpy.bincount(self.rows,weights=x,minlength=self.I)
+
+    def column_sums(self,x):
+        return numpy.bincount(self.columns,weights=x,minlength=self.J)
+
+
+    # Observed entries of numpy.dot(A,B.T), with A of size I x K and B of size J x K
+    def dot(self,A,B):
+        return numpy.einsum('ij,ij->i',A[self.rows],B[self.columns])
+
+    # Observed entries of numpy.outer(a,b), with a of size I and b of size J
+    def outer(self,a,b):
+        return a[self.rows] * b[self.columns]
+
+    # Sparse (CSR) matrix with the values x at the observed entries, and 0 elsewhere
+    def matrix(self,x):
+        return scipy.sparse.csr_matrix((x,(self.rows,self.columns)),shape=(self.I,self.J))
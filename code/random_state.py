@@ -0,0 +1,34 @@
+"""
+Methods for the random states that the models draw from, so that runs can be
+reproduced, and parallel runs (e.g. restarts or cross-validation folds) are
+independent of each other and of the order in which they are done.
+
+A seed can be None, an int, or a numpy.random.RandomState:
+- None          -> use numpy's global random state (numpy.random.seed), as before.
+- int           -> use a new RandomState(seed).
+- RandomState   -> use it as it is, so that several draws can share one state.
+
+For a number of independent tasks we spawn one seed per task from a parent seed,
+using spawn_seeds(seed,n). The seed of a task then only depends on the parent
+seed and its position, not on which process runs it. If the parent seed is None
+the task seeds are None as well, so that the tasks use the global random state.
+
+Usage:
+    state = random_state(seed)
+    U = state.rand(I,K)
+    seeds = spawn_seeds(seed,restarts)
+"""
+
+import numpy
+
+# Return the random state to draw from for the given seed
+def random_state(seed=None):
+    if isinstance(seed,numpy.random.RandomState):
+        return seed
+    return numpy.random.RandomState(seed) if seed is not None else numpy.random
+
+# Return a list of <n> seeds for independent tasks, drawn from the given seed (or Nones if it is None)
+def spawn_seeds(seed,n):
+    if seed is None:
+        return [None for i in range(0,n)]
+    return [int(s) for s in random_state(seed).randint(0,2**31-1,size=n)]
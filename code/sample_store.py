@@ -0,0 +1,99 @@
+"""
+Class for storing the draws of the Gibbs samplers with bounded memory.
+
+By default the Gibbs samplers keep every draw of every matrix in memory (e.g.
+all_U of size iterations x I x K), and only throw away the burn-in and apply the
+thinning afterwards, in approx_expectation(burn_in,thinning). Passing a
+SampleStore to run() instead lets us give the burn-in and thinning up front,
+and keep a running mean and variance of each variable (Welford's algorithm),
+so that the memory needed does not grow with the number of iterations.
+
+We expect the following arguments:
+- burn_in, the number of draws to throw away at the start
+- thinning, optional (default 1). After the burn-in we use every <thinning>th draw.
+- filename, optional (default None). If given, we also store the thinned draws
+    of each variable in a memory-mapped .npy file, <filename>_<variable>.npy
+    (e.g. samples_U.npy), so they can still be inspected without holding them
+    in memory. The files are overwritten if they already exist.
+
+The model calls initialise(iterations,shapes) at the start of run(), with shapes
+a dictionary from variable names to their shapes (e.g. {'U':(I,K),'tau':()}),
+and add(iteration,values) after each iteration. We then have:
+- mean(variable), variance(variable) - the mean and (population) variance of the
+    draws we kept, as arrays of the shape of the variable
+- samples(variable) - the memory-mapped array of draws we kept, if filename was given
+- count - the number of draws we kept
+
+Usage:
+    store = SampleStore(burn_in=1000,thinning=10)
+    BNMF.run(iterations=10000,sample_store=store)
+    performances = BNMF.predict(M_test,burn_in=1000,thinning=10)
+"""
+
+import numpy
+
+class SampleStore:
+    def __init__(self,burn_in,thinning=1,filename=None):
+        assert burn_in >= 0, "Burn-in should be at least 0, but is %s." % burn_in
+        assert thinning >= 1, "Thinning should be at least 1, but is %s." % thinning
+        self.burn_in = burn_in
+        self.thinning = thinning
+        self.filename = filename
+
+
+    # Reset the accumulators, to store the draws of a run of <iterations> iterations
+    def initialise(self,iterations,shapes):
+        self.count = 0
+        self.means = {}
+        self.sums_squares = {}
+        self.memmaps = {}
+
+        no_samples = len(range(self.burn_in,iterations,self.thinning))
+        for variable,shape in shapes.items():
+            self.means[variable] = numpy.zeros(shape)
+            self.sums_squares[variable] = numpy.zeros(shape)
+            if self.filename is not None:
+                self.memmaps[variable] = numpy.lib.format.open_memmap(
+                    self.sample_filename(variable),mode='w+',dtype=float,shape=(no_samples,)+tuple(shape))
+
+    def sample_filename(self,variable):
+        return "%s_%s.npy" % (self.filename,variable)
+
+
+    # Return True if we keep the draw of iteration <iteration> (counting from 0)
+    def keep(self,iteration):
+        return iteration >= self.burn_in and (iteration - self.burn_in) % self.thinning == 0
+
+    # Add the draws of iteration <iteration>, a dictionary from variable names to values
+    def add(self,iteration,values):
+        if not self.keep(iteration):
+            return
+        self.count += 1
+        for variable,value in values.items():
+            # Welford's update: mean += (x - mean) / n, sum_squares += (x - mean_old) * (x - mean_new)
+            mean = self.means[variable]
+            delta = value - mean
+            mean += delta / self.count
+            self.sums_squares[variable] += delta * (value - mean)
+            if self.filename is not None:
+                self.memmaps[variable][self.count-1] = value
+
+
+    # Check that the burn-in and thinning match the ones we used to store the draws
+    def check(self,burn_in,thinning):
+        assert (burn_in,thinning) == (self.burn_in,self.thinning), \
+            "Samples were stored with burn-in %s and thinning %s, but burn-in %s and thinning %s were requested." % \
+            (self.burn_in,self.thinning,burn_in,thinning)
+        assert self.count > 0, "No samples were stored after the burn-in of %s iterations." % self.burn_in
+
+
+    # The mean, variance, and (if stored on disk) the draws of the variable
+    def mean(self,variable):
+        return numpy.copy(self.means[variable])
+
+    def variance(self,variable):
+        return self.sums_squares[variable] / float(self.count)
+
+    def samples(self,variable):
+        assert self.filename is not None, "Samples are only kept if a filename is given."
+        return self.memmaps[variable][:self.count]
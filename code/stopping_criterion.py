@@ -0,0 +1,131 @@
+"""
+Stopping criteria for the inference methods, so that run(iterations) can stop
+before the maximum number of iterations once the model has converged.
+
+We expect the following arguments:
+- criterion, one of:
+    'ELBO'  -> stop when the relative change in the ELBO, |ELBO_t - ELBO_t-1| / |ELBO_t-1|,
+               is below tolerance (variational Bayes only)
+    'MSE'   -> stop when the absolute change in the training MSE is below tolerance
+    'tau'   -> stop when the relative change in (the expectation of) tau is below tolerance
+    'Rhat'  -> stop when the split R-hat of the trace of tau, after discarding the first
+               half as burn-in, is below tolerance, e.g. 1.1 (Gibbs sampling only)
+    'ESS'   -> stop when the effective sample size of the trace of tau, after discarding
+               the first half as burn-in, is above tolerance, e.g. 100 (Gibbs sampling only)
+- tolerance, the threshold for the criterion
+- patience, optional (default 1). We only stop once the criterion has been met for
+    this many consecutive iterations.
+- minimum_iterations, optional (default 1). Never stop before this many iterations.
+  (The sampling criteria always need at least 8 samples.)
+
+Each iteration the model passes a dictionary of the values it has available -
+{ 'ELBO', 'MSE', 'tau' } for VB, { 'MSE', 'tau' } for ICM, { 'MSE', 'tau_sample' } 
+for Gibbs, and { 'MSE' } for the non-probabilistic methods - and we return True 
+if we should stop.
+The reason is then stored in criterion.reason, and in model.stop_reason.
+
+Usage:
+    criterion = StoppingCriterion('ELBO',tolerance=1e-5,patience=5)
+    BNMF.run(iterations=1000,stopping_criterion=criterion)
+    print BNMF.stop_reason
+"""
+
+import numpy, math
+
+criteria = ['ELBO','MSE','tau','Rhat','ESS']
+minimum_samples = 8
+
+class StoppingCriterion:
+    def __init__(self,criterion,tolerance,patience=1,minimum_iterations=1):
+        assert criterion in criteria, "Unrecognised stopping criterion: %s. Should be one of %s." % (criterion,criteria)
+        assert patience >= 1, "Patience should be at least 1, but is %s." % patience
+        self.criterion = criterion
+        self.tolerance = tolerance
+        self.patience = patience
+        self.minimum_iterations = minimum_iterations
+        self.initialise()
+
+
+    # Reset the criterion, to start a new run
+    def initialise(self):
+        self.values = []
+        self.statistics = []
+        self.count = 0
+        self.reason = None
+
+
+    # Add the values of this iteration, and return True if we should stop
+    def check(self,values):
+        key = 'tau_sample' if self.criterion in ['Rhat','ESS'] else self.criterion
+        assert key in values, "Stopping criterion %s is not available for this model." % self.criterion
+        self.values.append(values[key])
+
+        if self.criterion in ['ELBO','MSE','tau']:
+            statistic = self.change()
+            met = statistic is not None and statistic < self.tolerance
+        else:
+            statistic = self.split_rhat() if self.criterion == 'Rhat' else self.effective_sample_size()
+            met = statistic is not None and \
+                (statistic < self.tolerance if self.criterion == 'Rhat' else statistic > self.tolerance)
+        self.statistics.append(statistic)
+
+        self.count = self.count + 1 if met else 0
+        if self.count >= self.patience and len(self.values) >= self.minimum_iterations:
+            self.reason = self.describe(statistic)
+            return True
+        return False
+
+    def describe(self,statistic):
+        descriptions = {
+            'ELBO' : "Relative change in ELBO below %s",
+            'MSE'  : "Change in training MSE below %s",
+            'tau'  : "Relative change in tau below %s",
+            'Rhat' : "Split R-hat of tau below %s",
+            'ESS'  : "Effective sample size of tau above %s",
+        }
+        return (descriptions[self.criterion] + " for %s iteration(s) (last value %s), after %s iterations.") % \
+            (self.tolerance,self.patience,statistic,len(self.values))
+
+
+    # Change between the last two values - relative for ELBO and tau, absolute for MSE
+    def change(self):
+        if len(self.values) < 2:
+            return None
+        (previous,current) = (self.values[-2],self.values[-1])
+        if self.criterion == 'MSE':
+            return abs(current - previous)
+        return abs(current - previous) / abs(previous) if previous != 0. else numpy.inf
+
+
+    # Split R-hat (Gelman et al., 2013) of the second half of the trace, split into two chains
+    def split_rhat(self):
+        trace = numpy.array(self.values[len(self.values)/2:])
+        n = len(trace) / 2
+        if 2*n < minimum_samples:
+            return None
+        chains = numpy.array([trace[:n],trace[-n:]])
+        W = chains.var(axis=1,ddof=1).mean()
+        B = n * chains.mean(axis=1).var(ddof=1)
+        if W == 0.:
+            return 1. if B == 0. else numpy.inf
+        var_plus = (n-1.)/n * W + B/n
+        return math.sqrt(var_plus / W)
+
+    # Effective sample size of the second half of the trace, summing the autocorrelations
+    # until they first become negative
+    def effective_sample_size(self):
+        trace = numpy.array(self.values[len(self.values)/2:])
+        n = len(trace)
+        if n < minimum_samples:
+            return None
+        centred = trace - trace.mean()
+        variance = (centred**2).sum()
+        if variance == 0.:
+            return float(n)
+        autocorrelations = numpy.correlate(centred,centred,mode='full')[n-1:] / variance
+        total = 0.
+        for rho in autocorrelations[1:]:
+            if rho < 0.:
+                break
+            total += rho
+        return n / (1. + 2.*total)
@@ -0,0 +1,53 @@
+"""
+Methods for warm starts: initialising a model with more factors from the fit of
+a model with fewer, so that a model selection (see grid_search) does not start
+each larger K (and L) from scratch.
+
+We copy the columns of the factor matrices of the fit, and add the new columns
+in one of two ways (the argument warm_start of initialise_warm):
+- 'split' -> split the columns with the highest variance. Column k is replaced by
+             two columns A[:,k]*(1+e)/2 and A[:,k]*(1-e)/2, with e ~ U(0,0.1) for
+             each entry so that they can diverge, and the matching columns of
+             the other factor matrices (rows of S for F) are copied. The product
+             of the factor matrices, and so the fit, stays the same.
+- 'prior' -> use the new columns of <default>, values drawn from the priors as
+             initialise(init='random') does.
+
+Usage:
+    sources = split_sources(U,K,warm_start)                 # the column to split for each new column, or None
+    U = extend_columns(U,sources,default_U,random_state)    # split the columns in two
+    V = copy_columns(V,sources,default_V)                   # copy the matching columns
+"""
+
+import numpy
+
+warm_start_options = ['split','prior']
+
+# Return for each of the K_new - K new columns of A the column to split, or None if we use the prior
+def split_sources(A,K_new,warm_start):
+    assert warm_start in warm_start_options, "Unknown warm start option: %s. Should be 'split' or 'prior'." % warm_start
+    K = A.shape[1]
+    assert K <= K_new, "Cannot warm start from a model with more factors: %s > %s." % (K,K_new)
+    if warm_start == 'prior':
+        return [None for k in range(K,K_new)]
+    order = numpy.argsort(-A.var(axis=0),kind='mergesort')
+    return [order[i % K] for i in range(0,K_new-K)]
+
+# Return A with a column added for each of the sources: half of the split column, or the column of <default>
+def extend_columns(A,sources,default,random_state=numpy.random):
+    (A,K) = (numpy.array(A),A.shape[1])
+    columns = []
+    for i,k in enumerate(sources):
+        if k is None:
+            columns.append(default[:,K+i])
+        else:
+            e = random_state.uniform(0.,0.1,size=A.shape[0])
+            columns.append(A[:,k]*(1.-e)/2.)
+            A[:,k] = A[:,k]*(1.+e)/2.
+    return numpy.column_stack([A]+columns).astype(A.dtype)
+
+# Return B with a column added for each of the sources: a copy of the split column, or the column of <default>
+def copy_columns(B,sources,default):
+    K = B.shape[1]
+    columns = [B[:,k] if k is not None else default[:,K+i] for i,k in enumerate(sources)]
+    return numpy.column_stack([B]+columns).astype(B.dtype)
@@ -0,0 +1,67 @@
+"""
+Class holding preallocated buffers that the models reuse in their updates, so
+that the dense (I x J) temporaries in expressions like M * (R - U V^T) are not
+allocated again for every column of every iteration.
+
+Buffers are identified by a name, and allocated the first time they are
+requested with a given shape. The models then write into them using the out=
+arguments of numpy.dot and the ufuncs, and in-place operators. The operations
+are done in the same order as the original expressions, so the results are
+identical.
+
+A buffer is only valid until the next request with the same name, so callers
+should not hold on to it across calls to other updates (unless they own the name,
+like the cached residual of the tri-factorisation models).
+
+The buffers are allocated with the given dtype (default float), which the models
+set to their own dtype, e.g. numpy.float32 to halve the memory of the buffers.
+
+Usage:
+    workspace = Workspace()
+    residual = workspace.masked_residual('residual',M,R,U,V)   # M * (R - U V^T)
+    tauU = (workspace.multiply('work',M,V[:,k]**2)).sum(axis=1)
+"""
+
+import numpy
+
+class Workspace:
+    def __init__(self,dtype=float):
+        self.dtype = dtype
+        self.buffers = {}
+
+
+    # Return the buffer <name> of the given shape, allocating it if needed
+    def get(self,name,shape):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape):
+            buffer = numpy.empty(shape,dtype=self.dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+
+    # numpy.dot(A,B), written into buffer <name>. numpy.dot only accepts out= if the
+    # result has the same type as the buffer, so we copy the result in for other inputs.
+    def dot(self,name,A,B):
+        out = self.get(name,(A.shape[0],B.shape[1]))
+        if numpy.result_type(A,B) != out.dtype:
+            out[:] = numpy.dot(A,B)
+            return out
+        return numpy.dot(A,B,out=out)
+
+    # numpy.outer(a,b), written into buffer <name>
+    def outer(self,name,a,b):
+        return numpy.multiply(a[:,None],b[None,:],out=self.get(name,(len(a),len(b))))
+
+    # X * Y (with broadcasting), written into buffer <name>
+    def multiply(self,name,X,Y):
+        return numpy.multiply(X,Y,out=self.get(name,numpy.broadcast(X,Y).shape))
+
+    # R - A B, written into buffer <name>
+    def residual(self,name,R,A,B):
+        out = self.dot(name,A,B)
+        return numpy.subtract(R,out,out=out)
+
+    # M * (R - A B^T), written into buffer <name>
+    def masked_residual(self,name,M,R,A,B):
+        out = self.residual(name,R,A,B.T)
+        return numpy.multiply(M,out,out=out)
@@ -16,6 +16,14 @@ Arguments:
 - restarts          - the number of times we try each model when doing model selection
 - quality_metric    - the metric we use to measure model quality - MSE, AIC, or BIC
 - file_performance  - the file in which we store the performances
+- seed              - optional (default None). If given, the folds, the greedy search of
+                      each fold and the restarts of the final model of each fold
+                      get their own seeds, spawned from this one (see mask.spawn_seeds).
+- cache             - optional (default None). A FitCache (see code/fit_cache.py),
+                      which we pass to the GreedySearch, and use for the final models
+                      together with their performances on the test set, so that
+                      rerunning the cross-validation reuses the fits of previous
+                      runs. Only used if we are given a seed.
 
 We start the search using run(). If we use ICM we use run(minimum_TN=<>)
 run(burn_in=<>,thinning=<>).
@@ -24,13 +32,13 @@ run(burn_in=<>,thinning=<>).
 import sys
 sys.path.append("/home/tab43/Documents/Projects/libraries/")#("/home/thomas/Documenten/PhD/")#
 
-from BNMTF.grid_search.greedy_search_bnmtf import GreedySearch
+from BNMTF.grid_search.greedy_search_bnmtf import GreedySearch, metrics as fit_metrics
 import numpy, mask
 
 metrics = ['MSE','AIC','BIC'] 
 
 class GreedySearchCrossValidation:
-    def __init__(self,classifier,R,M,values_K,values_L,folds,priors,init_S,init_FG,iterations,restarts,quality_metric,file_performance):
+    def __init__(self,classifier,R,M,values_K,values_L,folds,priors,init_S,init_FG,iterations,restarts,quality_metric,file_performance,seed=None,cache=None):
         self.classifier = classifier
         self.R = numpy.array(R,dtype=float)
         self.M = numpy.array(M)
@@ -43,6 +51,9 @@ class GreedySearchCrossValidation:
         self.iterations = iterations
         self.restarts = restarts
         self.quality_metric = quality_metric
+        self.cache = cache
+        (self.seed_folds,seed_runs) = mask.spawn_seeds(seed,2)
+        self.seeds = mask.spawn_seeds(seed_runs,self.folds)
         
         self.fout = open(file_performance,'w')
         (self.I,self.J) = self.R.shape
@@ -55,11 +66,12 @@ class GreedySearchCrossValidation:
         
     # Run the cross-validation
     def run(self,burn_in=None,thinning=None,minimum_TN=None):
-        folds_test = mask.compute_folds(self.I,self.J,self.folds,self.M)
+        folds_test = mask.compute_folds(self.I,self.J,self.folds,self.M,seed=self.seed_folds)
         folds_training = mask.compute_Ms(folds_test)
 
         for i,(train,test) in enumerate(zip(folds_training,folds_test)):
             print "Fold %s." % (i+1)
+            (seed_search,seed_model) = mask.spawn_seeds(self.seeds[i],2)
             
             # Run the greedy grid search
             greedy_search = GreedySearch(
@@ -72,7 +84,9 @@ class GreedySearchCrossValidation:
                 initS=self.init_S,
                 initFG=self.init_FG,
                 iterations=self.iterations,
-                restarts=self.restarts)
+                restarts=self.restarts,
+                seed=seed_search,
+                cache=self.cache)
             greedy_search.search(self.quality_metric,burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
             
             # Store the model fits, and find the best one according to the metric    
@@ -84,37 +98,29 @@ class GreedySearchCrossValidation:
             self.fout.write("Best K,L for fold %s: %s.\n" % (i+1,best_KL))
             
             # Train a model with this K and measure performance on the test set
-            performance = self.run_model(train,test,best_KL[0],best_KL[1],burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+            performance = self.run_model(train,test,best_KL[0],best_KL[1],burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN,seed=seed_model)
             self.fout.write("Performance: %s.\n\n" % performance)
             self.fout.flush()
             
             
     # Initialises and runs the model, and returns the performance on the test set
-    def run_model(self,train,test,K,L,burn_in=None,thinning=None,minimum_TN=None):
+    def run_model(self,train,test,K,L,burn_in=None,thinning=None,minimum_TN=None,seed=None):
+        run_args = {} if minimum_TN is None else {'minimum_TN':minimum_TN}
+        quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        seeds = mask.spawn_seeds(seed,self.restarts)
+        
         # We train <restarts> models, and use the one with the best log likelihood to make predictions   
         best_loglikelihood = None
         best_performance = None
         for r in range(0,self.restarts):
-            model = self.classifier(
-                R=self.R,
-                M=train,
-                K=K,
-                L=L,
-                priors=self.priors
-            )
-            model.initialise(self.init_S,self.init_FG)
-            
-            if minimum_TN is None:
-                model.run(self.iterations)
-            else:
-                model.run(self.iterations,minimum_TN=minimum_TN)
-                
-            if burn_in is None or thinning is None:
-                new_loglikelihood = model.quality('loglikelihood')
-                performance = model.predict(test)
+            key = self.fit_key(train,K,L,seeds[r],run_args,quality_args)
+            record = self.cache.get(key) if key is not None else None
+            if record is not None and self.cache.hash_array(test) in record['predictions']:
+                print "Using the cached fit for the final model, attempt %s." % (r+1)
+                new_loglikelihood = record['qualities']['loglikelihood']
+                performance = record['predictions'][self.cache.hash_array(test)]
             else:
-                new_loglikelihood = model.quality('loglikelihood',burn_in,thinning)
-                performance = model.predict(test,burn_in,thinning)
+                (new_loglikelihood,performance) = self.train_model(train,test,K,L,seeds[r],key,run_args,quality_args)
                 
             if best_loglikelihood is None or new_loglikelihood > best_loglikelihood:
                 best_loglikelihood = new_loglikelihood
@@ -123,4 +129,33 @@ class GreedySearchCrossValidation:
             print "Trained final model, attempt %s. Log likelihood: %s." % (r+1,new_loglikelihood)            
             
         print "Best log likelihood: %s." % best_loglikelihood
-        return best_performance
\ No newline at end of file
+        return best_performance
+        
+        
+    # Train a final model, add it to the fit cache if we have a key, and return its log
+    # likelihood and its performance on the test set
+    def train_model(self,train,test,K,L,seed,key,run_args,quality_args):
+        model = self.classifier(
+            R=self.R,
+            M=train,
+            K=K,
+            L=L,
+            priors=self.priors
+        )
+        model.initialise(self.init_S,self.init_FG,seed=seed)
+        model.run(self.iterations,**run_args)
+        
+        new_loglikelihood = model.quality('loglikelihood',**quality_args)
+        performance = model.predict(test,**quality_args)
+        if key is not None:
+            qualities = { metric : model.quality(metric,**quality_args) for metric in fit_metrics }
+            self.cache.add(key,model,qualities,{ self.cache.hash_array(test) : performance },quality_args)
+        return (new_loglikelihood,performance)
+        
+        
+    # Return the key of a final model in the fit cache (as in the GreedySearch), or None if we do not cache it
+    def fit_key(self,train,K,L,seed,run_args,quality_args):
+        if self.cache is None or not isinstance(seed,int):
+            return None
+        return self.cache.key(self.R,train,classifier=self.classifier,K=K,L=L,priors=self.priors,initS=self.init_S,initFG=self.init_FG,
+                              seed=seed,iterations=self.iterations,run_args=run_args,quality_args=quality_args)
\ No newline at end of file
@@ -1,77 +1,93 @@
 """
 Methods for (randomly) generating a mask M of 1 values if a value is known, and
 0 if a value is unknown
+
+The folds are returned as boolean masks (True if known), which take one byte
+per entry rather than eight for a float matrix, and which the models accept in
+place of M. For storage they can be packed further into bits, using pack_M and
+unpack_M. Rather than multiplying by a mask, the row and column indices of the
+known entries can be used, given by nonzero_row_indices and nonzero_column_indices.
+
+Rather than K masks, the folds can also be represented by a single fold-label
+matrix (compute_fold_labels), giving the fold (0 to K-1) of each known entry as
+an int8, and -1 for unknown entries. The training and test masks of a fold are
+then given by fold_Ms(fold_labels,fold).
+
+All methods work on the flattened indices of the entries, using numpy rather
+than Python loops. The random methods take an optional seed (an int or a
+numpy.random.RandomState); if it is None we use numpy's global random state 
+(numpy.random.seed). Seeds for independent tasks, such as the folds of a 
+parallel cross-validation, can be drawn from one seed using spawn_seeds.
 """
 
-import numpy, random, itertools
+project_location = "/home/tab43/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+from BNMTF.code.random_state import random_state, spawn_seeds
+import numpy
+
+def generate_M(I,J,fraction,seed=None):
+    M = numpy.ones(I*J)
+    M[random_state(seed).permutation(I*J)[:int(I*J*fraction)]] = 0
+    return M.reshape((I,J))
 
-def generate_M(I,J,fraction):
-    M = numpy.ones([I,J])
-    values = random.sample(range(0,I*J),int(I*J*fraction))
-    for v in values:
-        M[v / J][v % J] = 0
-    return M
+# Compute the fold-label matrix for <no_folds> folds: an int8 matrix with the fold
+# of each entry (0 to no_folds-1), or -1 if it is unknown. If M is defined, we
+# split only the 1 entries into the folds.
+def compute_fold_labels(I,J,no_folds,M=None,seed=None):
+    assert no_folds <= numpy.iinfo(numpy.int8).max, "Cannot store %s folds in an int8 fold-label matrix." % no_folds
+    M = numpy.ones((I,J),dtype=bool) if M is None else numpy.array(M,dtype=bool)
+
+    indices = numpy.flatnonzero(M)
+    indices = indices[random_state(seed).permutation(len(indices))]
+
+    fold_labels = numpy.empty(I*J,dtype=numpy.int8)
+    fold_labels.fill(-1)
+    for fold,fold_indices in enumerate(numpy.array_split(indices,no_folds)):
+        fold_labels[fold_indices] = fold
+    return fold_labels.reshape((I,J))
 
 # Compute <no_folds> folds, returning a list of M's. If M is defined, we split
 # only the 1 entries into the folds.
-def compute_folds(I,J,no_folds,M=None):
-    if M is None:
-        M = numpy.ones((I,J))
-    else:
-        M = numpy.array(M)
-        
-    no_elements = sum([len([v for v in row if v]) for row in M])
-    indices = nonzero_indices(M)
-    
-    random.shuffle(indices)
-    
-    split_places = [int(i*no_elements/no_folds) for i in range(0,no_folds+1)] #find the indices where the next fold start
-    split_indices = [indices[split_places[i]:split_places[i+1]] for i in range(0,no_folds)] #split the indices list into the folds
-    
-    folds_M = [] #list of the M's for the different folds
-    for indices in split_indices:
-        M = numpy.zeros((I,J))
-        for i,j in indices:
-            M[i][j] = 1
-        folds_M.append(M)
-    return folds_M
-    
+def compute_folds(I,J,no_folds,M=None,seed=None):
+    fold_labels = compute_fold_labels(I,J,no_folds,M,seed)
+    return [fold_labels == fold for fold in range(0,no_folds)]
+
 # Take in the ten fold M's, and construct the masks M for the other nine folds
 def compute_Ms(folds_M):
-    no_folds = len(folds_M)
-    folds_M = [numpy.array(fold_M) for fold_M in folds_M]
-    return [sum(folds_M[:fold]+folds_M[fold+1:]) for fold in range(0,no_folds)]
+    folds_M = [numpy.array(fold_M,dtype=bool) for fold_M in folds_M]
+    all_M = numpy.logical_or.reduce(folds_M)
+    return [all_M & ~fold_M for fold_M in folds_M]
+
+# Return the training and test masks (M_train,M_test) of fold <fold> in the fold-label matrix
+def fold_Ms(fold_labels,fold):
+    return ((fold_labels >= 0) & (fold_labels != fold), fold_labels == fold)
+
+# Pack the boolean mask M into bits, eight entries per byte along each row, and
+# recover the I x J boolean mask from them.
+def pack_M(M):
+    return numpy.packbits(numpy.array(M,dtype=bool),axis=1)
+
+def unpack_M(packed_M,J):
+    return numpy.unpackbits(packed_M,axis=1)[:,:J].astype(bool)
 
 def calc_inverse_M(M):
-    (I,J) = numpy.array(M).shape
-    M_inv = numpy.ones([I,J])
-    for i in range(0,I):
-        for j in range(0,J):
-            if M[i][j] == 1:
-                M_inv[i][j] = 0
-    return M_inv
-    
+    return (numpy.array(M) != 1).astype(float)
+
 # Return a list of indices of all nonzero indices in M
 def nonzero_indices(M):
-    (I,J) = numpy.array(M).shape
-    return [(i,j) for i,j in itertools.product(range(0,I),range(0,J)) if M[i][j]]
-    
-# Return a list of lists, the ith list being of all indices j s.t. M[i,j] != 0
+    return zip(*numpy.nonzero(numpy.array(M)))
+
+# Return a list of arrays, the ith array being of all indices j s.t. M[i,j] != 0
 def nonzero_row_indices(M):
-    (I,J) = numpy.array(M).shape
-    return [[j for j,v in enumerate(row) if v] for row in M]
-    
+    M = numpy.array(M,dtype=bool)
+    (rows,columns) = numpy.nonzero(M)
+    return numpy.split(columns,numpy.cumsum(M.sum(axis=1))[:-1])
+
 def nonzero_column_indices(M):
-    M = numpy.array(M)
-    (I,J) = numpy.array(M).shape
-    return [[i for i,v in enumerate(column) if v] for column in M.T]
+    return nonzero_row_indices(numpy.array(M).T)
 
-# Return a list of tuples of the actual value vs the predicted value, for nonzero elements in M
+# Return a list of tuples of the actual value vs the predicted value, for zero elements in M
 def recover_predictions(M,X_true,X_pred):
-    (I,J) = numpy.array(M).shape
-    actual_vs_predicted = []
-    for i in range(0,I):
-        for j in range(0,J):
-            if M[i][j] == 0:
-                actual_vs_predicted.append((X_true[i][j],X_pred[i][j]))
-    return (actual_vs_predicted)
\ No newline at end of file
+    unknown = numpy.array(M) == 0
+    return zip(numpy.array(X_true)[unknown],numpy.array(X_pred)[unknown])
@@ -22,6 +22,17 @@ We expect the following arguments:
 - train_config, the additional parameters to pass to the train function (e.g. no. of iterations).
     This should be a dictionary mapping parameter names to values 
 - file_performance, the location and name of the file in which we store the performances.
+- file_results, optional (default None). The location and name of a results store
+    (see results_store.py), to which we append the performances of each fold as
+    it finishes. If the file already exists, the cross-validation is resumed:
+    the folds that are in it are not run again, and we append to 
+    <file_performance> rather than overwriting it.
+- seed, optional (default None). If given, each parameter setting gets its own
+    seed for its folds, and each fold its own seed for the model, spawned from 
+    this one (see mask.spawn_seeds). The seed of a fold is passed to the model as
+    train(seed=seed,**train_config), so the method should accept it. The results
+    are then reproducible, and do not depend on the order the folds are run in
+    (e.g. in parallel). If None, we use numpy's global random state.
 
 For each of the parameter configurations in <parameter_search>, we split the
 dataset <X> into <K> folds (considering only 1 entries in <M>), and thus form
@@ -29,6 +40,11 @@ our <K> training and test sets. Then for each we train the model using the
 parameters and training configuration <train_config>. The performances are 
 stored in <file_performance>
 
+If <file_results> is given, the folds of each parameter setting are generated
+from a seed that we store with its results, so that a resumed run uses the same
+folds. The best parameters are then found from the results in the store, using
+only the parameter settings for which all <K> folds are done.
+
 Methods:
 - Constructor - simply takes in the arguments requires
 - run - no arguments, runs the cross validation and stores the results in the file
@@ -38,18 +54,23 @@ Methods:
     Also logs these findings to the file.
 """
 
-import numpy, mask, json
+import numpy, mask, json, time
+from results_store import ResultsStore
 
 class MatrixCrossValidation:
-    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance):
+    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance,file_results=None,seed=None):
         self.method = method
         self.X = numpy.array(X,dtype=float)
         self.M = numpy.array(M)
         self.K = K
         self.train_config = train_config
         self.parameter_search = parameter_search
+        self.seed = seed
+        self.seeds = mask.spawn_seeds(seed,len(parameter_search))
         
-        self.fout = open(file_performance,'w')
+        # When resuming we append to the performances file rather than wiping its log
+        self.store = ResultsStore(file_results) if file_results is not None else None
+        self.fout = open(file_performance,'a' if self.store is not None and self.store.records else 'w')
         (self.I,self.J) = self.X.shape
         assert (self.X.shape == self.M.shape), "X and M are of different shapes: %s and %s respectively." % (self.X.shape,self.M.shape)
         
@@ -60,18 +81,27 @@ class MatrixCrossValidation:
         
     # Run the cross-validation
     def run(self):
-        for parameters in self.parameter_search:
+        for index,parameters in enumerate(self.parameter_search):
             print "Trying parameters %s." % (parameters)
             
             try:
-                folds_test = mask.compute_folds(self.I,self.J,self.K,self.M)
-                folds_training = mask.compute_Ms(folds_test)
+                seed = self.fold_seed(index)
+                model_seeds = self.model_seeds(seed)
+                fold_labels = mask.compute_fold_labels(self.I,self.J,self.K,self.M,seed)
+                completed = self.completed_folds(parameters)
                 
                 # We need to put the parameter dict into json to hash it
                 self.all_performances[self.JSON(parameters)] = {}
-                for i,(train,test) in enumerate(zip(folds_training,folds_test)):
-                    print "Fold %s (parameters: %s)." % (i+1,parameters)
-                    performance_dict = self.run_model(train,test,parameters)
+                for i in range(0,self.K):
+                    if i in completed:
+                        print "Fold %s (parameters: %s) already done." % (i+1,parameters)
+                        performance_dict = completed[i]
+                    else:
+                        print "Fold %s (parameters: %s)." % (i+1,parameters)
+                        (train,test) = mask.fold_Ms(fold_labels,i)
+                        start = time.time()
+                        performance_dict = self.run_model(train,test,parameters,model_seeds[i])
+                        self.add_to_store(parameters,i,seed,performance_dict,time.time()-start)
                     self.store_performances(performance_dict,parameters)
                     
                 self.log(parameters)
@@ -82,11 +112,42 @@ class MatrixCrossValidation:
             
             
     # Initialises and runs the model, and returns the performance on the test set
-    def run_model(self,train,test,parameters):
+    def run_model(self,train,test,parameters,seed=None):
         model = self.method(self.X,train,**parameters)
-        model.train(**self.train_config)
+        model.train(**self.seeded_train_config(seed))
         return model.predict(test)
         
+    # Return the train_config for a model with the given seed, which we only pass on if it is not None
+    def seeded_train_config(self,seed):
+        return dict(self.train_config,seed=seed) if seed is not None else self.train_config
+        
+    # Return the seed for the folds of the parameters with the given index in the search:
+    # the one in the results store, or else the one spawned from <seed>. With a store but 
+    # no seed we draw a new one, so that it can be stored; otherwise we return None, to 
+    # use numpy's random state.
+    def fold_seed(self,index):
+        seed = self.seeds[index]
+        if self.store is None:
+            return seed
+        stored_seed = self.store.seed(self.JSON(self.parameter_search[index]))
+        if stored_seed is not None:
+            return stored_seed
+        return seed if seed is not None else numpy.random.randint(0,2**31-1)
+        
+    # Return the seeds for the models of the K folds, spawned from the seed of the folds 
+    # (or Nones if we were not given a seed)
+    def model_seeds(self,fold_seed):
+        return mask.spawn_seeds(fold_seed if self.seed is not None else None,self.K)
+        
+    # Return a dictionary from the folds of the parameters in the results store to their performances
+    def completed_folds(self,parameters):
+        return self.store.completed(self.JSON(parameters)) if self.store is not None else {}
+        
+    # Add the performances of a fold to the results store, if we have one
+    def add_to_store(self,parameters,fold,seed,performance_dict,wall_time):
+        if self.store is not None:
+            self.store.add(self.JSON(parameters),fold,seed,performance_dict,wall_time)
+            
     # Returns the sorted json of the dictionary given
     def JSON(self,d):
         # Cannot handle numpy arrays so force all numpy arrays to be lists
@@ -118,14 +179,31 @@ class MatrixCrossValidation:
             else:
                 self.performances[name] = [avr_perf]
         
-    # Finds the parameter values of the best performance for the specified criterion
+    # Recompute the average performances from the results store, for the parameter
+    # settings for which all K folds are done
+    def load_performances(self):
+        (self.all_performances,self.average_performances,self.performances) = ({},{},{})
+        for parameters in self.parameter_search:
+            completed = self.completed_folds(parameters)
+            if len(completed) == self.K:
+                self.all_performances[self.JSON(parameters)] = {}
+                for fold in range(0,self.K):
+                    self.store_performances(completed[fold],parameters)
+                self.compute_average_performances(parameters)
+        
+    # Finds the parameter values of the best performance for the specified criterion,
+    # out of the parameter settings that did not fail
     def find_best_parameters(self,evaluation_criterion,low_better):
+        if self.store is not None:
+            self.load_performances()
+        
         min_or_max = min if low_better else max
-        self.best_performance = min_or_max(self.performances[evaluation_criterion])
-        index_best = self.performances[evaluation_criterion].index(self.best_performance)
+        candidates = [parameters for parameters in self.parameter_search if self.JSON(parameters) in self.average_performances]
+        self.best_parameters = min_or_max(candidates,key=lambda parameters: self.average_performances[self.JSON(parameters)][evaluation_criterion])
+        index_best = self.parameter_search.index(self.best_parameters)
         
-        self.best_parameters = self.parameter_search[index_best]
         self.best_performances_all = self.average_performances[self.JSON(self.best_parameters)]
+        self.best_performance = self.best_performances_all[evaluation_criterion]
         
         self.log_best(index_best)
         return (self.best_parameters,self.best_performance)
@@ -25,6 +25,15 @@ We expect the following arguments:
     overall performances of the nested cross-validations.
 - files_nested_performances, a list of K locations+names of the files in which
     we store the performances of the parameter search cross-validation.
+- parallel_outer, optional (default False). If True, we also run the outer folds
+    in parallel (see run_parallel_outer), using P threads in total.
+- seed, optional (default None). If given, we draw the outer folds from it, and
+    spawn a seed for the parameter search of each outer fold (see
+    MatrixCrossValidation) and for the model trained with its best parameters.
+    If None, we use numpy's global random state.
+- timeout, optional (default None). With parallel_outer, the number of seconds
+    we wait for the next training to finish before we give up with an error,
+    e.g. if the process running it was killed. If None, we wait as long as needed.
 
 We split the dataset <X> up into <K> folds (considering only 1 entries in <M>),
 thus forming our <K> training and test sets. Then for each we run the regular
@@ -34,6 +43,12 @@ The performances are stored in <file_performance>.
 
 We use the parallel matrix cross-validation module.
 
+If parallel_outer is True, we instead use a single pool of P threads for all
+trainings: the (outer fold, parameter, inner fold) trainings of all outer folds
+are queued at once, and as soon as the parameter search of an outer fold is
+done we queue the training of its final model with the best parameters. The
+outer folds then overlap, rather than each waiting for its slowest inner fold.
+
 Methods:
 - Constructor - simply takes in the arguments requires
 - run - no arguments, runs the cross validation and stores the results in the file
@@ -43,12 +58,21 @@ Methods:
     Also logs these findings to the file.
 """
 
-import numpy, mask
-from parallel_matrix_cross_validation import ParallelMatrixCrossValidation
+import numpy, mask, os, shutil, tempfile, time
+from parallel_matrix_cross_validation import ParallelMatrixCrossValidation, run_task
 from matrix_cross_validation import MatrixCrossValidation
+from multiprocessing import Pool
+
+# Number of seconds we wait for a training at a time, so that we can be interrupted
+POLL_INTERVAL = 0.1
+
+# Run a task of the nested cross-validation, returning (outer,index,fold,performances,error,wall time),
+# with outer the outer fold and index None for the training of the final model
+def run_nested_task(task):
+    return (task['outer'],) + run_task(task)
 
 class MatrixNestedCrossValidation:
-    def __init__(self,method,X,M,K,P,parameter_search,train_config,file_performance,files_nested_performances):
+    def __init__(self,method,X,M,K,P,parameter_search,train_config,file_performance,files_nested_performances,parallel_outer=False,seed=None,timeout=None):
         self.method = method
         self.X = numpy.array(X,dtype=float)
         self.M = numpy.array(M)
@@ -57,6 +81,13 @@ class MatrixNestedCrossValidation:
         self.train_config = train_config
         self.parameter_search = parameter_search
         self.files_nested_performances = files_nested_performances        
+        self.parallel_outer = parallel_outer
+        self.timeout = timeout
+        
+        # Seeds for the outer folds, and the parameter search and final model of each outer fold
+        seeds = mask.spawn_seeds(seed,2*self.K+1)
+        self.seed = seeds[0]
+        (self.crossval_seeds,self.model_seeds) = (seeds[1:self.K+1],seeds[self.K+1:])
         
         self.fout = open(file_performance,'w')
         (self.I,self.J) = self.X.shape
@@ -68,7 +99,10 @@ class MatrixNestedCrossValidation:
         
     # Run the cross-validation
     def run(self):
-        folds_test = mask.compute_folds(self.I,self.J,self.K,self.M)
+        if self.parallel_outer:
+            return self.run_parallel_outer()
+            
+        folds_test = mask.compute_folds(self.I,self.J,self.K,self.M,self.seed)
         folds_training = mask.compute_Ms(folds_test)       
 
         for i,(train,test) in enumerate(zip(folds_training,folds_test)):
@@ -84,7 +118,8 @@ class MatrixNestedCrossValidation:
                 parameter_search=self.parameter_search,
                 train_config=self.train_config,
                 file_performance=self.files_nested_performances[i],
-                P=self.P
+                P=self.P,
+                seed=self.crossval_seeds[i]
             )
             crossval.run()
             (best_parameters,_) = crossval.find_best_parameters(evaluation_criterion='MSE',low_better=True)
@@ -92,19 +127,117 @@ class MatrixNestedCrossValidation:
             print "Best parameters for fold %s were %s." % (i+1,best_parameters)
             
             # Train the model and test the performance on the test set
-            performance_dict = self.run_model(train,test,best_parameters)
+            performance_dict = self.run_model(train,test,best_parameters,self.model_seeds[i])
             self.store_performances(performance_dict)
             print "Finished fold %s, with performances %s." % (i+1,performance_dict)            
             
         self.log()
             
             
+    # Run the outer folds in parallel, with all trainings on one pool of P threads
+    def run_parallel_outer(self):
+        folder = tempfile.mkdtemp()
+        pool = Pool(self.P)
+        try:
+            file_X = os.path.join(folder,'X.npy')
+            numpy.save(file_X,self.X)
+            file_fold_labels = os.path.join(folder,'fold_labels.npy')
+            fold_labels = mask.compute_fold_labels(self.I,self.J,self.K,self.M,self.seed)
+            numpy.save(file_fold_labels,fold_labels)
+            
+            # We keep the AsyncResults of the trainings, and take them as they finish, so that we can add tasks
+            pending = []
+            submit = lambda task: pending.append(pool.apply_async(run_nested_task,(task,)))
+            
+            # Once the parameter search of outer fold i is done, train its final model
+            def submit_final(i):
+                (best_parameters,_) = crossvals[i].find_best_parameters(evaluation_criterion='MSE',low_better=True)
+                print "Best parameters for fold %s were %s." % (i+1,best_parameters)
+                submit({
+                    'outer' : i,
+                    'index' : None,
+                    'parameters' : best_parameters,
+                    'fold' : i,
+                    'file_X' : file_X,
+                    'file_fold_labels' : file_fold_labels,
+                    'method' : self.method,
+                    'train_config' : self.seeded_train_config(self.model_seeds[i])
+                })
+            
+            crossvals = []
+            for i in range(0,self.K):
+                (train,_) = mask.fold_Ms(fold_labels,i)
+                crossval = ParallelMatrixCrossValidation(
+                    method=self.method,
+                    X=self.X,
+                    M=train,
+                    K=self.K,
+                    parameter_search=self.parameter_search,
+                    train_config=self.train_config,
+                    file_performance=self.files_nested_performances[i],
+                    P=self.P,
+                    seed=self.crossval_seeds[i]
+                )
+                folder_fold = os.path.join(folder,'fold_%s' % i)
+                os.mkdir(folder_fold)
+                for task in crossval.create_tasks(folder_fold,file_X):
+                    submit(dict(task,outer=i))
+                crossvals.append(crossval)
+                if crossval.finished():
+                    submit_final(i)
+            
+            performances = [None for i in range(0,self.K)]
+            while None in performances:
+                (i,index,fold,performance_dict,error,wall_time) = self.next_result(pending)
+                if index is None:
+                    # The final model of outer fold i is done
+                    if error is not None:
+                        raise Exception("Training the model of fold %s failed: %s." % (i+1,error))
+                    performances[i] = performance_dict
+                    print "Finished fold %s, with performances %s." % (i+1,performance_dict)
+                    continue
+                
+                crossvals[i].add_result(index,fold,performance_dict,error,wall_time)
+                if crossvals[i].finished():
+                    submit_final(i)
+            
+            for performance_dict in performances:
+                self.store_performances(performance_dict)
+            self.log()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(folder)
+            
+            
+    # Wait for the first of the pending AsyncResults to finish, remove it, and return its
+    # value - raising the error if its task failed in the pool (e.g. it could not be pickled).
+    # We wait in short intervals so that Ctrl-C still works, and give up after self.timeout.
+    def next_result(self,pending):
+        start = time.time()
+        while True:
+            for result in pending:
+                if result.ready():
+                    pending.remove(result)
+                    return result.get()
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise Exception("No training finished within %s seconds, a process may have been killed." % self.timeout)
+            pending[0].wait(POLL_INTERVAL)
+            
+            
     # Initialises and runs the model, and returns the performance on the test set
-    def run_model(self,train,test,parameters):  
+    def run_model(self,train,test,parameters,seed=None):  
         model = self.method(self.X,train,**parameters)
-        model.train(**self.train_config)
+        model.train(**self.seeded_train_config(seed))
         return model.predict(test)
         
+    # Return the train_config for a model with the given seed, which we only pass on if it is not None
+    def seeded_train_config(self,seed):
+        return dict(self.train_config,seed=seed) if seed is not None else self.train_config
+        
     # Store the performances we get back in a dictionary from criterion name to a list of performances
     def store_performances(self,performance_dict):
         for name in performance_dict:
@@ -1,23 +1,56 @@
 """
 Parallel version of the MatrixCrossValidation class, where we parallelize
-the K-fold cross-validation for each parameter.
+the K-fold cross-validation over all parameters.
 We now have an extra parameter P for the initialisation, defining the number
 of parallel threads we should run.
+
+We use a single pool of P threads for the whole search, and give it one task
+per (parameter, fold) pair, so that the folds of different parameter settings
+run at the same time. The results are collected as they complete (using
+imap_unordered), and each parameter setting is logged once all its folds
+are done, in the order of <parameter_search>.
+
+Rather than sending the data matrix and the training and test masks of each
+fold to the threads, we store the data matrix X and the fold-label matrix (see
+mask.compute_fold_labels) as .npy files in a temporary folder, which each
+thread memory-maps. Only the file names, the fold number and the parameters
+are then sent to the threads. The folder is created using the tempfile module
+(so in TMPDIR if it is set), and removed at the end of run().
+
+If a seed is given (see MatrixCrossValidation), each task gets its own seeds for
+its folds and model, so the results do not depend on which thread runs which
+task, or in what order.
+
+If a results store <file_results> is given (see MatrixCrossValidation), the
+folds that are already in it are not sent to the threads, and the others are
+added to it as they come in, with the wall time of the thread.
 """
 
-import numpy, mask, json
+import numpy, mask, json, os, shutil, tempfile, time
 from matrix_cross_validation import MatrixCrossValidation
 from multiprocessing import Pool
 
 
 # We try the parameters in parallel. This function either raises an Exception,
-# or returns a tuple (parameters,all_performances,average_performances)
+# or returns the performances on the test set of the fold
 def run_fold(params):
-    (parameters,X,train,test,method,train_config) = \
-        (params['parameters'],params['X'],params['train'],params['test'],params['method'],params['train_config'])    
+    (parameters,fold,file_X,file_fold_labels,method,train_config) = \
+        (params['parameters'],params['fold'],params['file_X'],params['file_fold_labels'],params['method'],params['train_config'])
+    X = numpy.load(file_X,mmap_mode='r')
+    fold_labels = numpy.load(file_fold_labels,mmap_mode='r')
+    (train,test) = mask.fold_Ms(fold_labels,fold)
     performance_dict = run_model(method,X,train,test,parameters,train_config)
-    return performance_dict           
-    
+    return performance_dict
+
+# Run the fold of a task, returning (index,fold,performances,None,wall time), with index 
+# the index of the parameters in the search, or (index,fold,None,message,wall time) if it failed
+def run_task(task):
+    start = time.time()
+    try:
+        return (task['index'],task['fold'],run_fold(task),None,time.time()-start)
+    except Exception as e:
+        return (task['index'],task['fold'],None,str(e),time.time()-start)
+
 # Method for running the model with the given parameters
 def run_model(method,X,train,test,parameters,train_config):
     model = method(X,train,**parameters)
@@ -26,45 +59,93 @@ def run_model(method,X,train,test,parameters,train_config):
 
 # Class, redefining the run function
 class ParallelMatrixCrossValidation(MatrixCrossValidation):
-    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance,P):
-        MatrixCrossValidation.__init__(self,method,X,M,K,parameter_search,train_config,file_performance)
-        self.P = P        
-        
+    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance,P,file_results=None,seed=None):
+        MatrixCrossValidation.__init__(self,method,X,M,K,parameter_search,train_config,file_performance,file_results,seed)
+        self.P = P
+
     # Run the cross-validation
     def run(self):
-        for parameters in self.parameter_search:
+        folder = tempfile.mkdtemp()
+        pool = Pool(self.P)
+        try:
+            file_X = os.path.join(folder,'X.npy')
+            numpy.save(file_X,self.X)
+            tasks = self.create_tasks(folder,file_X)
+            for (index,fold,performance_dict,error,wall_time) in pool.imap_unordered(run_task,tasks):
+                self.add_result(index,fold,performance_dict,error,wall_time)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(folder)
+            
+    # Compute the folds for each parameter setting, storing them in <folder>, and return 
+    # the list of (parameter, fold) tasks for run_task. Folds in the results store are 
+    # added straight away rather than returned as tasks.
+    def create_tasks(self,folder,file_X):
+        self.remaining = [self.K for parameters in self.parameter_search]
+        self.errors = [None for parameters in self.parameter_search]
+        self.fold_seeds = [self.fold_seed(index) for index in range(0,len(self.parameter_search))]
+        self.next_index = 0
+        
+        tasks = []
+        for index,parameters in enumerate(self.parameter_search):
             print "Trying parameters %s." % (parameters)
+            file_fold_labels = os.path.join(folder,'fold_labels_%s.npy' % index)
+            numpy.save(file_fold_labels,mask.compute_fold_labels(self.I,self.J,self.K,self.M,self.fold_seeds[index]))
+            model_seeds = self.model_seeds(self.fold_seeds[index])
+            completed = self.completed_folds(parameters)
+            
+            # We need to put the parameter dict into json to hash it
+            self.all_performances[self.JSON(parameters)] = {}
+            for fold in sorted(completed):
+                print "Fold %s (parameters: %s) already done." % (fold+1,parameters)
+                self.store_performances(completed[fold],parameters)
+                self.remaining[index] -= 1
+            tasks.extend([
+                {
+                    'index' : index,
+                    'parameters' : parameters,
+                    'fold' : fold,
+                    'file_X' : file_X,
+                    'file_fold_labels' : file_fold_labels,
+                    'method' : self.method,
+                    'train_config' : self.seeded_train_config(model_seeds[fold])
+                }
+                for fold in range(0,self.K) if fold not in completed
+            ])
+        self.log_finished()
+        return tasks
             
-            try:
-                folds_test = mask.compute_folds(self.I,self.J,self.K,self.M)
-                folds_training = mask.compute_Ms(folds_test)
-                
-                # We need to put the parameter dict into json to hash it
-                self.all_performances[self.JSON(parameters)] = {}
-                
-                # Create the threads for the folds, and run them
-                pool = Pool(self.P)
-                all_parameters = [
-                    {
-                        'parameters' : parameters,
-                        'X' : numpy.copy(self.X),
-                        'train' : train,
-                        'test' : test,
-                        'method' : self.method,
-                        'train_config' : self.train_config                
-                    }
-                    for (train,test) in zip(folds_training,folds_test)
-                ]
-                outputs = pool.map(run_fold,all_parameters)
-                
-                for performance_dict in outputs:
-                    self.store_performances(performance_dict,parameters)
-                    
-                self.log(parameters)
-                
-            except Exception as e:
-                self.fout.write("Tried parameters %s but got exception: %s. \n" % (parameters,e))
-                
+    # Store the result of a task as it comes in, and log each parameter setting 
+    # (in the order of the search) once all its folds are done
+    def add_result(self,index,fold,performance_dict,error,wall_time):
+        parameters = self.parameter_search[index]
+        self.remaining[index] -= 1
+        if error is None:
+            print "Finished fold %s (parameters: %s)." % (fold+1,parameters)
+            self.store_performances(performance_dict,parameters)
+            self.add_to_store(parameters,fold,self.fold_seeds[index],performance_dict,wall_time)
+        elif self.errors[index] is None:
+            self.errors[index] = error
+        self.log_finished()
+            
+    # Log the parameter settings whose folds are all done, in the order of the search
+    def log_finished(self):
+        while not self.finished() and self.remaining[self.next_index] == 0:
+            if self.errors[self.next_index] is None:
+                self.log(self.parameter_search[self.next_index])
+            else:
+                self.fout.write("Tried parameters %s but got exception: %s. \n" % (self.parameter_search[self.next_index],self.errors[self.next_index]))
+                self.fout.flush()
+            self.next_index += 1
+            
+    # Return True if all parameter settings have been logged
+    def finished(self):
+        return self.next_index == len(self.parameter_search)
+
     # Undo the function run_model:
     def run_model(self,train,test,parameters):
-        raise Exception("Using wrong method for ParallelMatrixCrossValidation! Use the one defined outside of the class.")
\ No newline at end of file
+        raise Exception("Using wrong method for ParallelMatrixCrossValidation! Use the one defined outside of the class.")
@@ -0,0 +1,60 @@
+"""
+Class storing the results of a cross-validation as it runs, so that it can be
+resumed after a crash without recomputing the folds that had finished.
+
+The results are appended to a file with one JSON record per line, written as
+soon as a fold finishes:
+    { 'hash' : <SHA-1 of the JSON of the parameters>, 'parameters' : <JSON of the parameters>,
+      'fold' : <fold index>, 'seed' : <seed of the folds>, 'performances' : {<metric> : <value>},
+      'time' : <wall time of the fold in seconds> }
+If the file already exists we read the records in it, so a cross-validation can
+skip the (parameters, fold) pairs that are already done. The folds of a parameter
+setting are generated from its seed, so that on restart we use the same folds.
+
+Usage:
+    store = ResultsStore('results.jsonl')
+    store.add(parameters,fold,seed,performances,time)
+    store.completed(parameters) -> { fold : performances }
+    store.seed(parameters)      -> seed of the folds, or None if there are no records
+"""
+
+import json, hashlib, os
+
+class ResultsStore:
+    def __init__(self,filename):
+        self.filename = filename
+        self.records = {}   # Map from parameter hash to a map from fold to record
+        if os.path.exists(filename):
+            for line in open(filename,'r'):
+                # Skip a final line that was only partially written
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.records.setdefault(record['hash'],{})[record['fold']] = record
+        self.fout = open(filename,'a')
+
+
+    # Return the hash identifying the JSON of the parameters
+    def hash(self,parameters):
+        return hashlib.sha1(parameters).hexdigest()
+
+    # Add the result of a fold, and write it to the file straight away
+    def add(self,parameters,fold,seed,performances,time):
+        record = { 'hash' : self.hash(parameters), 'parameters' : parameters, 'fold' : fold,
+                   'seed' : seed, 'performances' : performances, 'time' : time }
+        self.records.setdefault(record['hash'],{})[fold] = record
+        self.fout.write(json.dumps(record,sort_keys=True)+"\n")
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+
+
+    # Return a map from the completed folds of the parameters to their performances
+    def completed(self,parameters):
+        records = self.records.get(self.hash(parameters),{})
+        return { fold : record['performances'] for (fold,record) in records.items() }
+
+    # Return the seed used for the folds of the parameters, or None if there are no records
+    def seed(self,parameters):
+        records = self.records.get(self.hash(parameters),{})
+        return records.values()[0]['seed'] if records else None
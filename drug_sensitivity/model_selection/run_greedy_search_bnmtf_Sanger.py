@@ -10,6 +10,7 @@ from BNMTF.code.bnmtf_vb_optimised import bnmtf_vb_optimised
 from ml_helpers.code.mask import compute_Ms, compute_folds
 from load_data import load_Sanger
 from BNMTF.grid_search.greedy_search_bnmtf import GreedySearch
+from BNMTF.code.fit_cache import FitCache
 
 import numpy, matplotlib.pyplot as plt
 import scipy.interpolate
@@ -21,6 +22,8 @@ no_folds = 5
 
 restarts = 5
 iterations = 1000
+seed = 0
+folder_fit_cache = "./fit_cache/" # reuse the fits of previous runs, e.g. after changing the plots
 I, J = 622,139
 values_K = range(1,30+1)
 values_L = range(1,30+1)
@@ -47,7 +50,7 @@ folds_training = compute_Ms(folds_test)
 
 # Run the line search
 priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
-greedy_search = GreedySearch(classifier,values_K,values_L,X_min,M,priors,initS,initFG,iterations,restarts=restarts)
+greedy_search = GreedySearch(classifier,values_K,values_L,X_min,M,priors,initS,initFG,iterations,restarts=restarts,seed=seed,cache=FitCache(folder_fit_cache))
 greedy_search.search(search_metric)
 
 # Plot the performances of all metrics
@@ -10,6 +10,7 @@ from BNMTF.code.bnmtf_vb_optimised import bnmtf_vb_optimised
 from ml_helpers.code.mask import compute_Ms, compute_folds
 from load_data import load_Sanger
 from BNMTF.grid_search.grid_search_bnmtf import GridSearch
+from BNMTF.code.fit_cache import FitCache
 
 import numpy, matplotlib.pyplot as plt
 import scipy.interpolate
@@ -21,6 +22,8 @@ no_folds = 5
 
 restarts = 1
 iterations = 1000
+seed = 0
+folder_fit_cache = "./fit_cache/" # reuse the fits of previous runs, e.g. after changing the plots
 I, J = 622,139
 values_K = range(1,10+1)
 values_L = range(1,10+1)
@@ -45,7 +48,7 @@ folds_training = compute_Ms(folds_test)
 
 # Run the line search
 priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
-grid_search = GridSearch(classifier,values_K,values_L,X_min,M,priors,initS,initFG,iterations,restarts=restarts)
+grid_search = GridSearch(classifier,values_K,values_L,X_min,M,priors,initS,initFG,iterations,restarts=restarts,seed=seed,cache=FitCache(folder_fit_cache))
 grid_search.search()
 
 # Plot the performances of all metrics
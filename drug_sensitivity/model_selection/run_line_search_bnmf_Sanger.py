@@ -10,6 +10,7 @@ from BNMTF.code.bnmf_vb_optimised import bnmf_vb_optimised
 from ml_helpers.code.mask import compute_Ms, compute_folds
 from load_data import load_Sanger
 from BNMTF.grid_search.line_search_bnmf import LineSearch
+from BNMTF.code.fit_cache import FitCache
 
 import numpy, matplotlib.pyplot as plt
 
@@ -20,6 +21,8 @@ no_folds = 5
 
 restarts = 5
 iterations = 1000
+seed = 0
+folder_fit_cache = "./fit_cache/" # reuse the fits of previous runs, e.g. after changing the plots
 I, J = 622,139
 values_K = range(31,35+1)
 
@@ -41,7 +44,7 @@ folds_training = compute_Ms(folds_test)
 
 # Run the line search
 priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
-line_search = LineSearch(classifier,values_K,X_min,M,priors,initUV,iterations,restarts=restarts)
+line_search = LineSearch(classifier,values_K,X_min,M,priors,initUV,iterations,restarts=restarts,seed=seed,cache=FitCache(folder_fit_cache))
 line_search.search()
 
 # Plot the performances of all four metrics
@@ -18,7 +18,7 @@ project_location = "/home/tab43/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-from BNMTF.code.distributions.exponential import exponential_draw
+from BNMTF.code.distributions.exponential import exponential_vector_draw
 from BNMTF.code.distributions.normal import normal_draw
 from ml_helpers.code.mask import generate_M
 
@@ -26,12 +26,8 @@ import numpy, itertools, matplotlib.pyplot as plt
 
 def generate_dataset(I,J,K,lambdaU,lambdaV,tau):
     # Generate U, V
-    U = numpy.zeros((I,K))
-    for i,k in itertools.product(xrange(0,I),xrange(0,K)):
-        U[i,k] = exponential_draw(lambdaU[i,k])
-    V = numpy.zeros((J,K))
-    for j,k in itertools.product(xrange(0,J),xrange(0,K)):
-        V[j,k] = exponential_draw(lambdaV[j,k])
+    U = exponential_vector_draw(lambdaU)
+    V = exponential_vector_draw(lambdaV)
     
     # Generate R
     true_R = numpy.dot(U,V.T)
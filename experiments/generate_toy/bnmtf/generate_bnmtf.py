@@ -19,7 +19,7 @@ project_location = "/home/tab43/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-from BNMTF.code.distributions.exponential import exponential_draw
+from BNMTF.code.distributions.exponential import exponential_vector_draw
 from BNMTF.code.distributions.normal import normal_draw
 from ml_helpers.code.mask import generate_M
 
@@ -27,15 +27,9 @@ import numpy, itertools, matplotlib.pyplot as plt
 
 def generate_dataset(I,J,K,L,lambdaF,lambdaS,lambdaG,tau):
     # Generate U, V
-    F = numpy.zeros((I,K))
-    for i,k in itertools.product(xrange(0,I),xrange(0,K)):
-        F[i,k] = exponential_draw(lambdaF[i,k])
-    S = numpy.zeros((K,L))
-    for k,l in itertools.product(xrange(0,K),xrange(0,L)):
-        S[k,l] = exponential_draw(lambdaS[k,l])
-    G = numpy.zeros((J,L))
-    for j,l in itertools.product(xrange(0,J),xrange(0,L)):
-        G[j,l] = exponential_draw(lambdaG[j,l])
+    F = exponential_vector_draw(lambdaF)
+    S = exponential_vector_draw(lambdaS)
+    G = exponential_vector_draw(lambdaG)
     
     # Generate R
     true_R = numpy.dot(F,numpy.dot(S,G.T))
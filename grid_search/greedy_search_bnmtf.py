@@ -11,7 +11,9 @@ We expect the following arguments:
 - classifier    - a class for BNMTF, with methods: 
                     __init__(R,M,K,L,priors), 
                     initialise(init_S,init_FG), 
+                    initialise_warm(model,warm_start,seed) - if warm_start is given
                     run(iterations), 
+                    run(iterations,resume=True)         - if halving is given
                     quality(metric)         - metric in ['AIC','BIC','loglikelihood','MSE']
                     or quality(metric,burn_in,thinning) for Gibbs
 - values_K      - a list of values for K
@@ -26,6 +28,39 @@ We expect the following arguments:
 - iterations    - number of iterations to run 
 - restarts      - we run the classifier this many times and use the one with 
                   the highest log likelihood
+- seed          - optional (default None). Each restart for each K and L is 
+                  initialised with its own seed, spawned from this one (see 
+                  code/random_state.py), so that the search is reproducible and 
+                  the runs do not depend on each other or on the order they are 
+                  done in. If None, we use numpy's global random state.
+- P             - optional (default 1). The number of processes to train the 
+                  models in. If P > 1, we train the restarts in parallel, and
+                  try the neighbouring values of K and L at the same time.
+- warm_start    - optional (default None). If 'split' or 'prior', each K and L 
+                  is initialised from the best fit we tried with the most factors
+                  that has at most K and L (and fewer of either), such as the 
+                  current values when we try their neighbours, using 
+                  initialise_warm(model,warm_start,seed) (see code/warm_start.py),
+                  rather than from scratch. Only for P = 1, as the fits then 
+                  depend on each other.
+- warm_iterations - optional (default <iterations>). The number of iterations to
+                  run for the warm started models, which need fewer to converge.
+- halving       - optional (default None). A SuccessiveHalving (see 
+                  successive_halving.py). If given, at each step we first train
+                  the (up to three) neighbouring values for a few iterations, and
+                  only continue training the best ones by search_metric, until 
+                  they reach <iterations>. The eliminated values are not stored 
+                  in all_values, and we do not step to them. If we need them 
+                  again in a later step, they are trained again. Only for P = 1,
+                  and cannot be combined with warm_start.
+- cache         - optional (default None). A FitCache (see code/fit_cache.py). If
+                  given, each seeded restart is first looked up in the cache, and
+                  only trained (and added to the cache) if it is not there yet, so
+                  that rerunning the search reuses the fits of the previous runs.
+                  With P > 1 the processes look up and add the fits. Needs a seed,
+                  and cannot be combined with warm_start or halving, as those fits
+                  depend on the other fits. The keys are the same as in GridSearch,
+                  so with the same seed and values of K and L the two share fits.
 
 The greedy grid search can be started by running search(search_metric), where 
 we stop searching after our specified metric's performance drops.
@@ -38,19 +73,54 @@ returned using best_value(metric).
 
 all_values(metric) returns a list of tuples detailing the performances: (K,L,metric).
 
+With P > 1 each restart of each K and L is a task on a pool of P processes, which
+memory-map R and M from .npy files in a temporary folder (as in GridSearch), and
+return only the quality of the model for each metric. At each step we submit the 
+(up to three) neighbouring values together, and if there are processes to spare,
+also the values we may try in the step after (speculatively). Once we know which
+step we take, the speculative tasks that are no longer needed are cancelled: tasks
+that have not started yet then return straight away, and the results of the others
+are ignored. At the end we stop the pool, also stopping any remaining speculative
+tasks. With a seed the search takes the same steps and gives the same performances
+as without P.
+
 We use the optimised Variational Bayes algorithm for BNMTF.
 """
 
 project_location = "/home/tab43/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
+from BNMTF.code.random_state import spawn_seeds
 
-import numpy
+import numpy, itertools, os, shutil, tempfile
+from multiprocessing import Pool, Manager
 
 metrics = ['BIC','AIC','loglikelihood','MSE','ELBO']
 
+
+# Train the model of a (K,L,restart) task on the dataset stored in the .npy files, and 
+# return its quality for each metric, or None if the task was cancelled before it started.
+# Each submission of a (K,L) has its own token, so that resubmitting it does not revive 
+# the cancelled tasks of an earlier submission that are still queued.
+# If the task has a key, we use the fit cache instead if it has the fit, or add it to it.
+def run_restart(task):
+    if task['cancelled'].get(task['token']):
+        return None
+    record = task['cache'].get(task['key']) if task['key'] is not None else None
+    if record is not None:
+        return record['qualities']
+    R = numpy.load(task['file_R'],mmap_mode='r')
+    M = numpy.load(task['file_M'],mmap_mode='r')
+    BNMTF = task['classifier'](R,M,task['K'],task['L'],task['priors'])
+    BNMTF.initialise(init_S=task['initS'],init_FG=task['initFG'],seed=task['seed'])
+    BNMTF.run(**task['run_args'])
+    qualities = { metric : BNMTF.quality(metric,**task['quality_args']) for metric in metrics }
+    if task['key'] is not None:
+        task['cache'].add(task['key'],BNMTF,qualities,quality_args=task['quality_args'])
+    return qualities
+
 class GreedySearch:
-    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1):
+    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1,seed=None,P=1,warm_start=None,warm_iterations=None,halving=None,cache=None):
         self.classifier = classifier
         self.values_K = values_K
         self.values_L = values_L
@@ -62,7 +132,19 @@ class GreedySearch:
         self.initFG = initFG
         self.iterations = iterations
         self.restarts = restarts
-        assert self.restarts > 0, "Need at least 1 restart."        
+        self.P = P
+        self.warm_start = warm_start
+        self.warm_iterations = warm_iterations if warm_iterations is not None else iterations
+        self.halving = halving
+        self.cache = cache
+        assert self.restarts > 0, "Need at least 1 restart."
+        assert self.warm_start is None or self.P == 1, "Warm starts are only supported for P = 1."
+        assert self.halving is None or self.P == 1, "Successive halving is only supported for P = 1."
+        assert self.warm_start is None or self.halving is None, "Warm starts and successive halving cannot be combined."
+        assert self.cache is None or (self.warm_start is None and self.halving is None), "The fit cache cannot be combined with warm starts or successive halving."
+        
+        values_KL = list(itertools.product(self.values_K,self.values_L))
+        self.seeds = { KL : spawn_seeds(seed_KL,self.restarts) for (KL,seed_KL) in zip(values_KL,spawn_seeds(seed,len(values_KL))) }        
         
         self.all_performances = {
             metric : []
@@ -73,6 +155,22 @@ class GreedySearch:
     def search(self,search_metric,burn_in=None,thinning=None,minimum_TN=None):
         assert search_metric in metrics, "Unrecognised metric name: %s." % search_metric    
         
+        self.run_args = {'iterations':self.iterations} if minimum_TN is None else {'iterations':self.iterations,'minimum_TN':minimum_TN}
+        self.quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        self.fits = {}  # Best fits of the values we tried, to warm start from
+        self.halved = {}  # Qualities of the values trained by the successive halving, or None if eliminated
+        if self.P == 1:
+            return self.greedy_search(search_metric)
+        
+        self.start_pool()
+        try:
+            self.greedy_search(search_metric)
+        finally:
+            self.stop_pool()
+            
+            
+    # Do the greedy search, using train_KL or train_KL_parallel to get the qualities of each K and L
+    def greedy_search(self,search_metric):
         def try_KL(K,L):
             # First see if we already tried this combination     
             existing = self.find_KL(search_metric,K,L)
@@ -82,46 +180,27 @@ class GreedySearch:
             
             # Otherwise, we try it
             print "Running line search for BNMF. Trying K = %s, L = %s." % (K,L)
-            
-            priors = self.priors.copy()
-            priors['lambdaF'] = self.priors['lambdaF']*numpy.ones((self.I,K))
-            priors['lambdaS'] = self.priors['lambdaS']*numpy.ones((K,L))
-            priors['lambdaG'] = self.priors['lambdaG']*numpy.ones((self.J,L))
-            
-            best_BNMTF = None
-            for r in range(0,self.restarts):
-                print "Restart %s for K = %s, L = %s." % (r+1,K,L)  
-                BNMTF = self.classifier(self.R,self.M,K,L,priors)
-                BNMTF.initialise(init_S=self.initS,init_FG=self.initFG)
-                if minimum_TN is None:
-                    BNMTF.run(iterations=self.iterations)
-                else:
-                    BNMTF.run(iterations=self.iterations,minimum_TN=minimum_TN)
-                
-                args = {'metric':'loglikelihood'}
-                if burn_in is not None and thinning is not None:
-                    args['burn_in'], args['thinning'] = burn_in, thinning
-                
-                if best_BNMTF is None or BNMTF.quality(**args) > best_BNMTF.quality(**args):
-                    best_BNMTF = BNMTF
-            
+            qualities = self.train_KL(K,L) if self.P == 1 else self.train_KL_parallel(K,L)
+            if qualities is None:
+                print "K = %s, L = %s was eliminated by the successive halving." % (K,L)
+                return float('inf')
             for metric in metrics:
-                if burn_in is not None and thinning is not None:
-                    quality = best_BNMTF.quality(metric,burn_in,thinning)
-                else:
-                    quality = best_BNMTF.quality(metric)
-                self.all_performances[metric].append((K,L,quality))
+                self.all_performances[metric].append((K,L,qualities[metric]))
                 
             return self.all_performances[search_metric][-1][2] # return the quality of the last appended value (K,L,quality)
             
         # Get the initial starting point
         ik, il = 0, 0 #current indices for values of K and L
         current_K, current_L = self.values_K[ik], self.values_L[il]
+        self.prefetch([(current_K,current_L)],list(itertools.product(self.values_K[:2],self.values_L[:2]))[1:])
         performance_so_far = try_KL(current_K,current_L)
         
         while ik < len(self.values_K)-1 and il < len(self.values_L)-1: 
             print "Currently at K = %s, L = %s." % (current_K,current_L)
             new_K, new_L = self.values_K[ik+1], self.values_L[il+1]
+            neighbours = [(new_K,current_L),(current_K,new_L),(new_K,new_L)]
+            self.prefetch(neighbours,self.next_neighbours(ik,il))
+            self.halve(neighbours,search_metric)
             performance_new_K = try_KL(new_K,current_L)
             performance_new_L = try_KL(current_K,new_L)
             performance_new_KL = try_KL(new_K,new_L)
@@ -152,6 +231,7 @@ class GreedySearch:
             while il < len(self.values_L)-1:
                 print "Currently at K = %s, L = %s." % (current_K,current_L)
                 new_L = self.values_L[il+1]
+                self.prefetch([(current_K,new_L)],[(current_K,L) for L in self.values_L[il+2:il+3]])
                 performance_new_L = try_KL(current_K,new_L)
                 if performance_so_far < performance_new_L:
                     break
@@ -165,6 +245,7 @@ class GreedySearch:
             while ik < len(self.values_K)-1:
                 print "Currently at K = %s, L = %s." % (current_K,current_L)
                 new_K = self.values_K[ik+1]
+                self.prefetch([(new_K,current_L)],[(K,current_L) for K in self.values_K[ik+2:ik+3]])
                 performance_new_K = try_KL(new_K,current_L)
                 if performance_so_far < performance_new_K:
                     break
@@ -175,6 +256,180 @@ class GreedySearch:
                     performance_so_far = performance_new_L
                 
         print "Finished running line search for BNMF."
+        
+        
+    # Train the restarts for K and L one after another, and return the qualities of the
+    # one with the highest log likelihood
+    def train_KL(self,K,L):
+        if (K,L) in self.halved:
+            return self.halved.pop((K,L))
+        priors = self.priors_KL(K,L)
+        warm_BNMTF = self.warm_model(K,L)
+        (best_BNMTF,best_qualities) = (None,None)
+        for r in range(0,self.restarts):
+            print "Restart %s for K = %s, L = %s." % (r+1,K,L)  
+            key = self.fit_key(K,L,r)
+            record = self.cache.get(key) if key is not None else None
+            if record is not None:
+                print "Using the cached fit for restart %s for K = %s, L = %s." % (r+1,K,L)
+                (BNMTF,qualities) = (None,record['qualities'])
+            else:
+                BNMTF = self.classifier(self.R,self.M,K,L,priors)
+                if warm_BNMTF is not None:
+                    BNMTF.initialise_warm(warm_BNMTF,self.warm_start,seed=self.seeds[(K,L)][r])
+                    BNMTF.run(**dict(self.run_args,iterations=self.warm_iterations))
+                else:
+                    BNMTF.initialise(init_S=self.initS,init_FG=self.initFG,seed=self.seeds[(K,L)][r])
+                    BNMTF.run(**self.run_args)
+                
+                qualities = { metric : BNMTF.quality(metric,**self.quality_args) for metric in metrics }
+                if key is not None:
+                    self.cache.add(key,BNMTF,qualities,quality_args=self.quality_args)
+            
+            if best_qualities is None or qualities['loglikelihood'] > best_qualities['loglikelihood']:
+                (best_BNMTF,best_qualities) = (BNMTF,qualities)
+        if self.warm_start is not None:
+            self.fits[(K,L)] = best_BNMTF
+        return best_qualities
+        
+    # Wait for the restarts for K and L on the pool (submitting them if needed), and return
+    # the qualities of the first one with the highest log likelihood
+    def train_KL_parallel(self,K,L):
+        self.submit(K,L)
+        restarts = [result.get() for result in self.pending.pop((K,L))]
+        del self.tokens[(K,L)]
+        return max(restarts,key=lambda qualities: qualities['loglikelihood'])
+        
+        
+    # Train the values we need for this step that we did not try yet using successive halving (see 
+    # successive_halving.py), and store the qualities of the best restart of each in self.halved, 
+    # or None for the values that were eliminated
+    def halve(self,needed,search_metric):
+        candidates = [KL for KL in needed if not self.find_KL(metrics[0],KL[0],KL[1])]
+        if self.halving is None or len(candidates) < 2:
+            return
+        models = {}
+        
+        # Train the restarts for (K,L) for <iterations> more iterations, initialising them the first time
+        def train(KL,iterations):
+            (K,L) = KL
+            print "Running line search for BNMF. Training K = %s, L = %s for %s iterations." % (K,L,iterations)
+            resume = (K,L) in models
+            if not resume:
+                priors = self.priors_KL(K,L)
+                models[(K,L)] = [self.classifier(self.R,self.M,K,L,priors) for r in range(0,self.restarts)]
+                for r,BNMTF in enumerate(models[(K,L)]):
+                    BNMTF.initialise(init_S=self.initS,init_FG=self.initFG,seed=self.seeds[(K,L)][r])
+            for BNMTF in models[(K,L)]:
+                BNMTF.run(**dict(self.run_args,iterations=iterations,resume=resume))
+                
+        # Return the restart for (K,L) with the highest log likelihood
+        def best(KL):
+            return max(models[KL],key=lambda BNMTF: BNMTF.quality('loglikelihood',**self.quality_args))
+            
+        # Store the qualities of (K,L) if it was trained for all iterations
+        def finish(KL,iterations):
+            self.halved[KL] = { metric : best(KL).quality(metric,**self.quality_args) for metric in metrics } if iterations == self.iterations else None
+            del models[KL]
+            
+        self.halving.run(candidates,train,lambda KL: best(KL).quality(search_metric,**self.quality_args),self.iterations,finish)
+        
+        
+    # Start the pool of P processes, storing R and M in a temporary folder
+    def start_pool(self):
+        self.folder = tempfile.mkdtemp()
+        (self.file_R,self.file_M) = (os.path.join(self.folder,'R.npy'),os.path.join(self.folder,'M.npy'))
+        numpy.save(self.file_R,self.R)
+        numpy.save(self.file_M,self.M)
+        
+        self.manager = Manager()
+        self.cancelled = self.manager.dict()    # Map from the token (K,L,submission) of a submission to True if its tasks are cancelled
+        self.pending = {}                       # Map from (K,L) to the AsyncResults of its restarts
+        self.tokens = {}                        # Map from (K,L) to the token of its pending submission
+        self.submissions = 0                    # Number of submissions so far, to make each token unique
+        self.pool = Pool(self.P)
+        
+    # Stop the pool, including any remaining speculative tasks, and remove the folder
+    def stop_pool(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.manager.shutdown()
+        shutil.rmtree(self.folder)
+        
+    # Submit the restarts for K and L to the pool, unless we already tried or submitted them
+    def submit(self,K,L):
+        if (K,L) in self.pending or self.find_KL(metrics[0],K,L):
+            return
+        token = (K,L,self.submissions)
+        self.submissions += 1
+        self.tokens[(K,L)] = token
+        self.cancelled[token] = False
+        priors = self.priors_KL(K,L)
+        self.pending[(K,L)] = [
+            self.pool.apply_async(run_restart,({
+                'K' : K, 'L' : L,
+                'classifier' : self.classifier,
+                'file_R' : self.file_R,
+                'file_M' : self.file_M,
+                'priors' : priors,
+                'initS' : self.initS,
+                'initFG' : self.initFG,
+                'seed' : seed if seed is not None else numpy.random.randint(0,2**31-1),
+                'run_args' : self.run_args,
+                'quality_args' : self.quality_args,
+                'cancelled' : self.cancelled,
+                'token' : token,
+                'cache' : self.cache,
+                'key' : self.fit_key(K,L,r)
+            },))
+            for r,seed in enumerate(self.seeds[(K,L)])
+        ]
+        
+    # Submit the (K,L) values we need for this step, and the speculative ones for the next
+    # step while there are processes to spare. Cancel the unfinished ones we no longer need.
+    def prefetch(self,needed,speculative):
+        if self.P == 1:
+            return
+        for KL in self.pending.keys():
+            if KL not in needed and KL not in speculative and not all([result.ready() for result in self.pending[KL]]):
+                self.cancelled[self.tokens.pop(KL)] = True
+                del self.pending[KL]
+        for (K,L) in needed:
+            self.submit(K,L)
+        for (K,L) in speculative:
+            running = sum([not result.ready() for results in self.pending.values() for result in results])
+            if running + self.restarts > self.P:
+                break
+            self.submit(K,L)
+            
+    # Return the (K,L) values we may try in the step after the one from (ik,il)
+    def next_neighbours(self,ik,il):
+        steps = [(1,0),(0,1),(1,1)]
+        indices = set([(ik+a+c,il+b+d) for (a,b) in steps for (c,d) in steps]) - set([(ik+a,il+b) for (a,b) in steps])
+        return [(self.values_K[i],self.values_L[j]) for (i,j) in sorted(indices) if i < len(self.values_K) and j < len(self.values_L)]
+        
+    # Return the key of restart r for K and L in the fit cache (as in GridSearch), or None if we do not cache it
+    def fit_key(self,K,L,r):
+        seed = self.seeds[(K,L)][r]
+        if self.cache is None or not isinstance(seed,int):
+            return None
+        run_args = { name : value for (name,value) in self.run_args.items() if name != 'iterations' }
+        return self.cache.key(self.R,self.M,classifier=self.classifier,K=K,L=L,priors=self.priors,initS=self.initS,initFG=self.initFG,
+                              seed=seed,iterations=self.iterations,run_args=run_args,quality_args=self.quality_args)
+        
+    # Return the fit with the most factors that has at most K and L factors (and fewer of 
+    # either), to warm start (K,L) from, or None if there is none
+    def warm_model(self,K,L):
+        fits = [(K_fit+L_fit,K_fit,BNMTF) for ((K_fit,L_fit),BNMTF) in self.fits.items() if K_fit <= K and L_fit <= L and (K_fit,L_fit) != (K,L)]
+        return max(fits,key=lambda fit: fit[:2])[2] if fits else None
+        
+    # Return the priors for the given K and L
+    def priors_KL(self,K,L):
+        priors = self.priors.copy()
+        priors['lambdaF'] = self.priors['lambdaF']*numpy.ones((self.I,K))
+        priors['lambdaS'] = self.priors['lambdaS']*numpy.ones((K,L))
+        priors['lambdaG'] = self.priors['lambdaG']*numpy.ones((self.J,L))
+        return priors
     
     
     def all_values(self,metric):
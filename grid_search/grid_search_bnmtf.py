@@ -6,7 +6,9 @@ We expect the following arguments:
 - classifier    - a class for BNMTF, with methods: 
                     __init__(R,M,K,L,priors), 
                     initialise(init_S,init_FG), 
+                    initialise_warm(model,warm_start,seed) - if warm_start is given
                     run(iterations), 
+                    run(iterations,resume=True)         - if halving is given
                     quality(metric)         - metric in ['AIC','BIC','loglikelihood','MSE']
                     or quality(metric,burn_in,thinning) for Gibbs
 - values_K      - a list of values for K
@@ -21,10 +23,51 @@ We expect the following arguments:
 - iterations    - number of iterations to run 
 - restarts      - we run the classifier this many times and use the one with 
                   the highest log likelihood
+- seed          - optional (default None). Each restart for each K and L is 
+                  initialised with its own seed, spawned from this one (see 
+                  code/random_state.py), so that the search is reproducible and 
+                  the runs do not depend on each other or on the order they are 
+                  done in. If None, we use numpy's global random state.
+- P             - optional (default 1). The number of processes to run the 
+                  restarts in. If P > 1, search() trains all (K,L,restart) 
+                  models on a pool of P processes (see search_parallel).
+- warm_start    - optional (default None). If 'split' or 'prior', each (K,L) is
+                  initialised from the best fit of (K',L) in the previous row of 
+                  the grid or (K,L') in the same row, whichever has the most 
+                  factors (with K' <= K and L' <= L), using 
+                  initialise_warm(model,warm_start,seed) (see code/warm_start.py),
+                  rather than from scratch. The values in values_K and values_L
+                  should then be increasing. Only for P = 1, as the fits depend
+                  on each other.
+- warm_iterations - optional (default <iterations>). The number of iterations to
+                  run for the warm started models, which need fewer to converge.
+- halving       - optional (default None). A SuccessiveHalving (see 
+                  successive_halving.py). If given, we first train all (K,L) 
+                  (with all their restarts) for a few iterations, and only 
+                  continue training the best ones by halving.metric, until they 
+                  reach <iterations>. The performances of the other values are 
+                  those after the iterations they got, which are stored in 
+                  self.budgets (an array like all_values). Only for P = 1, and 
+                  cannot be combined with warm_start.
+- cache         - optional (default None). A FitCache (see code/fit_cache.py). If
+                  given, each seeded restart is first looked up in the cache, and
+                  only trained (and added to the cache) if it is not there yet, so
+                  that rerunning the search reuses the fits of the previous runs.
+                  With P > 1 the processes look up and add the fits. Needs a seed,
+                  and cannot be combined with warm_start or halving, as those fits
+                  depend on the other fits.
 
 The grid search can be started by running search().
 If we use Gibbs then we run search(burn_in,thinning).
 
+With P > 1 the models are trained in parallel. R and M are stored as .npy files
+in a temporary folder (using the tempfile module), which the processes memory-map,
+rather than sending them to the processes with each model. The processes then
+only return the quality of the model for each metric, and we keep the restart
+with the highest log likelihood, as before. If no seed is given, we draw a seed
+for each restart from numpy's global random state, as otherwise the processes 
+would share the same random state.
+
 After that, the values for each metric ('BIC','AIC','loglikelihood','MSE') can 
 be obtained using all_values(metric), and the best value of K and L can be 
 returned using best_value(metric).
@@ -37,13 +80,33 @@ We use the optimised Variational Bayes algorithm for BNMTF.
 project_location = "/home/tab43/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
+from BNMTF.code.random_state import spawn_seeds
 
-import numpy
+import numpy, itertools, os, shutil, tempfile
+from multiprocessing import Pool
 
 metrics = ['BIC','AIC','loglikelihood','MSE','ELBO']
 
+
+# Train the model of a (K,L,restart) task on the dataset stored in the .npy files, and 
+# return (ik,il,r,qualities), with qualities a dictionary from metric to quality. If
+# the task has a key, we use the fit cache instead if it has the fit, or add it to it.
+def run_restart(task):
+    record = task['cache'].get(task['key']) if task['key'] is not None else None
+    if record is not None:
+        return (task['ik'],task['il'],task['r'],record['qualities'])
+    R = numpy.load(task['file_R'],mmap_mode='r')
+    M = numpy.load(task['file_M'],mmap_mode='r')
+    BNMTF = task['classifier'](R,M,task['K'],task['L'],task['priors'])
+    BNMTF.initialise(init_S=task['initS'],init_FG=task['initFG'],seed=task['seed'])
+    BNMTF.run(iterations=task['iterations'])
+    qualities = { metric : BNMTF.quality(metric,**task['quality_args']) for metric in metrics }
+    if task['key'] is not None:
+        task['cache'].add(task['key'],BNMTF,qualities,quality_args=task['quality_args'])
+    return (task['ik'],task['il'],task['r'],qualities)
+
 class GridSearch:
-    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1):
+    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1,seed=None,P=1,warm_start=None,warm_iterations=None,halving=None,cache=None):
         self.classifier = classifier
         self.values_K = values_K
         self.values_L = values_L
@@ -55,7 +118,19 @@ class GridSearch:
         self.initFG = initFG
         self.iterations = iterations
         self.restarts = restarts
+        self.P = P
+        self.warm_start = warm_start
+        self.warm_iterations = warm_iterations if warm_iterations is not None else iterations
+        self.halving = halving
+        self.cache = cache
         assert self.restarts > 0, "Need at least 1 restart."
+        assert self.warm_start is None or self.P == 1, "Warm starts are only supported for P = 1."
+        assert self.halving is None or self.P == 1, "Successive halving is only supported for P = 1."
+        assert self.warm_start is None or self.halving is None, "Warm starts and successive halving cannot be combined."
+        assert self.cache is None or (self.warm_start is None and self.halving is None), "The fit cache cannot be combined with warm starts or successive halving."
+        
+        values_KL = list(itertools.product(self.values_K,self.values_L))
+        self.seeds = { KL : spawn_seeds(seed_KL,self.restarts) for (KL,seed_KL) in zip(values_KL,spawn_seeds(seed,len(values_KL))) }
         
         self.all_performances = {
             metric : numpy.empty((len(self.values_K),len(self.values_L)))
@@ -64,37 +139,164 @@ class GridSearch:
     
     
     def search(self,burn_in=None,thinning=None):
+        if self.P > 1:
+            return self.search_parallel(burn_in,thinning)
+        if self.halving is not None:
+            return self.search_halving(burn_in,thinning)
+            
+        quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        self.fits = {}  # Best fits of the previous and current row, to warm start from
         for ik,K in enumerate(self.values_K):
+            self.fits = { KL : BNMTF for (KL,BNMTF) in self.fits.items() if KL[0] == self.values_K[ik-1] }
             for il,L in enumerate(self.values_L):
                 print "Running line search for BNMF. Trying K = %s, L = %s." % (K,L)
                             
-                priors = self.priors.copy()
-                priors['lambdaF'] = self.priors['lambdaF']*numpy.ones((self.I,K))
-                priors['lambdaS'] = self.priors['lambdaS']*numpy.ones((K,L))
-                priors['lambdaG'] = self.priors['lambdaG']*numpy.ones((self.J,L))
+                priors = self.priors_KL(K,L)
+                warm_BNMTF = self.warm_model(K,L)
                 
-                best_BNMTF = None
+                (best_BNMTF,best_qualities) = (None,None)
                 for r in range(0,self.restarts):
                     print "Restart %s for K = %s, L = %s." % (r+1,K,L)    
-                    BNMTF = self.classifier(self.R,self.M,K,L,priors)
-                    BNMTF.initialise(init_S=self.initS,init_FG=self.initFG)
-                    BNMTF.run(iterations=self.iterations)
-                    
-                    args = {'metric':'loglikelihood'}
-                    if burn_in is not None and thinning is not None:
-                        args['burn_in'], args['thinning'] = burn_in, thinning
+                    key = self.fit_key(K,L,r,quality_args)
+                    record = self.cache.get(key) if key is not None else None
+                    if record is not None:
+                        print "Using the cached fit for restart %s for K = %s, L = %s." % (r+1,K,L)
+                        (BNMTF,qualities) = (None,record['qualities'])
+                    else:
+                        BNMTF = self.classifier(self.R,self.M,K,L,priors)
+                        if warm_BNMTF is not None:
+                            BNMTF.initialise_warm(warm_BNMTF,self.warm_start,seed=self.seeds[(K,L)][r])
+                            BNMTF.run(iterations=self.warm_iterations)
+                        else:
+                            BNMTF.initialise(init_S=self.initS,init_FG=self.initFG,seed=self.seeds[(K,L)][r])
+                            BNMTF.run(iterations=self.iterations)
+                        
+                        qualities = { metric : BNMTF.quality(metric,**quality_args) for metric in metrics }
+                        if key is not None:
+                            self.cache.add(key,BNMTF,qualities,quality_args=quality_args)
                     
-                    if best_BNMTF is None or BNMTF.quality(**args) > best_BNMTF.quality(**args):
-                        best_BNMTF = BNMTF
+                    if best_qualities is None or qualities['loglikelihood'] > best_qualities['loglikelihood']:
+                        (best_BNMTF,best_qualities) = (BNMTF,qualities)
                 
                 for metric in metrics:
-                    if burn_in is not None and thinning is not None:
-                        quality = best_BNMTF.quality(metric,burn_in,thinning)
-                    else:
-                        quality = best_BNMTF.quality(metric)
-                    self.all_performances[metric][ik,il] = quality
+                    self.all_performances[metric][ik,il] = best_qualities[metric]
+                if self.warm_start is not None:
+                    self.fits[(K,L)] = best_BNMTF
         
         print "Finished running line search for BNMF."
+        
+        
+    # Train all (K,L) for a few iterations, and only continue with the best ones (see successive_halving.py)
+    def search_halving(self,burn_in=None,thinning=None):
+        quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        models = {}
+        
+        # Train the restarts for (K,L) for <iterations> more iterations, initialising them the first time
+        def train(ikl,iterations):
+            (K,L) = (self.values_K[ikl[0]],self.values_L[ikl[1]])
+            print "Running grid search for BNMTF. Training K = %s, L = %s for %s iterations." % (K,L,iterations)
+            resume = ikl in models
+            if not resume:
+                priors = self.priors_KL(K,L)
+                models[ikl] = [self.classifier(self.R,self.M,K,L,priors) for r in range(0,self.restarts)]
+                for r,BNMTF in enumerate(models[ikl]):
+                    BNMTF.initialise(init_S=self.initS,init_FG=self.initFG,seed=self.seeds[(K,L)][r])
+            for BNMTF in models[ikl]:
+                BNMTF.run(iterations=iterations,resume=resume)
+        
+        # Return the restart for (K,L) with the highest log likelihood
+        def best(ikl):
+            return max(models[ikl],key=lambda BNMTF: BNMTF.quality('loglikelihood',**quality_args))
+            
+        # Store the performances of (K,L) once we are done with it
+        def finish(ikl,iterations):
+            for metric in metrics:
+                self.all_performances[metric][ikl] = best(ikl).quality(metric,**quality_args)
+            self.budgets[ikl] = iterations
+            del models[ikl]
+        
+        self.budgets = numpy.zeros((len(self.values_K),len(self.values_L)),dtype=int)
+        candidates = list(itertools.product(range(0,len(self.values_K)),range(0,len(self.values_L))))
+        self.halving.run(candidates,train,lambda ikl: best(ikl).quality(self.halving.metric,**quality_args),self.iterations,finish)
+        
+        print "Finished running grid search for BNMTF."
+        
+        
+    # Train all (K,L,restart) models on a pool of P processes, and store the qualities
+    # of the best restart (highest log likelihood) for each K and L
+    def search_parallel(self,burn_in=None,thinning=None):
+        quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        folder = tempfile.mkdtemp()
+        pool = Pool(self.P)
+        try:
+            (file_R,file_M) = (os.path.join(folder,'R.npy'),os.path.join(folder,'M.npy'))
+            numpy.save(file_R,self.R)
+            numpy.save(file_M,self.M)
+            
+            tasks = []
+            for (ik,K),(il,L) in itertools.product(enumerate(self.values_K),enumerate(self.values_L)):
+                priors = self.priors_KL(K,L)
+                for r,seed in enumerate(self.seeds[(K,L)]):
+                    tasks.append({
+                        'ik' : ik, 'il' : il, 'r' : r, 'K' : K, 'L' : L,
+                        'classifier' : self.classifier,
+                        'file_R' : file_R,
+                        'file_M' : file_M,
+                        'priors' : priors,
+                        'initS' : self.initS,
+                        'initFG' : self.initFG,
+                        'iterations' : self.iterations,
+                        'seed' : seed if seed is not None else numpy.random.randint(0,2**31-1),
+                        'quality_args' : quality_args,
+                        'cache' : self.cache,
+                        'key' : self.fit_key(K,L,r,quality_args)
+                    })
+            
+            all_qualities = {}
+            for (ik,il,r,qualities) in pool.imap_unordered(run_restart,tasks):
+                print "Finished restart %s for K = %s, L = %s." % (r+1,self.values_K[ik],self.values_L[il])
+                all_qualities[(ik,il,r)] = qualities
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(folder)
+        
+        # Keep the first restart with the highest log likelihood, as in search()
+        for ik,il in itertools.product(range(0,len(self.values_K)),range(0,len(self.values_L))):
+            restarts = [all_qualities[(ik,il,r)] for r in range(0,self.restarts)]
+            best = max(restarts,key=lambda qualities: qualities['loglikelihood'])
+            for metric in metrics:
+                self.all_performances[metric][ik,il] = best[metric]
+        
+        print "Finished running grid search for BNMTF."
+        
+        
+    # Return the key of restart r for K and L in the fit cache, or None if we do not cache it
+    def fit_key(self,K,L,r,quality_args):
+        seed = self.seeds[(K,L)][r]
+        if self.cache is None or not isinstance(seed,int):
+            return None
+        return self.cache.key(self.R,self.M,classifier=self.classifier,K=K,L=L,priors=self.priors,initS=self.initS,initFG=self.initFG,
+                              seed=seed,iterations=self.iterations,run_args={},quality_args=quality_args)
+        
+        
+    # Return the fit with the most factors that has at most K and L factors (and fewer of 
+    # either), to warm start (K,L) from, or None if there is none
+    def warm_model(self,K,L):
+        fits = [(K_fit+L_fit,K_fit,BNMTF) for ((K_fit,L_fit),BNMTF) in self.fits.items() if K_fit <= K and L_fit <= L and (K_fit,L_fit) != (K,L)]
+        return max(fits,key=lambda fit: fit[:2])[2] if fits else None
+        
+        
+    # Return the priors for the given K and L
+    def priors_KL(self,K,L):
+        priors = self.priors.copy()
+        priors['lambdaF'] = self.priors['lambdaF']*numpy.ones((self.I,K))
+        priors['lambdaS'] = self.priors['lambdaS']*numpy.ones((K,L))
+        priors['lambdaG'] = self.priors['lambdaG']*numpy.ones((self.J,L))
+        return priors
     
     
     def all_values(self,metric):
@@ -5,7 +5,9 @@ We expect the following arguments:
 - classifier    - a class for BNMF, with methods: 
                     __init__(R,M,K,priors), 
                     initialise(initUV), 
+                    initialise_warm(model,warm_start,seed) - if warm_start is given
                     run(iterations), 
+                    run(iterations,resume=True)         - if halving is given
                     quality(metric)         - metric in ['AIC','BIC','loglikelihood','MSE']
                     or quality(metric,burn_in,thinning) for Gibbs
 - values_K      - a list of values for K
@@ -18,6 +20,31 @@ We expect the following arguments:
 - iterations    - number of iterations to run 
 - restarts      - we run the classifier this many times and use the one with 
                   the highest log likelihood
+- seed          - optional (default None). Each restart for each K is initialised
+                  with its own seed, spawned from this one (see code/random_state.py),
+                  so that the search is reproducible and the runs do not depend on
+                  each other. If None, we use numpy's global random state.
+- warm_start    - optional (default None). If 'split' or 'prior', each K after
+                  the first is initialised from the best fit of the previous K 
+                  (if it is smaller), using initialise_warm(model,warm_start,seed) 
+                  (see code/warm_start.py), rather than from scratch. The values
+                  in values_K should then be increasing.
+- warm_iterations - optional (default <iterations>). The number of iterations to
+                  run for the warm started models, which need fewer to converge.
+- halving       - optional (default None). A SuccessiveHalving (see 
+                  successive_halving.py). If given, we first train all values of
+                  K (with all their restarts) for a few iterations, and only 
+                  continue training the best ones by halving.metric, until they 
+                  reach <iterations>. The performances of the other values of K 
+                  are those after the iterations they got, which are stored in
+                  self.budgets (a list like all_values). Cannot be combined with
+                  warm_start.
+- cache         - optional (default None). A FitCache (see code/fit_cache.py). If
+                  given, each seeded restart is first looked up in the cache, and
+                  only trained (and added to the cache) if it is not there yet, so
+                  that rerunning the search reuses the fits of the previous runs.
+                  Needs a seed, and cannot be combined with warm_start or halving,
+                  as those fits depend on the other fits.
 
 The line search can be started by running search().
 If we use Gibbs then we run search(burn_in=<>,thinning=<>).
@@ -31,13 +58,14 @@ using best_value(metric).
 project_location = "/home/tab43/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
+from BNMTF.code.random_state import spawn_seeds
 
 import numpy
 
 metrics = ['BIC','AIC','loglikelihood','MSE','ELBO']
 
 class LineSearch:
-    def __init__(self,classifier,values_K,R,M,priors,initUV,iterations,restarts=1):
+    def __init__(self,classifier,values_K,R,M,priors,initUV,iterations,restarts=1,seed=None,warm_start=None,warm_iterations=None,halving=None,cache=None):
         self.classifier = classifier
         self.values_K = values_K
         self.R = R
@@ -47,7 +75,14 @@ class LineSearch:
         self.initUV = initUV
         self.iterations = iterations
         self.restarts = restarts
+        self.warm_start = warm_start
+        self.warm_iterations = warm_iterations if warm_iterations is not None else iterations
+        self.halving = halving
+        self.cache = cache
         assert self.restarts > 0, "Need at least 1 restart."
+        assert self.warm_start is None or self.halving is None, "Warm starts and successive halving cannot be combined."
+        assert self.cache is None or (self.warm_start is None and self.halving is None), "The fit cache cannot be combined with warm starts or successive halving."
+        self.seeds = { K : spawn_seeds(seed_K,self.restarts) for (K,seed_K) in zip(self.values_K,spawn_seeds(seed,len(self.values_K))) }
         
         self.all_performances = {
             metric : []
@@ -56,6 +91,12 @@ class LineSearch:
     
     
     def search(self,burn_in=None,thinning=None,minimum_TN=None):
+        if self.halving is not None:
+            return self.search_halving(burn_in,thinning,minimum_TN)
+            
+        run_args = {} if minimum_TN is None else {'minimum_TN':minimum_TN}
+        quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        previous_BNMF = None
         for K in self.values_K:
             print "Running line search for BNMF. Trying K = %s." % K
                         
@@ -63,31 +104,83 @@ class LineSearch:
             priors['lambdaU'] = self.priors['lambdaU']*numpy.ones((self.I,K))
             priors['lambdaV'] = self.priors['lambdaV']*numpy.ones((self.J,K))
             
-            best_BNMF = None
+            (best_BNMF,best_qualities) = (None,None)
             for r in range(0,self.restarts):
                 print "Restart %s for K = %s." % (r+1,K)
-                BNMF = self.classifier(self.R,self.M,K,priors)
-                BNMF.initialise(init=self.initUV)
-                if minimum_TN is None:
-                    BNMF.run(iterations=self.iterations)
+                key = self.fit_key(K,r,run_args,quality_args)
+                record = self.cache.get(key) if key is not None else None
+                if record is not None:
+                    print "Using the cached fit for restart %s for K = %s." % (r+1,K)
+                    (BNMF,qualities) = (None,record['qualities'])
                 else:
-                    BNMF.run(iterations=self.iterations,minimum_TN=minimum_TN)
-                
-                args = {'metric':'loglikelihood'}
-                if burn_in is not None and thinning is not None:
-                    args['burn_in'], args['thinning'] = burn_in, thinning
+                    BNMF = self.classifier(self.R,self.M,K,priors)
+                    if self.warm_start is not None and previous_BNMF is not None and previous_BNMF.K <= K:
+                        BNMF.initialise_warm(previous_BNMF,self.warm_start,seed=self.seeds[K][r])
+                        iterations = self.warm_iterations
+                    else:
+                        BNMF.initialise(init=self.initUV,seed=self.seeds[K][r])
+                        iterations = self.iterations
+                    BNMF.run(iterations=iterations,**run_args)
+                    
+                    qualities = { metric : BNMF.quality(metric,**quality_args) for metric in metrics }
+                    if key is not None:
+                        self.cache.add(key,BNMF,qualities,quality_args=quality_args)
                 
-                if best_BNMF is None or BNMF.quality(**args) > best_BNMF.quality(**args):
-                    best_BNMF = BNMF
+                if best_qualities is None or qualities['loglikelihood'] > best_qualities['loglikelihood']:
+                    (best_BNMF,best_qualities) = (BNMF,qualities)
             
             for metric in metrics:
-                if burn_in is not None and thinning is not None:
-                    quality = best_BNMF.quality(metric,burn_in,thinning)
-                else:
-                    quality = best_BNMF.quality(metric)
-                self.all_performances[metric].append(quality)
+                self.all_performances[metric].append(best_qualities[metric])
+            previous_BNMF = best_BNMF
         
         print "Finished running line search for BNMF."
+        
+        
+    # Train all values of K for a few iterations, and only continue with the best ones (see successive_halving.py)
+    def search_halving(self,burn_in=None,thinning=None,minimum_TN=None):
+        run_args = {} if minimum_TN is None else {'minimum_TN':minimum_TN}
+        quality_args = {'burn_in':burn_in, 'thinning':thinning} if burn_in is not None and thinning is not None else {}
+        models, performances = {}, {}
+        
+        # Train the restarts for K for <iterations> more iterations, initialising them the first time
+        def train(K,iterations):
+            print "Running line search for BNMF. Training K = %s for %s iterations." % (K,iterations)
+            resume = K in models
+            if not resume:
+                priors = self.priors.copy()
+                priors['lambdaU'] = self.priors['lambdaU']*numpy.ones((self.I,K))
+                priors['lambdaV'] = self.priors['lambdaV']*numpy.ones((self.J,K))
+                models[K] = [self.classifier(self.R,self.M,K,priors) for r in range(0,self.restarts)]
+                for r,BNMF in enumerate(models[K]):
+                    BNMF.initialise(init=self.initUV,seed=self.seeds[K][r])
+            for BNMF in models[K]:
+                BNMF.run(iterations=iterations,resume=resume,**run_args)
+        
+        # Return the restart for K with the highest log likelihood
+        def best(K):
+            return max(models[K],key=lambda BNMF: BNMF.quality('loglikelihood',**quality_args))
+            
+        # Store the performances of K once we are done with it
+        def finish(K,iterations):
+            performances[K] = { metric : best(K).quality(metric,**quality_args) for metric in metrics }
+            del models[K]
+            
+        budgets = self.halving.run(self.values_K,train,lambda K: best(K).quality(self.halving.metric,**quality_args),self.iterations,finish)
+        for K in self.values_K:
+            for metric in metrics:
+                self.all_performances[metric].append(performances[K][metric])
+        self.budgets = [budgets[K] for K in self.values_K]
+        
+        print "Finished running line search for BNMF."
+    
+    
+    # Return the key of restart r for K in the fit cache, or None if we do not cache it
+    def fit_key(self,K,r,run_args,quality_args):
+        seed = self.seeds[K][r]
+        if self.cache is None or not isinstance(seed,int):
+            return None
+        return self.cache.key(self.R,self.M,classifier=self.classifier,K=K,priors=self.priors,init=self.initUV,
+                              seed=seed,iterations=self.iterations,run_args=run_args,quality_args=quality_args)
     
     
     def all_values(self,metric):
@@ -0,0 +1,72 @@
+"""
+Class for successive halving (Jamieson and Talwalkar, 2016) in the model
+selection, so that we do not train every value of K (or K and L) for the full
+number of iterations when it is clearly worse after a few.
+
+We expect the following arguments:
+- min_iterations - the number of iterations we first train all candidates for
+- eta, optional (default 3). After each round we keep the best 1/eta of the
+    candidates (at least one), and train them for eta times as many iterations
+    in total, until they reach the full number of iterations.
+- metric, optional (default 'BIC'). The metric we rank the candidates by in
+    LineSearch and GridSearch, where lower is better (as in best_value).
+    GreedySearch instead uses its search_metric.
+
+The drivers (LineSearch, GridSearch, GreedySearch) take a SuccessiveHalving as
+their optional argument <halving>, and call run(candidates,train,quality,iterations,finish):
+- train(candidate,iterations) should train the candidate for <iterations> more
+    iterations, continuing from its current values after the first time (using
+    run(iterations,resume=True) of the models).
+- quality(candidate) should return its value of the metric.
+- finish(candidate,iterations), optional, is called once we stop training a
+    candidate, with the number of iterations it was trained for in total (equal
+    to <iterations> for the ones that were not eliminated), so that the driver
+    can store its performances and drop its models.
+run returns a dictionary from candidate to the number of iterations it got.
+
+For example, with 9 candidates, min_iterations=10, eta=3 and iterations=100, we
+train 9 candidates for 10 iterations, 3 of them up to 30, and 1 up to 100, so
+220 iterations rather than 900. Candidates with equal quality are kept in the
+order they were given in. For Gibbs, min_iterations should be larger than the
+burn-in, as we need draws to compute the quality.
+
+Usage:
+    halving = SuccessiveHalving(min_iterations=10,eta=3,metric='BIC')
+    linesearch = LineSearch(classifier,values_K,R,M,priors,initUV,iterations,halving=halving)
+    linesearch.search()
+"""
+
+import math
+
+class SuccessiveHalving:
+    def __init__(self,min_iterations,eta=3,metric='BIC'):
+        assert min_iterations >= 1, "Minimum number of iterations should be at least 1, but is %s." % min_iterations
+        assert eta > 1, "Eta should be greater than 1, but is %s." % eta
+        self.min_iterations = min_iterations
+        self.eta = eta
+        self.metric = metric
+
+
+    # Train the candidates in rounds, keeping the best 1/eta each time, and return a
+    # dictionary from candidate to the number of iterations it was trained for
+    def run(self,candidates,train,quality,iterations,finish=None):
+        budgets = { candidate : 0 for candidate in candidates }
+        remaining = list(candidates)
+        budget = min(self.min_iterations,iterations)
+        while remaining:
+            for candidate in remaining:
+                train(candidate,budget-budgets[candidate])
+                budgets[candidate] = budget
+            if budget == iterations:
+                kept = []
+            else:
+                no_kept = max(1,int(math.ceil(len(remaining)/float(self.eta))))
+                kept = sorted(remaining,key=quality)[:no_kept]
+                print "Trained %s candidates for %s iterations, keeping %s." % (len(remaining),budget,no_kept)
+
+            for candidate in remaining:
+                if candidate not in kept and finish is not None:
+                    finish(candidate,budget)
+            remaining = [candidate for candidate in remaining if candidate in kept]
+            budget = int(min(budget*self.eta,iterations)) if len(remaining) > 1 else iterations
+        return budgets
@@ -0,0 +1,22 @@
+"""
+Test the class for Exponential draws in exponential.py.
+"""
+from BNMTF.code.distributions.exponential import exponential_draw, exponential_vector_draw
+import numpy
+
+# Test a draw - simply verify it is > 0.
+def test_draw():
+    lambdax = 2.0
+    for i in range(0,100):
+        assert exponential_draw(lambdax) >= 0.0
+        
+# Test drawing an entire array at once, with a different lambda per entry
+def test_vector_draw():
+    lambdas = numpy.array([[1.0,2.0,3.0],[4.0,5.0,6.0]])
+    draws = exponential_vector_draw(lambdas)
+    assert draws.shape == (2,3)
+    assert numpy.all(draws >= 0.0)
+    
+    numpy.random.seed(0)
+    draws = exponential_vector_draw(numpy.array([1.0,4.0]*50000))
+    assert abs(draws[0::2].mean() - 1.0) < 0.02 and abs(draws[1::2].mean() - 0.25) < 0.02
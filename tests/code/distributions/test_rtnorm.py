@@ -0,0 +1,43 @@
+"""
+Test the vectorised draws of Chopin's algorithm in rtnorm.py.
+"""
+from BNMTF.code.distributions.rtnorm import rtnorm, rtstdnorm_vector
+from scipy.stats import truncnorm
+import numpy, pytest
+
+# Test that the draws are within the bounds, for each of the cases (left tail,
+# right tail, small interval, and Chopin's boxes), and that the means match.
+def test_rtstdnorm_vector():
+    numpy.random.seed(0)
+    for (a,b) in [(-3.,-2.5),(4.,numpy.inf),(1.,1.001),(-1.,1.),(0.,numpy.inf),(-numpy.inf,0.5)]:
+        draws = rtstdnorm_vector(a*numpy.ones(50000),b*numpy.ones(50000))
+        assert draws.min() >= a and draws.max() <= b
+        assert abs(draws.mean() - truncnorm(a,b).mean()) < 0.01
+        
+# Test that we get different bounds per entry
+def test_rtstdnorm_vector_arrays():
+    numpy.random.seed(0)
+    a = numpy.random.normal(size=1000)
+    b = a + numpy.random.uniform(size=1000)
+    draws = rtstdnorm_vector(a,b)
+    assert numpy.all(draws >= a) and numpy.all(draws <= b)
+    
+    with pytest.raises(Exception) as error:
+        rtstdnorm_vector([0.,1.],[1.,0.5])
+    assert str(error.value) == "For a truncated ndst in [a,b] b must be greater than a."
+    
+# Test rtnorm with size > 1, and with mu and sigma
+def test_rtnorm_size():
+    numpy.random.seed(0)
+    mu, sigma = 1., 2.
+    draws = rtnorm(a=0., b=numpy.inf, mu=mu, sigma=sigma, size=50000)
+    assert draws.shape == (50000,)
+    assert draws.min() >= 0.
+    assert abs(draws.mean() - truncnorm(-mu/sigma,numpy.inf,loc=mu,scale=sigma).mean()) < 0.03
+    
+# Test that draws with the same random state are the same, for single and vector draws
+def test_rtnorm_random_state():
+    for (a,b) in [(-3.,-2.5),(4.,numpy.inf),(1.,1.001),(-1.,1.),(-numpy.inf,0.5)]:
+        for size in [1,100]:
+            draws = rtnorm(a, b, size=size, random_state=numpy.random.RandomState(0))
+            assert numpy.array_equal(draws, rtnorm(a, b, size=size, random_state=numpy.random.RandomState(0)))
@@ -1,7 +1,7 @@
 """
 Test the class for Truncated Normal draws and expectations in truncated_normal_vector.py.
 """
-from BNMTF.code.distributions.truncated_normal_vector import TN_vector_draw, TN_vector_expectation, TN_vector_variance, TN_vector_mode
+from BNMTF.code.distributions.truncated_normal_vector import TN_vector_draw, TN_vector_expectation, TN_vector_variance, TN_vector_moments, TN_vector_mode
 from scipy.stats import norm
 import numpy
 
@@ -13,7 +13,10 @@ def test_expectation():
     
     lambdav = ( norm.pdf( - mu[0] / sigma[0] ) ) / ( 1 - norm.cdf( - mu[0] / sigma[0] ) )
     expectation = mu[0] + sigma[0] * lambdav
-    assert numpy.array_equal(TN_vector_expectation(mu,tau), [expectation, 1./2000.])
+    # The second entry is close to the expectation of an Exp(|mu|*tau)
+    (exp1, exp2) = TN_vector_expectation(mu,tau)
+    assert abs(exp1 - expectation) < 1e-12
+    assert abs(exp2 - 1./2000.) < 1e-3 * 1./2000.
     
 def test_variance():
     # One normal case, one exponential approximation
@@ -23,7 +26,34 @@ def test_variance():
     
     lambdav = ( norm.pdf( - mu[0] / sigma[0] ) ) / ( 1 - norm.cdf( - mu[0] / sigma[0] ) )
     variance = sigma[0]**2 * ( 1 - ( lambdav * ( lambdav + mu[0] / sigma[0] ) ) )
-    assert numpy.array_equal(TN_vector_variance(mu,tau), [variance, (1./2000.)**2])
+    # The second entry is close to the variance of an Exp(|mu|*tau)
+    (var1, var2) = TN_vector_variance(mu,tau)
+    assert abs(var1 - variance) < 1e-12
+    assert abs(var2 - (1./2000.)**2) < 5e-3 * (1./2000.)**2
+    
+# Test that the fused moments match, and that they stay finite for very low mu
+def test_moments():
+    mu = [1.0, -1, -100., 5.]
+    tau = [3.0, 2000, 1., 0.]
+    (exp, var) = TN_vector_moments(mu,tau)
+    assert numpy.array_equal(exp, TN_vector_expectation(mu,tau))
+    assert numpy.array_equal(var, TN_vector_variance(mu,tau))
+    assert abs(exp[2] - 1./100.) < 1e-3 * 1./100.
+    assert abs(var[2] - (1./100.)**2) < 5e-3 * (1./100.)**2
+    assert exp[3] == 0. and var[3] == 0.
+
+# Test that the moments keep their precision far in the tail, against the exact series in 1/x
+def test_moments_asymptotic():
+    mu = [-1e4, -1e3, -50.*numpy.sqrt(1./4.), -49.9*numpy.sqrt(1./4.)]
+    tau = [1., 1., 4., 4.]
+    (exp, var) = TN_vector_moments(mu,tau)
+    for (m,t,e,v) in zip(mu,tau,exp,var):
+        (sigma, x) = (1./numpy.sqrt(t), -m*numpy.sqrt(t))
+        exact_exp = sigma * (1./x - 2./x**3 + 10./x**5 - 74./x**7)
+        exact_var = sigma**2 * (1./x**2 - 6./x**4 + 50./x**6 - 518./x**8)
+        assert abs(e - exact_exp) < 1e-10 * exact_exp
+        assert abs(v - exact_var) < 1e-9 * exact_var
+    assert var[0] > 0.
 
 # Test a draw - simply verify it is > 0.
 # Also test whether we get inf for a very negative mean and high variance
@@ -39,4 +69,30 @@ def test_draw():
 def test_mode():
     # Positive mean
     mus = [1.0, -2.0]
-    assert numpy.array_equal(TN_vector_mode(mus), [1.0, 0.0])
\ No newline at end of file
+    assert numpy.array_equal(TN_vector_mode(mus), [1.0, 0.0])
+    
+# Test that the batched draws match the expectation and variance, both in the 
+# inverse-CDF region and in the right tail (mu < -TAIL_THRESHOLD * sigma)
+def test_draw_moments():
+    numpy.random.seed(0)
+    for (mu,tau) in [(1.0,3.0),(-1.0,3.0),(-10.0,1.0),(-1.0,2000.)]:
+        draws = TN_vector_draw(mu*numpy.ones(100000),tau*numpy.ones(100000))
+        assert all(draws >= 0.0)
+        assert abs(draws.mean() - TN_vector_expectation([mu],[tau])[0]) < 0.01 * TN_vector_expectation([mu],[tau])[0]
+        assert abs(draws.var() - TN_vector_variance([mu],[tau])[0]) < 0.05 * TN_vector_variance([mu],[tau])[0]
+        
+# Test that non-finite parameters give 0 draws, and tau = inf gives mu
+def test_draw_nonfinite():
+    mu = [1.0, 2.0, -1.0, numpy.nan, 1.0]
+    tau = [0.0, numpy.inf, numpy.inf, 1.0, numpy.nan]
+    assert numpy.array_equal(TN_vector_draw(mu,tau), [0.0, 2.0, 0.0, 0.0, 0.0])
+    
+# Test that draws with the same random state are the same, both in the inverse-CDF 
+# region and in the right tail, and that they do not use the global random state
+def test_draw_random_state():
+    mu, tau = [1.0, -1.0, -10.0], [3.0, 3.0, 1.0]
+    draws = TN_vector_draw(mu,tau,numpy.random.RandomState(0))
+    numpy.random.seed(1)
+    state = numpy.random.get_state()
+    assert numpy.array_equal(draws, TN_vector_draw(mu,tau,numpy.random.RandomState(0)))
+    assert numpy.array_equal(state[1], numpy.random.get_state()[1])
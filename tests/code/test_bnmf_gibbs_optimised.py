@@ -4,6 +4,8 @@ Tests for the BNMF Gibbs sampler.
 
 import numpy, math, pytest, itertools
 from BNMTF.code.bnmf_gibbs_optimised import bnmf_gibbs_optimised
+from BNMTF.code.sample_store import SampleStore
+from BNMTF.code.stopping_criterion import StoppingCriterion
 
 
 """ Test constructor """
@@ -232,6 +234,120 @@ def test_run():
     assert taus[1] != alpha/float(beta)
     
     
+""" Test stopping early, once the split R-hat of tau is below the threshold. """
+def test_run_stopping_criterion():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    iterations = 200
+    criterion = StoppingCriterion('Rhat',2.,patience=2)
+    BNMF = bnmf_gibbs_optimised(R,M,K,priors)
+    BNMF.initialise('exp')
+    (Us,Vs,taus) = BNMF.run(iterations,stopping_criterion=criterion)
+    
+    it = len(BNMF.all_times)
+    assert it < iterations
+    assert Us.shape == (it,I,K) and Vs.shape == (it,J,K) and taus.shape == (it,)
+    assert len(BNMF.all_performances['MSE']) == it
+    assert BNMF.stop_reason == criterion.reason
+    assert BNMF.stop_reason.startswith("Split R-hat of tau below 2.0 for 2 iteration(s)")
+    
+    # Without a criterion we do all iterations
+    BNMF.run(10)
+    assert BNMF.all_U.shape == (10,I,K)
+    assert BNMF.stop_reason == "Reached the maximum number of iterations (10)."
+    
+    
+""" Test that keeping running means of the draws gives the same results as storing them all. """
+def test_run_sample_store(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    iterations, burn_in, thinning = 20, 5, 3
+    
+    numpy.random.seed(0)
+    full = bnmf_gibbs_optimised(R,M,K,priors)
+    full.initialise('random')
+    full.run(iterations)
+    
+    numpy.random.seed(0)
+    store = SampleStore(burn_in,thinning,filename=str(tmpdir.join('samples')))
+    streamed = bnmf_gibbs_optimised(R,M,K,priors)
+    streamed.initialise('random')
+    draws = streamed.run(iterations,sample_store=store)
+    
+    assert all([draw is None for draw in draws[:-1]])
+    assert numpy.array_equal(full.all_tau,streamed.all_tau)
+    for (expected,streamed_mean) in zip(full.approx_expectation(burn_in,thinning),streamed.approx_expectation(burn_in,thinning)):
+        assert numpy.allclose(expected,streamed_mean)
+    assert numpy.array_equal(store.samples('U'),full.all_U[burn_in::thinning])
+    assert numpy.array_equal(store.samples('V'),full.all_V[burn_in::thinning])
+    for metric in ['MSE','R^2','Rp']:
+        assert numpy.allclose(full.predict(M_test,burn_in,thinning)[metric],streamed.predict(M_test,burn_in,thinning)[metric],equal_nan=True)
+    for metric in ['loglikelihood','BIC','AIC','MSE']:
+        assert numpy.allclose(full.quality(metric,burn_in,thinning),streamed.quality(metric,burn_in,thinning))
+    with pytest.raises(AssertionError):
+        streamed.approx_expectation(burn_in,1)
+    
+    
+""" Test that runs with the same seed give the same draws, whatever the global random state. """
+def test_run_seed():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    runs = []
+    for global_seed in [0,1]:
+        numpy.random.seed(global_seed)
+        BNMF = bnmf_gibbs_optimised(R,M,K,priors)
+        BNMF.initialise('random',seed=42)
+        BNMF.run(5)
+        runs.append(BNMF)
+    assert numpy.array_equal(runs[0].all_U,runs[1].all_U)
+    assert numpy.array_equal(runs[0].all_V,runs[1].all_V)
+    assert numpy.array_equal(runs[0].all_tau,runs[1].all_tau)
+    
+    other = bnmf_gibbs_optimised(R,M,K,priors)
+    other.initialise('random',seed=43)
+    other.run(5)
+    assert not numpy.array_equal(runs[0].all_U,other.all_U)
+    
+    
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    lambdaU = 2*numpy.ones((I,K))
+    lambdaV = 3*numpy.ones((J,K))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        BNMF = bnmf_gibbs_optimised(R,M,K,priors,sparse=sparse)
+        BNMF.initialise('random')
+        BNMF.run(4)
+        models.append(BNMF)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.all_U,sparse.all_U)
+    assert numpy.allclose(dense.all_V,sparse.all_V)
+    assert numpy.allclose(dense.all_tau,sparse.all_tau)
+    assert numpy.allclose([dense.predict(M_test,2,1)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test,2,1)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.quality('loglikelihood',2,1), sparse.quality('loglikelihood',2,1))
+    
+    
 """ Test approximating the expectations for U, V, tau """
 def test_approx_expectation():
     burn_in = 2
@@ -2,8 +2,9 @@
 Tests for the BNMF Variational Bayes algorithm, with optimised matrix operation updates.
 """
 
-import numpy, math, pytest, itertools, random
+import numpy, math, pytest, itertools, random, scipy.sparse
 from BNMTF.code.bnmf_vb_optimised import bnmf_vb_optimised
+from BNMTF.code.monitor import Monitor
 
 
 """ Test constructor """
@@ -150,6 +151,33 @@ def test_initialise():
         assert BNMF.tauU[i,k] == 2.
     for j,k in itertools.product(xrange(0,J),xrange(0,K)):
         assert BNMF.tauV[j,k] == 3.
+        
+        
+""" Test initialising from the fit of a model with fewer factors """
+def test_initialise_warm():
+    I,J,K,K_new = 5,3,2,4
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = lambda K: { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    model = bnmf_vb_optimised(R,M,K,priors(K))
+    model.initialise('random')
+    model.run(2)
+    
+    # Splitting keeps muU muV^T, and copies the taus of the split columns
+    BNMF = bnmf_vb_optimised(R,M,K_new,priors(K_new))
+    BNMF.initialise_warm(model,'split',seed=0)
+    assert BNMF.muU.shape == (I,K_new) and BNMF.expU.shape == (I,K_new) and BNMF.expV.shape == (J,K_new)
+    assert numpy.allclose(numpy.dot(BNMF.muU,BNMF.muV.T),numpy.dot(model.muU,model.muV.T))
+    assert numpy.array_equal(BNMF.tauU[:,:K],model.tauU) and numpy.array_equal(BNMF.tauV[:,:K],model.tauV)
+    assert BNMF.exptau != numpy.inf and not math.isnan(BNMF.exptau)
+    
+    # Drawing from the prior keeps the old columns, with tau = 1 for the new ones
+    BNMF = bnmf_vb_optimised(R,M,K_new,priors(K_new))
+    BNMF.initialise_warm(model,'prior',seed=0)
+    assert numpy.array_equal(BNMF.muU[:,:K],model.muU) and numpy.array_equal(BNMF.muV[:,:K],model.muV)
+    assert numpy.array_equal(BNMF.tauU[:,K:],numpy.ones((I,K_new-K)))
+    BNMF.run(2)
     
         
 """ Test computing the ELBO. """
@@ -341,6 +369,184 @@ def test_run():
     assert BNMF.explogtau != numpy.inf and not math.isnan(BNMF.explogtau)
     
 
+""" Test monitoring the performances only every few iterations, without printing. """
+def test_run_monitor(capsys):
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    numpy.random.seed(0)
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise('random')
+    BNMF.run(5)
+    (all_performances,all_iterations) = (BNMF.all_performances,BNMF.all_iterations)
+    assert all_iterations == [1,2,3,4,5]
+    assert sorted(all_performances.keys()) == ['ELBO','MSE','R^2','Rp']
+    assert "Iteration 5. ELBO: " in capsys.readouterr()[0]
+    
+    callbacks = []
+    monitor = Monitor(interval=2,metrics=['MSE','ELBO'],callback=lambda it,perf: callbacks.append((it,perf)),silent=True)
+    numpy.random.seed(0)
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise('random')
+    BNMF.run(5,monitor=monitor)
+    assert capsys.readouterr()[0] == ""
+    assert BNMF.all_iterations == [2,4,5]
+    assert sorted(BNMF.all_performances.keys()) == ['ELBO','MSE']
+    assert numpy.allclose(BNMF.all_performances['MSE'],[all_performances['MSE'][it-1] for it in [2,4,5]])
+    assert numpy.allclose(BNMF.all_performances['ELBO'],[all_performances['ELBO'][it-1] for it in [2,4,5]])
+    assert [it for (it,perf) in callbacks] == [2,4,5]
+    assert sorted(callbacks[0][1].keys()) == ['ELBO','MSE']
+    
+    
+""" Test that resuming a run gives the same values and performances as one longer run. """
+def test_run_resume():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    full = bnmf_vb_optimised(R,M,K,priors)
+    full.initialise('random',seed=0)
+    full.run(5)
+    resumed = bnmf_vb_optimised(R,M,K,priors)
+    resumed.initialise('random',seed=0)
+    resumed.run(2)
+    resumed.run(3,resume=True)
+    
+    assert numpy.array_equal(full.muU,resumed.muU) and numpy.array_equal(full.expV,resumed.expV)
+    assert full.all_exp_tau == resumed.all_exp_tau
+    assert full.all_performances == resumed.all_performances
+    assert resumed.all_iterations == [1,2,3,4,5] and len(resumed.all_times) == 5
+
+    
+""" Test that train() initialises with the given seed and runs. """
+def test_train():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise('random',seed=1)
+    BNMF.run(3)
+    trained = bnmf_vb_optimised(R,M,K,priors)
+    trained.train('random',3,seed=1)
+    
+    assert numpy.array_equal(BNMF.muU,trained.muU) and numpy.array_equal(BNMF.muV,trained.muV)
+    assert BNMF.all_performances == trained.all_performances
+    assert trained.all_iterations == [1,2,3]
+    
+    
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    lambdaU = 2*numpy.ones((I,K))
+    lambdaV = 3*numpy.ones((J,K))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
+    
+    # In sparse mode R and M can also be given as scipy.sparse matrices, e.g. built from (i,j,R_ij) triples
+    (rows,columns) = numpy.nonzero(M)
+    M_triples = scipy.sparse.coo_matrix((numpy.ones(len(rows)),(rows,columns)),shape=(I,J))
+    R_triples = scipy.sparse.coo_matrix(R)
+    
+    models = []
+    for (sparse,R_input,M_input) in [(False,R,M),(True,R,M),(True,R_triples,M_triples)]:
+        numpy.random.seed(0)
+        BNMF = bnmf_vb_optimised(R_input,M_input,K,priors,sparse=sparse)
+        BNMF.initialise('random')
+        BNMF.run(3)
+        models.append(BNMF)
+    (dense,sparse,triples) = models
+    assert sparse.R is R and sparse.M is M
+    assert scipy.sparse.isspmatrix_csr(triples.R) and scipy.sparse.isspmatrix_csr(triples.M)
+    
+    for model in [sparse,triples]:
+        assert numpy.allclose(dense.muU,model.muU)
+        assert numpy.allclose(dense.tauU,model.tauU)
+        assert numpy.allclose(dense.muV,model.muV)
+        assert numpy.allclose(dense.tauV,model.tauV)
+        assert numpy.allclose(dense.exptau,model.exptau)
+        assert numpy.allclose([dense.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], [model.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+        assert numpy.allclose(dense.elbo(), model.elbo())
+        assert numpy.allclose(dense.quality('loglikelihood'), model.quality('loglikelihood'))
+    assert numpy.allclose(dense.predict(M_test)['MSE'], triples.predict(scipy.sparse.csr_matrix(M_test))['MSE'])
+    
+    # Empty rows are still found without the dense mask
+    M_triples = scipy.sparse.coo_matrix((numpy.ones(2),([0,1],[0,1])),shape=(I,J))
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb_optimised(R_triples,M_triples,K,priors,sparse=True)
+    assert str(error.value) == "Fully unobserved row in R, row 2."
+    
+    
+""" Test that updating all columns in one sweep with a rank-1 corrected residual gives the same results. """
+def test_run_batch_columns():
+    I,J,K = 10,5,3
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaU = 2*numpy.ones((I,K))
+    lambdaV = 3*numpy.ones((J,K))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
+    
+    models = []
+    for (sparse,batch_columns) in [(False,False),(False,True),(True,True)]:
+        numpy.random.seed(0)
+        BNMF = bnmf_vb_optimised(R,M,K,priors,sparse=sparse,batch_columns=batch_columns)
+        BNMF.initialise('random')
+        BNMF.run(3)
+        models.append(BNMF)
+    
+    for batched in models[1:]:
+        assert numpy.allclose(models[0].muU,batched.muU)
+        assert numpy.allclose(models[0].tauU,batched.tauU)
+        assert numpy.allclose(models[0].muV,batched.muV)
+        assert numpy.allclose(models[0].tauV,batched.tauV)
+        assert numpy.allclose(models[0].exptau,batched.exptau)
+        assert numpy.allclose(models[0].elbo(),batched.elbo())
+    
+    
+""" Test that running in float32 gives (nearly) the same performances as float64. """
+def test_run_float32():
+    I,J,K = 10,5,3
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2*numpy.ones((I,K)), 'lambdaV':3*numpy.ones((J,K)) }
+    
+    for (sparse,batch_columns) in [(False,False),(True,False),(False,True)]:
+        models = []
+        for dtype in [numpy.float64,numpy.float32]:
+            numpy.random.seed(0)
+            BNMF = bnmf_vb_optimised(R,M,K,priors,sparse=sparse,batch_columns=batch_columns,dtype=dtype)
+            BNMF.initialise('random')
+            BNMF.run(5)
+            models.append(BNMF)
+        (double,single) = models
+        
+        for matrix in [single.omega.values if sparse else single.R,single.muU,single.tauU,single.expU,single.varU,single.expV,single.varV]:
+            assert matrix.dtype == numpy.float32
+        assert sparse or single.M.dtype == numpy.float32
+        assert numpy.allclose(double.expU,single.expU,rtol=1e-3)
+        assert numpy.allclose(double.expV,single.expV,rtol=1e-3)
+        assert numpy.allclose(double.exptau,single.exptau,rtol=1e-4)
+        assert numpy.allclose(double.elbo(),single.elbo(),rtol=1e-4)
+        assert numpy.allclose(double.all_performances['MSE'],single.all_performances['MSE'],rtol=1e-4)
+        assert numpy.allclose(double.predict(M_test)['MSE'],single.predict(M_test)['MSE'],rtol=1e-4)
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K) = (5,3,2)
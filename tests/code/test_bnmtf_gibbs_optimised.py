@@ -4,6 +4,7 @@ Tests for the BNMTF Gibbs sampler.
 
 import numpy, math, pytest, itertools
 from BNMTF.code.bnmtf_gibbs_optimised import bnmtf_gibbs_optimised
+from BNMTF.code.sample_store import SampleStore
 
 
 """ Test constructor """
@@ -178,6 +179,30 @@ def test_initialise():
         assert BNMTF.G[j,l] == 0.2 or BNMTF.G[j,l] == 1.2
     for k,l in itertools.product(xrange(0,K),xrange(0,L)):
         assert BNMTF.S[k,l] == 1./lambdaS[k,l]
+        
+        
+""" Test initialising from the fit of a model with fewer factors, with the residual cached """
+def test_initialise_warm():
+    I,J,K,L,K_new,L_new = 5,3,2,2,4,3
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = lambda K,L: { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    
+    model = bnmtf_gibbs_optimised(R,M,K,L,priors(K,L))
+    model.initialise('random','random')
+    model.run(2)
+    
+    BNMTF = bnmtf_gibbs_optimised(R,M,K_new,L_new,priors(K_new,L_new),cache_residual=True)
+    BNMTF.initialise_warm(model,'split',seed=0)
+    assert BNMTF.F.shape == (I,K_new) and BNMTF.S.shape == (K_new,L_new) and BNMTF.G.shape == (J,L_new)
+    assert numpy.allclose(numpy.dot(BNMTF.F,numpy.dot(BNMTF.S,BNMTF.G.T)),numpy.dot(model.F,numpy.dot(model.S,model.G.T)))
+    (residual,FS,GS) = BNMTF.compute_residual_products()
+    assert numpy.allclose(BNMTF.residual,residual)
+    
+    BNMTF.run(2)
+    with pytest.raises(AssertionError) as error:
+        bnmtf_gibbs_optimised(R,M,1,L,priors(1,L)).initialise_warm(model,'split')
+    assert str(error.value) == "Cannot warm start from a model with more factors: 2 > 1."
     
     
 """ Test computing values for alpha, beta, mu, tau. """
@@ -308,6 +333,208 @@ def test_run():
     assert taus[1] != alpha/float(beta)
     
     
+""" Test that keeping running means of the draws gives the same results as storing them all. """
+def test_run_sample_store(tmpdir):
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    iterations, burn_in, thinning = 20, 5, 3
+    
+    numpy.random.seed(0)
+    full = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    full.initialise('random','random')
+    full.run(iterations)
+    
+    numpy.random.seed(0)
+    store = SampleStore(burn_in,thinning,filename=str(tmpdir.join('samples')))
+    streamed = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    streamed.initialise('random','random')
+    draws = streamed.run(iterations,sample_store=store)
+    
+    assert all([draw is None for draw in draws[:-1]])
+    assert numpy.array_equal(full.all_tau,streamed.all_tau)
+    for (expected,streamed_mean) in zip(full.approx_expectation(burn_in,thinning),streamed.approx_expectation(burn_in,thinning)):
+        assert numpy.allclose(expected,streamed_mean)
+    assert numpy.array_equal(store.samples('F'),full.all_F[burn_in::thinning])
+    assert numpy.array_equal(store.samples('S'),full.all_S[burn_in::thinning])
+    assert numpy.array_equal(store.samples('G'),full.all_G[burn_in::thinning])
+    for metric in ['MSE','R^2','Rp']:
+        assert numpy.allclose(full.predict(M_test,burn_in,thinning)[metric],streamed.predict(M_test,burn_in,thinning)[metric],equal_nan=True)
+    for metric in ['loglikelihood','BIC','AIC','MSE']:
+        assert numpy.allclose(full.quality(metric,burn_in,thinning),streamed.quality(metric,burn_in,thinning))
+    with pytest.raises(AssertionError):
+        streamed.approx_expectation(burn_in,1)
+    
+    
+""" Test that resuming a run gives the same draws as one longer run. """
+def test_run_resume():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    
+    full = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    full.initialise('random','random',seed=0)
+    full.run(5)
+    resumed = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    resumed.initialise('random','random',seed=0)
+    resumed.run(2)
+    draws = resumed.run(3,resume=True)
+    
+    assert all([numpy.array_equal(expected,draw) for (expected,draw) in zip((full.all_F,full.all_S,full.all_G,full.all_tau),draws)])
+    assert full.all_performances == resumed.all_performances
+    assert resumed.all_iterations == [1,2,3,4,5]
+    assert full.quality('loglikelihood',2,1) == resumed.quality('loglikelihood',2,1)
+    
+    streamed = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    streamed.initialise('random','random',seed=0)
+    streamed.run(2,sample_store=SampleStore(1))
+    with pytest.raises(AssertionError) as error:
+        streamed.run(3,resume=True)
+    assert str(error.value) == "Cannot resume a run that uses a SampleStore."
+    
+    
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,sparse=sparse)
+        BNMTF.initialise('random','random')
+        BNMTF.run(4)
+        models.append(BNMTF)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.all_F,sparse.all_F)
+    assert numpy.allclose(dense.all_S,sparse.all_S)
+    assert numpy.allclose(dense.all_G,sparse.all_G)
+    assert numpy.allclose(dense.all_tau,sparse.all_tau)
+    assert numpy.allclose([dense.predict(M_test,2,1)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test,2,1)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.quality('loglikelihood',2,1), sparse.quality('loglikelihood',2,1))
+    
+    
+""" Test that running in float32 gives (nearly) the same draws and performances as float64. """
+def test_run_float32():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    
+    models = []
+    for dtype in [numpy.float64,numpy.float32]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,dtype=dtype)
+        BNMTF.initialise('random','random')
+        BNMTF.run(4)
+        models.append(BNMTF)
+    (double,single) = models
+    
+    assert single.all_F.dtype == single.all_S.dtype == single.all_G.dtype == numpy.float32
+    assert numpy.allclose(double.all_F,single.all_F,rtol=1e-3,atol=1e-5)
+    assert numpy.allclose(double.all_tau,single.all_tau,rtol=1e-3)
+    assert numpy.allclose(double.all_performances['MSE'],single.all_performances['MSE'],rtol=1e-3)
+    
+    
+""" Test that the residual maintained using rank-1 updates matches the one computed from scratch. """
+def test_update_residual():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    for sparse in [False,True]:
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,sparse=sparse,cache_residual=True)
+        BNMTF.initialise('random','random')
+        
+        BNMTF.F[:,1] = 2.
+        BNMTF.update_residual_F(1)
+        BNMTF.S[2,0] = 3.
+        BNMTF.update_residual_S(2,0)
+        BNMTF.G[:,1] = 4.
+        BNMTF.update_residual_G(1)
+        
+        (residual,FS,GS) = BNMTF.compute_residual_products()
+        assert numpy.allclose(BNMTF.residual,residual)
+        assert numpy.allclose(BNMTF.FS,FS)
+        assert numpy.allclose(BNMTF.GS,GS)
+        
+def test_run_cache_residual():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for cache_residual in [False,True]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,cache_residual=cache_residual)
+        BNMTF.initialise('random','random')
+        BNMTF.run(4)
+        models.append(BNMTF)
+    (recomputed,cached) = models
+    
+    assert numpy.allclose(recomputed.all_F,cached.all_F)
+    assert numpy.allclose(recomputed.all_S,cached.all_S)
+    assert numpy.allclose(recomputed.all_G,cached.all_G)
+    assert numpy.allclose(recomputed.all_tau,cached.all_tau)
+    
+    
+def test_run_batch_S():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for sparse,batch_S in [(False,False),(False,True),(True,True)]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,sparse=sparse,batch_S=batch_S)
+        BNMTF.initialise('random','random')
+        BNMTF.run(4)
+        models.append(BNMTF)
+    
+    for BNMTF in models[1:]:
+        assert numpy.allclose(models[0].all_F,BNMTF.all_F)
+        assert numpy.allclose(models[0].all_S,BNMTF.all_S)
+        assert numpy.allclose(models[0].all_G,BNMTF.all_G)
+        assert numpy.allclose(models[0].all_tau,BNMTF.all_tau)
+    
+    
 """ Test approximating the expectations for F, S, G, tau """
 def test_approx_expectation():
     burn_in = 2
@@ -220,6 +220,34 @@ def test_initialise():
         assert BNMTF.tauG[j,l] == 4.
         
         
+""" Test initialising from the fit of a model with fewer factors """
+def test_initialise_warm():
+    I,J,K,L,K_new,L_new = 5,3,2,2,3,4
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = lambda K,L: { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    
+    model = bnmtf_vb_optimised(R,M,K,L,priors(K,L))
+    model.initialise('random','random')
+    model.run(2)
+    
+    # Splitting keeps muF muS muG^T, and copies the taus of the split columns
+    BNMTF = bnmtf_vb_optimised(R,M,K_new,L_new,priors(K_new,L_new))
+    BNMTF.initialise_warm(model,'split',seed=0)
+    assert BNMTF.muS.shape == (K_new,L_new) and BNMTF.tauS.shape == (K_new,L_new) and BNMTF.expS.shape == (K_new,L_new)
+    assert BNMTF.muF.shape == (I,K_new) and BNMTF.muG.shape == (J,L_new)
+    assert numpy.allclose(numpy.dot(BNMTF.muF,numpy.dot(BNMTF.muS,BNMTF.muG.T)),numpy.dot(model.muF,numpy.dot(model.muS,model.muG.T)))
+    assert numpy.array_equal(BNMTF.tauF[:,:K],model.tauF) and numpy.array_equal(BNMTF.tauS[:K,:L],model.tauS)
+    assert BNMTF.exptau != numpy.inf and not math.isnan(BNMTF.exptau)
+    
+    # Drawing from the prior keeps the old columns, with tau = 1 for the new ones
+    BNMTF = bnmtf_vb_optimised(R,M,K_new,L_new,priors(K_new,L_new))
+    BNMTF.initialise_warm(model,'prior',seed=0)
+    assert numpy.array_equal(BNMTF.muF[:,:K],model.muF) and numpy.array_equal(BNMTF.muS[:K,:L],model.muS)
+    assert numpy.array_equal(BNMTF.tauS[K:,:],numpy.ones((K_new-K,L_new))) and numpy.array_equal(BNMTF.tauS[:,L:],numpy.ones((K_new,L_new-L)))
+    BNMTF.run(2)
+        
+        
 """ Test computing the ELBO. """
 def test_elbo():
     I,J,K,L = 5,3,2,4
@@ -511,6 +539,157 @@ def test_run():
     assert BNMF.explogtau != numpy.inf and not math.isnan(BNMF.explogtau)
     
 
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,sparse=sparse)
+        BNMTF.initialise('random','random')
+        BNMTF.run(3)
+        models.append(BNMTF)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.muF,sparse.muF)
+    assert numpy.allclose(dense.tauF,sparse.tauF)
+    assert numpy.allclose(dense.muS,sparse.muS)
+    assert numpy.allclose(dense.tauS,sparse.tauS)
+    assert numpy.allclose(dense.muG,sparse.muG)
+    assert numpy.allclose(dense.tauG,sparse.tauG)
+    assert numpy.allclose(dense.exptau,sparse.exptau)
+    assert numpy.allclose([dense.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.elbo(), sparse.elbo())
+    assert numpy.allclose(dense.quality('loglikelihood'), sparse.quality('loglikelihood'))
+    
+    
+""" Test that running in float32 gives (nearly) the same performances as float64. """
+def test_run_float32():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    
+    for (sparse,cache_residual,batch_S) in [(False,False,False),(True,False,False),(False,True,True)]:
+        models = []
+        for dtype in [numpy.float64,numpy.float32]:
+            numpy.random.seed(0)
+            BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,sparse=sparse,cache_residual=cache_residual,batch_S=batch_S,dtype=dtype)
+            BNMTF.initialise('random','random')
+            BNMTF.run(5)
+            models.append(BNMTF)
+        (double,single) = models
+        
+        for matrix in [single.expF,single.varF,single.expS,single.varS,single.expG,single.varG]:
+            assert matrix.dtype == numpy.float32
+        assert numpy.allclose(double.exptau,single.exptau,rtol=1e-4)
+        assert numpy.allclose(double.all_performances['ELBO'],single.all_performances['ELBO'],rtol=1e-4)
+        assert numpy.allclose(double.all_performances['MSE'],single.all_performances['MSE'],rtol=1e-4)
+    
+    
+""" Test that the residual maintained using rank-1 updates matches the one computed from scratch. """
+def test_update_residual():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    for sparse in [False,True]:
+        BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,sparse=sparse,cache_residual=True)
+        BNMTF.initialise('random','random')
+        
+        BNMTF.expF[:,1] = 2.
+        BNMTF.update_residual_F(1)
+        BNMTF.expS[2,0] = 3.
+        BNMTF.update_residual_S(2,0)
+        BNMTF.expG[:,1] = 4.
+        BNMTF.update_residual_G(1)
+        
+        (residual,FS,GS) = BNMTF.compute_residual_products()
+        assert numpy.allclose(BNMTF.residual,residual)
+        assert numpy.allclose(BNMTF.FS,FS)
+        assert numpy.allclose(BNMTF.GS,GS)
+        
+def test_run_cache_residual():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for cache_residual in [False,True]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,cache_residual=cache_residual)
+        BNMTF.initialise('random','random')
+        BNMTF.run(3)
+        models.append(BNMTF)
+    (recomputed,cached) = models
+    
+    assert numpy.allclose(recomputed.muF,cached.muF)
+    assert numpy.allclose(recomputed.tauF,cached.tauF)
+    assert numpy.allclose(recomputed.muS,cached.muS)
+    assert numpy.allclose(recomputed.tauS,cached.tauS)
+    assert numpy.allclose(recomputed.muG,cached.muG)
+    assert numpy.allclose(recomputed.tauG,cached.tauG)
+    assert numpy.allclose(recomputed.exptau,cached.exptau)
+    # The training performances should be the same when computed from the cached residual
+    for metric in ['ELBO','MSE','R^2','Rp']:
+        assert numpy.allclose(recomputed.all_performances[metric],cached.all_performances[metric])
+    
+    
+def test_run_batch_S():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for sparse,batch_S in [(False,False),(False,True),(True,True)]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,sparse=sparse,batch_S=batch_S)
+        BNMTF.initialise('random','random')
+        BNMTF.run(3)
+        models.append(BNMTF)
+    
+    for BNMTF in models[1:]:
+        assert numpy.allclose(models[0].muS,BNMTF.muS)
+        assert numpy.allclose(models[0].tauS,BNMTF.tauS)
+        assert numpy.allclose(models[0].expS,BNMTF.expS)
+        assert numpy.allclose(models[0].muF,BNMTF.muF)
+        assert numpy.allclose(models[0].muG,BNMTF.muG)
+        assert numpy.allclose(models[0].exptau,BNMTF.exptau)
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K) = (5,3,2)
@@ -0,0 +1,81 @@
+"""
+Tests for the on-disk cache of model fits, in fit_cache.py
+"""
+
+from BNMTF.code.fit_cache import FitCache
+from BNMTF.code.bnmf_vb_optimised import bnmf_vb_optimised
+from BNMTF.code.bnmf_gibbs_optimised import bnmf_gibbs_optimised
+import numpy, pytest, os, pickle
+
+
+""" Test the keys of the fits """
+def test_key(tmpdir):
+    cache = FitCache(str(tmpdir.join('fits')))
+    assert os.path.isdir(str(tmpdir.join('fits')))
+
+    R, M = numpy.ones((3,2)), numpy.ones((3,2))
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':numpy.ones((3,2)), 'lambdaV':numpy.float64(2.) }
+    key = cache.key(R,M,classifier=bnmf_vb_optimised,K=2,priors=priors,seed=1)
+    assert len(key) == 40
+    assert key == FitCache(str(tmpdir)).key(R.copy(),M.copy(),classifier=bnmf_vb_optimised,K=2,priors=dict(priors,lambdaU=numpy.ones((3,2))),seed=1)
+    assert key != cache.key(R,M,classifier=bnmf_vb_optimised,K=2,priors=priors,seed=2)
+    assert key != cache.key(R,numpy.ones((3,2),dtype=int),classifier=bnmf_vb_optimised,K=2,priors=priors,seed=1)
+    assert key != cache.key(R,numpy.ones((2,3)),classifier=bnmf_vb_optimised,K=2,priors=priors,seed=1)
+    assert key != cache.key(R,M,classifier=bnmf_gibbs_optimised,K=2,priors=priors,seed=1)
+
+    with pytest.raises(TypeError) as error:
+        cache.key(R,M,priors=set([1]))
+    assert str(error.value) == "Cannot store set([1]) in the fit cache."
+
+    # The hashes are not sent to other processes
+    assert pickle.loads(pickle.dumps(cache)).hashes == {}
+
+
+""" Test adding fits and getting them back """
+def test_add_get(tmpdir):
+    cache = FitCache(str(tmpdir))
+    I,J,K = 5,4,2
+    R, M = numpy.random.rand(I,J), numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5*numpy.ones((I,K)), 'lambdaV':6*numpy.ones((J,K)) }
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise(seed=0)
+    BNMF.run(3)
+
+    key = cache.key(R,M,K=K,seed=0)
+    assert cache.get(key) is None
+    qualities = { 'MSE' : BNMF.quality('MSE'), 'loglikelihood' : BNMF.quality('loglikelihood') }
+    cache.add(key,BNMF,qualities,{ 'test1' : {'MSE':1.5} })
+    assert sorted(os.listdir(str(tmpdir))) == [key+'.json',key+'.npz']
+
+    record = cache.get(key)
+    assert record['qualities'] == qualities
+    assert record['iterations'] == [1,2,3]
+    assert record['performances']['MSE'] == BNMF.all_performances['MSE']
+    assert record['predictions'] == { 'test1' : {'MSE':1.5} }
+    assert all(isinstance(name,str) for name in record['qualities'])
+
+    moments = cache.moments(key)
+    assert sorted(moments.keys()) == ['expU','expV','exptau','varU','varV']
+    assert numpy.array_equal(moments['expU'],BNMF.expU)
+
+    # Adding the fit again keeps the performances on the other test sets
+    cache.add(key,BNMF,qualities,{ 'test2' : {'MSE':2.5} })
+    assert cache.get(key)['predictions'] == { 'test1' : {'MSE':1.5}, 'test2' : {'MSE':2.5} }
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+""" Test storing the expectations over the draws for Gibbs """
+def test_add_gibbs(tmpdir):
+    cache = FitCache(str(tmpdir))
+    I,J,K = 5,4,2
+    R, M = numpy.random.rand(I,J), numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5*numpy.ones((I,K)), 'lambdaV':6*numpy.ones((J,K)) }
+    BNMF = bnmf_gibbs_optimised(R,M,K,priors)
+    BNMF.initialise(seed=0)
+    BNMF.run(10)
+
+    cache.add('gibbs',BNMF,{ 'MSE' : BNMF.quality('MSE',4,2) },quality_args={'burn_in':4,'thinning':2})
+    moments = cache.moments('gibbs')
+    assert sorted(moments.keys()) == ['U','V','expU','expV','exptau','tau']
+    assert numpy.array_equal(moments['expU'],BNMF.approx_expectation(4,2)[0])
+    assert numpy.array_equal(moments['U'],BNMF.U)
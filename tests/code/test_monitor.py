@@ -0,0 +1,84 @@
+"""
+Tests for the class monitoring the performances of the inference methods.
+"""
+
+import numpy, pytest
+from BNMTF.code.monitor import Monitor
+
+
+class Model:
+    def __init__(self):
+        self.all_iterations = []
+        self.all_performances = { 'ELBO' : [], 'MSE' : [] }
+        
+    def compute_MSE(self,M,R,R_pred):
+        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        
+    def compute_R2(self,M,R,R_pred):
+        raise Exception("Should not compute R^2.")
+        
+    def compute_Rp(self,M,R,R_pred):
+        raise Exception("Should not compute Rp.")
+        
+        
+""" Test constructor and initialise """
+def test_init():
+    with pytest.raises(AssertionError) as error:
+        Monitor(interval=0)
+    assert str(error.value) == "Evaluation interval should be at least 1, but is 0."
+    
+    monitor = Monitor()
+    monitor.initialise(['ELBO','MSE','R^2','Rp'])
+    assert monitor.metrics == ['ELBO','MSE','R^2','Rp']
+    
+    monitor = Monitor(metrics=['I-divergence'])
+    with pytest.raises(AssertionError) as error:
+        monitor.initialise(['ELBO','MSE','R^2','Rp'])
+    assert str(error.value) == "Metric I-divergence is not available for this model. Should be one of ['ELBO', 'MSE', 'R^2', 'Rp']."
+    
+
+""" Test which iterations we evaluate """
+def test_evaluate():
+    monitor = Monitor(interval=3)
+    assert [it for it in range(0,10) if monitor.evaluate(it,10)] == [2,5,8,9]
+    monitor = Monitor()
+    assert [it for it in range(0,4) if monitor.evaluate(it,4)] == [0,1,2,3]
+    
+    
+""" Test computing only the requested performances """
+def test_performances():
+    M, R, R_pred = numpy.array([1.,1.,0.]), numpy.array([1.,2.,3.]), numpy.array([2.,2.,10.])
+    calls = []
+    def predictions():
+        calls.append(1)
+        return (M,R,R_pred)
+    
+    monitor = Monitor(metrics=['ELBO','MSE'])
+    monitor.initialise(['ELBO','MSE','R^2','Rp'])
+    performances = monitor.performances(Model(),predictions,{'ELBO':lambda: -10.})
+    assert performances == { 'ELBO' : -10., 'MSE' : 0.5 }
+    assert len(calls) == 1
+    
+    # If we do not need the predictions, we should not compute them
+    monitor = Monitor(metrics=['ELBO'])
+    monitor.initialise(['ELBO','MSE','R^2','Rp'])
+    assert monitor.performances(Model(),predictions,{'ELBO':lambda: -10.}) == { 'ELBO' : -10. }
+    assert len(calls) == 1
+    
+    
+""" Test storing, printing, and passing on the performances """
+def test_record(capsys):
+    callbacks = []
+    monitor = Monitor(metrics=['ELBO','MSE'],callback=lambda it,perf: callbacks.append((it,perf)))
+    monitor.initialise(['ELBO','MSE','R^2','Rp'])
+    model = Model()
+    monitor.record(model,3,{ 'ELBO' : -10., 'MSE' : 0.5 })
+    assert model.all_iterations == [3]
+    assert model.all_performances == { 'ELBO' : [-10.], 'MSE' : [0.5] }
+    assert capsys.readouterr()[0] == "Iteration 3. ELBO: -10.0. MSE: 0.5.\n"
+    assert callbacks == [(3,{ 'ELBO' : -10., 'MSE' : 0.5 })]
+    
+    monitor = Monitor(metrics=['MSE'],silent=True)
+    monitor.initialise(['ELBO','MSE','R^2','Rp'])
+    monitor.record(Model(),1,{ 'MSE' : 0.5 })
+    assert capsys.readouterr()[0] == ""
@@ -223,6 +223,35 @@ def test_run():
     assert NMF.all_tau[1] != alpha/float(beta)
 
     
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    lambdaU = 2*numpy.ones((I,K))
+    lambdaV = 3*numpy.ones((J,K))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        NMF = nmf_icm(R,M,K,priors,sparse=sparse)
+        NMF.initialise('random')
+        NMF.run(3)
+        models.append(NMF)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.U,sparse.U)
+    assert numpy.allclose(dense.V,sparse.V)
+    assert numpy.allclose(dense.tau,sparse.tau)
+    assert numpy.allclose([dense.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.quality('loglikelihood'), sparse.quality('loglikelihood'))
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K) = (5,3,2)
@@ -4,6 +4,7 @@ Unit tests for the methods in the NMF class (/code/nmf_np.py).
 
 import numpy, math, pytest, itertools
 from BNMTF.code.nmf_np import NMF
+from BNMTF.code.stopping_criterion import StoppingCriterion
 
 
 """ Test the initialisation of Omega """
@@ -188,6 +189,71 @@ def test_run():
     assert abs(U_00 - nmf.U[0][0]) < 0.000001
     
 
+""" Test stopping early, once the training MSE has converged. """
+def test_run_stopping_criterion():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    
+    criterion = StoppingCriterion('MSE',1e-6)
+    nmf = NMF(R,M,K)
+    nmf.initialise('random')
+    nmf.run(1000,stopping_criterion=criterion)
+    
+    assert len(nmf.all_performances['MSE']) < 1000
+    assert abs(nmf.all_performances['MSE'][-1] - nmf.all_performances['MSE'][-2]) < 1e-6
+    assert nmf.stop_reason == criterion.reason
+    
+    with pytest.raises(AssertionError) as error:
+        nmf.run(10,stopping_criterion=StoppingCriterion('ELBO',1e-6))
+    assert str(error.value) == "Stopping criterion ELBO is not available for this model."
+    
+    
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J) + 0.1
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        nmf = NMF(R,M,K,sparse=sparse)
+        nmf.initialise('random')
+        nmf.run(3)
+        models.append(nmf)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.U,sparse.U)
+    assert numpy.allclose(dense.V,sparse.V)
+    assert numpy.allclose([dense.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.compute_I_div(), sparse.compute_I_div())
+    
+    
+""" Test that running in float32 gives (nearly) the same performances as float64. """
+def test_run_float32():
+    I,J,K = 10,5,2
+    R = numpy.random.rand(I,J) + 0.1
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    models = []
+    for dtype in [numpy.float64,numpy.float32]:
+        numpy.random.seed(0)
+        nmf = NMF(R,M,K,dtype=dtype)
+        nmf.initialise('random')
+        nmf.run(5)
+        models.append(nmf)
+    (double,single) = models
+    
+    assert single.U.dtype == single.V.dtype == numpy.float32
+    assert numpy.allclose(double.U,single.U,rtol=1e-4)
+    assert numpy.allclose(double.all_performances['MSE'],single.all_performances['MSE'],rtol=1e-4)
+    assert numpy.allclose(double.all_performances['I-divergence'],single.all_performances['I-divergence'],rtol=1e-4)
+    
+    
 """ Test divergence calculation """
 def test_compute_I_div():
     R = [[1,2,0,4],[5,0,7,0]]
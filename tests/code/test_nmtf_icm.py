@@ -294,6 +294,140 @@ def test_run():
     assert NMTF.all_tau[1] != alpha/float(beta)
     
     
+""" Test that resuming a run gives the same values as one longer run. """
+def test_run_resume():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2*numpy.ones((I,K)), 'lambdaS':3*numpy.ones((K,L)), 'lambdaG':4*numpy.ones((J,L)) }
+    
+    full = nmtf_icm(R,M,K,L,priors)
+    full.initialise('random','random',seed=0)
+    full.run(5,minimum_TN=0.1)
+    resumed = nmtf_icm(R,M,K,L,priors)
+    resumed.initialise('random','random',seed=0)
+    resumed.run(2,minimum_TN=0.1)
+    resumed.run(3,minimum_TN=0.1,resume=True)
+    
+    assert numpy.array_equal(full.F,resumed.F) and numpy.array_equal(full.S,resumed.S) and numpy.array_equal(full.G,resumed.G)
+    assert numpy.array_equal(full.all_tau,resumed.all_tau)
+    assert resumed.all_iterations == [1,2,3,4,5]
+    
+    
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        NMTF = nmtf_icm(R,M,K,L,priors,sparse=sparse)
+        NMTF.initialise('random','random')
+        NMTF.run(3)
+        models.append(NMTF)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.F,sparse.F)
+    assert numpy.allclose(dense.S,sparse.S)
+    assert numpy.allclose(dense.G,sparse.G)
+    assert numpy.allclose(dense.tau,sparse.tau)
+    assert numpy.allclose([dense.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.quality('loglikelihood'), sparse.quality('loglikelihood'))
+    
+    
+""" Test that the residual maintained using rank-1 updates matches the one computed from scratch. """
+def test_update_residual():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    for sparse in [False,True]:
+        BNMTF = nmtf_icm(R,M,K,L,priors,sparse=sparse,cache_residual=True)
+        BNMTF.initialise('random','random')
+        
+        BNMTF.F[:,1] = 2.
+        BNMTF.update_residual_F(1)
+        BNMTF.S[2,0] = 3.
+        BNMTF.update_residual_S(2,0)
+        BNMTF.G[:,1] = 4.
+        BNMTF.update_residual_G(1)
+        
+        (residual,FS,GS) = BNMTF.compute_residual_products()
+        assert numpy.allclose(BNMTF.residual,residual)
+        assert numpy.allclose(BNMTF.FS,FS)
+        assert numpy.allclose(BNMTF.GS,GS)
+        
+def test_run_cache_residual():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for cache_residual in [False,True]:
+        numpy.random.seed(0)
+        BNMTF = nmtf_icm(R,M,K,L,priors,cache_residual=cache_residual)
+        BNMTF.initialise('random','random')
+        BNMTF.run(3)
+        models.append(BNMTF)
+    (recomputed,cached) = models
+    
+    assert numpy.allclose(recomputed.F,cached.F)
+    assert numpy.allclose(recomputed.S,cached.S)
+    assert numpy.allclose(recomputed.G,cached.G)
+    assert numpy.allclose(recomputed.tau,cached.tau)
+    
+    
+def test_run_batch_S():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    lambdaF = 2*numpy.ones((I,K))
+    lambdaS = 3*numpy.ones((K,L))
+    lambdaG = 4*numpy.ones((J,L))
+    alpha, beta = 3, 1
+    priors = { 'alpha':alpha, 'beta':beta, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+    
+    models = []
+    for sparse,batch_S in [(False,False),(False,True),(True,True)]:
+        numpy.random.seed(0)
+        BNMTF = nmtf_icm(R,M,K,L,priors,sparse=sparse,batch_S=batch_S)
+        BNMTF.initialise('random','random')
+        BNMTF.run(3)
+        models.append(BNMTF)
+    
+    for BNMTF in models[1:]:
+        assert numpy.allclose(models[0].F,BNMTF.F)
+        assert numpy.allclose(models[0].S,BNMTF.S)
+        assert numpy.allclose(models[0].G,BNMTF.G)
+        assert numpy.allclose(models[0].tau,BNMTF.tau)
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K,L) = (5,3,2,4)
@@ -213,6 +213,30 @@ def test_run():
     
     
 
+""" Test that computing the updates over the observed entries only gives the same results. """
+def test_run_sparse():
+    I,J,K,L = 10,5,3,2
+    R = numpy.random.rand(I,J) + 0.1
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    M_test = 1 - M
+    
+    models = []
+    for sparse in [False,True]:
+        numpy.random.seed(0)
+        nmtf = NMTF(R,M,K,L,sparse=sparse)
+        nmtf.initialise('random','random')
+        nmtf.run(3)
+        models.append(nmtf)
+    (dense,sparse) = models
+    
+    assert numpy.allclose(dense.F,sparse.F)
+    assert numpy.allclose(dense.S,sparse.S)
+    assert numpy.allclose(dense.G,sparse.G)
+    assert numpy.allclose([dense.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], [sparse.predict(M_test)[metric] for metric in ['MSE','R^2','Rp']], equal_nan=True)
+    assert numpy.allclose(dense.compute_I_div(), sparse.compute_I_div())
+    
+    
 """ Test divergence calculation """
 def test_compute_I_div():
     R = numpy.array([[1,2],[3,4]],dtype=float)
@@ -0,0 +1,81 @@
+"""
+Tests for the class storing the observed entries of a matrix.
+"""
+
+import numpy, pytest, scipy.sparse
+from BNMTF.code.observed_entries import ObservedEntries
+
+
+I,J,K = 4,3,2
+R = numpy.array([[1.,2.,3.],[4.,5.,6.],[7.,8.,9.],[10.,11.,12.]])
+M = numpy.array([[1,0,1],[1,1,1],[0,0,1],[1,1,0]])
+A = numpy.arange(I*K,dtype=float).reshape((I,K))
+B = numpy.arange(J*K,dtype=float).reshape((J,K)) + 1.
+
+
+""" Test constructor """
+def test_init():
+    R1 = numpy.ones((3,2))
+    with pytest.raises(AssertionError) as error:
+        ObservedEntries(R1,M)
+    assert str(error.value) == "Input matrix R is not of the same size as the indicator matrix M: (3, 2) and (4, 3) respectively."
+
+    omega = ObservedEntries(R,M)
+    assert omega.I == I and omega.J == J
+    assert omega.size == 8
+    assert numpy.array_equal(omega.rows, [0,0,1,1,1,2,3,3])
+    assert numpy.array_equal(omega.columns, [0,2,0,1,2,2,0,1])
+    assert numpy.array_equal(omega.values, [1.,3.,4.,5.,6.,9.,10.,11.])
+
+
+""" Test the masked operations against their dense equivalents """
+def test_row_column_sums():
+    omega = ObservedEntries(R,M)
+    assert numpy.array_equal(omega.row_sums(omega.values), (M*R).sum(axis=1))
+    assert numpy.array_equal(omega.column_sums(omega.values), (M*R).sum(axis=0))
+
+    # Rows or columns without observed entries should still give a 0
+    M_empty = numpy.zeros((I,J))
+    M_empty[1,1] = 1
+    omega = ObservedEntries(R,M_empty)
+    assert numpy.array_equal(omega.row_sums(omega.values), [0.,5.,0.,0.])
+    assert numpy.array_equal(omega.column_sums(omega.values), [0.,5.,0.])
+
+def test_dot():
+    omega = ObservedEntries(R,M)
+    expected = numpy.dot(A,B.T)[M == 1]
+    assert numpy.array_equal(omega.dot(A,B), expected)
+
+def test_outer():
+    omega = ObservedEntries(R,M)
+    a, b = A[:,0], B[:,1]
+    expected = numpy.outer(a,b)[M == 1]
+    assert numpy.array_equal(omega.outer(a,b), expected)
+
+def test_matrix():
+    omega = ObservedEntries(R,M)
+    assert numpy.array_equal(omega.matrix(omega.values).toarray(), M*R)
+    assert numpy.array_equal(omega.matrix(omega.values).dot(B), numpy.dot(M*R,B))
+
+def test_counts_dense():
+    omega = ObservedEntries(R,M)
+    assert numpy.array_equal(omega.counts()[0], M.sum(axis=1))
+    assert numpy.array_equal(omega.counts()[1], M.sum(axis=0))
+    assert numpy.array_equal(omega.dense()[0], M*R)
+    assert numpy.array_equal(omega.dense()[1], M)
+
+
+""" Test giving R and M as scipy.sparse matrices """
+def test_sparse_inputs():
+    (rows,columns) = numpy.nonzero(M)
+    M_sparse = scipy.sparse.coo_matrix((numpy.ones(len(rows)),(rows,columns)),shape=(I,J))
+    omega, omega_sparse = ObservedEntries(R,M), ObservedEntries(scipy.sparse.coo_matrix(R),M_sparse)
+    assert numpy.array_equal(omega_sparse.rows, omega.rows)
+    assert numpy.array_equal(omega_sparse.columns, omega.columns)
+    assert numpy.array_equal(omega_sparse.values, omega.values)
+    assert numpy.array_equal(omega_sparse.counts()[0], M.sum(axis=1))
+    assert numpy.array_equal(omega_sparse.counts()[1], M.sum(axis=0))
+
+    # Explicitly stored zeros in M are not observed entries
+    M_zeros = scipy.sparse.csr_matrix((numpy.zeros(1),([0],[0])),shape=(I,J))
+    assert ObservedEntries(R,M_zeros).values.size == 0
@@ -0,0 +1,24 @@
+"""
+Tests for the random states of the models, in random_state.py
+"""
+
+from BNMTF.code.random_state import random_state, spawn_seeds
+import numpy
+
+
+""" Test getting the random state for a seed """
+def test_random_state():
+    assert random_state(None) is numpy.random
+    state = numpy.random.RandomState(0)
+    assert random_state(state) is state
+    assert numpy.array_equal(random_state(3).rand(5),numpy.random.RandomState(3).rand(5))
+    
+    
+""" Test spawning seeds for independent tasks """
+def test_spawn_seeds():
+    assert spawn_seeds(None,3) == [None,None,None]
+    seeds = spawn_seeds(0,5)
+    assert seeds == spawn_seeds(0,5)
+    assert len(set(seeds)) == 5
+    assert all([isinstance(seed,int) for seed in seeds])
+    assert seeds != spawn_seeds(1,5)
@@ -0,0 +1,70 @@
+"""
+Tests for the class storing the running means and variances of the Gibbs draws.
+"""
+
+import numpy, pytest
+from BNMTF.code.sample_store import SampleStore
+
+
+""" Test constructor """
+def test_init():
+    with pytest.raises(AssertionError) as error:
+        SampleStore(-1)
+    assert str(error.value) == "Burn-in should be at least 0, but is -1."
+    with pytest.raises(AssertionError) as error:
+        SampleStore(5,thinning=0)
+    assert str(error.value) == "Thinning should be at least 1, but is 0."
+    
+
+""" Test the running means and variances against the full trace """
+def test_add():
+    iterations, burn_in, thinning = 20, 5, 3
+    numpy.random.seed(0)
+    trace_A = numpy.random.rand(iterations,4,2)
+    trace_b = numpy.random.rand(iterations)
+    
+    store = SampleStore(burn_in,thinning)
+    store.initialise(iterations,{'A':(4,2),'b':()})
+    for it in range(0,iterations):
+        store.add(it,{'A':trace_A[it],'b':trace_b[it]})
+        
+    indices = range(burn_in,iterations,thinning)
+    assert store.count == len(indices) == 5
+    assert numpy.allclose(store.mean('A'),trace_A[indices].mean(axis=0))
+    assert numpy.allclose(store.variance('A'),trace_A[indices].var(axis=0))
+    assert numpy.allclose(store.mean('b'),trace_b[indices].mean())
+    assert numpy.allclose(store.variance('b'),trace_b[indices].var())
+    
+    # The draws should not be kept without a filename
+    with pytest.raises(AssertionError) as error:
+        store.samples('A')
+    assert str(error.value) == "Samples are only kept if a filename is given."
+    
+def test_samples(tmpdir):
+    iterations, burn_in, thinning = 10, 2, 2
+    trace = numpy.arange(iterations*3,dtype=float).reshape((iterations,3))
+    
+    filename = str(tmpdir.join('samples'))
+    store = SampleStore(burn_in,thinning,filename=filename)
+    store.initialise(iterations,{'A':(3,)})
+    for it in range(0,7):
+        store.add(it,{'A':trace[it]})
+        
+    # We stopped after 7 iterations, so we kept the draws of iterations 2, 4, 6
+    assert numpy.array_equal(store.samples('A'),trace[[2,4,6]])
+    assert numpy.load(filename+'_A.npy').shape == (4,3)
+    
+    
+""" Test checking the burn-in and thinning """
+def test_check():
+    store = SampleStore(5,2)
+    store.initialise(10,{'A':(2,)})
+    with pytest.raises(AssertionError) as error:
+        store.check(5,2)
+    assert str(error.value) == "No samples were stored after the burn-in of 5 iterations."
+    
+    store.add(5,{'A':numpy.ones(2)})
+    store.check(5,2)
+    with pytest.raises(AssertionError) as error:
+        store.check(4,2)
+    assert str(error.value) == "Samples were stored with burn-in 5 and thinning 2, but burn-in 4 and thinning 2 were requested."
@@ -0,0 +1,99 @@
+"""
+Tests for the stopping criteria of the inference methods.
+"""
+
+import numpy, math, pytest
+from BNMTF.code.stopping_criterion import StoppingCriterion
+
+
+""" Test constructor """
+def test_init():
+    with pytest.raises(AssertionError) as error:
+        StoppingCriterion('LL',1.)
+    assert str(error.value) == "Unrecognised stopping criterion: LL. Should be one of ['ELBO', 'MSE', 'tau', 'Rhat', 'ESS']."
+    with pytest.raises(AssertionError) as error:
+        StoppingCriterion('MSE',1.,patience=0)
+    assert str(error.value) == "Patience should be at least 1, but is 0."
+
+    criterion = StoppingCriterion('ELBO',0.1,patience=2)
+    assert criterion.values == [] and criterion.count == 0 and criterion.reason is None
+
+
+""" Test checking values """
+def test_check_missing():
+    criterion = StoppingCriterion('ELBO',0.1)
+    with pytest.raises(AssertionError) as error:
+        criterion.check({'MSE':1.})
+    assert str(error.value) == "Stopping criterion ELBO is not available for this model."
+    criterion = StoppingCriterion('Rhat',1.1)
+    with pytest.raises(AssertionError) as error:
+        criterion.check({'MSE':1.,'tau':1.})
+    assert str(error.value) == "Stopping criterion Rhat is not available for this model."
+
+def test_check_ELBO():
+    # Relative changes: 0.5, 0.1, 0.01, 0.005
+    criterion = StoppingCriterion('ELBO',0.05,patience=2)
+    assert not criterion.check({'ELBO':-200.,'MSE':1.})
+    assert not criterion.check({'ELBO':-100.,'MSE':1.})
+    assert not criterion.check({'ELBO':-90.,'MSE':1.})
+    assert not criterion.check({'ELBO':-89.1,'MSE':1.})
+    assert criterion.check({'ELBO':-89.1*1.005,'MSE':1.})
+    assert criterion.reason.startswith("Relative change in ELBO below 0.05 for 2 iteration(s)")
+    assert criterion.reason.endswith("after 5 iterations.")
+
+    # The patience count should be reset when the criterion is not met
+    criterion = StoppingCriterion('ELBO',0.05,patience=2)
+    for ELBO,stop in [(-100.,False),(-99.,False),(-50.,False),(-49.9,False),(-49.8,True)]:
+        assert criterion.check({'ELBO':ELBO}) == stop
+
+def test_check_MSE():
+    # Absolute changes
+    criterion = StoppingCriterion('MSE',0.01)
+    assert not criterion.check({'MSE':10.})
+    assert not criterion.check({'MSE':9.})
+    assert criterion.check({'MSE':8.995})
+    assert criterion.statistics[0] is None
+    assert abs(criterion.statistics[-1] - 0.005) < 1e-10
+
+def test_check_minimum_iterations():
+    criterion = StoppingCriterion('tau',0.1,minimum_iterations=4)
+    for tau,stop in [(1.,False),(1.,False),(1.,False),(1.,True)]:
+        assert criterion.check({'tau':tau}) == stop
+
+def test_initialise():
+    criterion = StoppingCriterion('tau',0.1)
+    criterion.check({'tau':1.})
+    criterion.check({'tau':1.})
+    criterion.initialise()
+    assert criterion.values == [] and criterion.statistics == [] and criterion.count == 0 and criterion.reason is None
+
+
+""" Test the sampling criteria """
+def test_split_rhat():
+    criterion = StoppingCriterion('Rhat',1.1)
+    criterion.values = range(0,14)
+    assert criterion.split_rhat() is None # only 7 samples after burn-in
+
+    criterion.values = [100.]*8 + [1.,2.,1.,2.,1.,2.,1.,2.]
+    # chains [1,2,1,2] and [1,2,1,2]: W = 1/3, B = 0
+    assert abs(criterion.split_rhat() - math.sqrt(3./4.)) < 1e-10
+
+    criterion.values = [100.]*8 + [1.,1.,1.,1.,5.,5.,5.,5.]
+    assert criterion.split_rhat() == numpy.inf
+
+def test_effective_sample_size():
+    criterion = StoppingCriterion('ESS',5.)
+    criterion.values = [0.]*8 + [1.,-1.]*4
+    # Alternating trace, so the first autocorrelation is negative and the ESS is the number of samples
+    assert criterion.effective_sample_size() == 8.
+
+    numpy.random.seed(0)
+    criterion.values = list(numpy.repeat(numpy.random.normal(size=500),10))
+    assert criterion.effective_sample_size() < 2500 / 5.
+
+def test_check_ESS():
+    # For a constant trace the ESS is the number of samples after burn-in, which reaches 8 after 15 iterations
+    criterion = StoppingCriterion('ESS',7.)
+    for it in range(0,15):
+        assert criterion.check({'tau_sample':1.,'MSE':1.}) == (it == 14)
+    assert criterion.reason == "Effective sample size of tau above 7.0 for 1 iteration(s) (last value 8.0), after 15 iterations."
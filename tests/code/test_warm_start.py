@@ -0,0 +1,48 @@
+"""
+Tests for the warm starts of the models, in warm_start.py
+"""
+
+from BNMTF.code.warm_start import split_sources, extend_columns, copy_columns
+import numpy, pytest
+
+
+""" Test choosing the columns to split """
+def test_split_sources():
+    A = numpy.array([[1.,5.,2.],[1.,1.,3.],[1.,9.,4.]])  # variances 0, 10.67, 0.67
+    assert split_sources(A,3,'split') == []
+    assert split_sources(A,5,'split') == [1,2]
+    assert split_sources(A,7,'split') == [1,2,0,1]
+    assert split_sources(A,5,'prior') == [None,None]
+
+    with pytest.raises(AssertionError) as error:
+        split_sources(A,2,'split')
+    assert str(error.value) == "Cannot warm start from a model with more factors: 3 > 2."
+    with pytest.raises(AssertionError) as error:
+        split_sources(A,4,'kmeans')
+    assert str(error.value) == "Unknown warm start option: kmeans. Should be 'split' or 'prior'."
+
+
+""" Test that splitting columns keeps the product of the factor matrices """
+def test_extend_columns():
+    I,J,K,K_new = 5,4,2,5
+    U, V = numpy.random.rand(I,K), numpy.random.rand(J,K)
+    sources = split_sources(U,K_new,'split')
+    U_new = extend_columns(U,sources,None,numpy.random.RandomState(0))
+    V_new = copy_columns(V,sources,None)
+    assert U_new.shape == (I,K_new) and V_new.shape == (J,K_new)
+    assert numpy.allclose(numpy.dot(U,V.T),numpy.dot(U_new,V_new.T))
+    assert numpy.array_equal(V_new[:,K:],V[:,sources])
+    assert numpy.array_equal(U_new,extend_columns(U,sources,None,numpy.random.RandomState(0)))
+    assert not numpy.array_equal(U_new[:,sources[0]],U_new[:,K])
+
+
+""" Test taking the new columns from the default values """
+def test_extend_columns_prior():
+    I,J,K,K_new = 5,4,2,4
+    U, V = numpy.random.rand(I,K), numpy.random.rand(J,K)
+    default_U, default_V = numpy.random.rand(I,K_new), numpy.random.rand(J,K_new)
+    sources = split_sources(U,K_new,'prior')
+    U_new = extend_columns(U,sources,default_U)
+    V_new = copy_columns(V,sources,default_V)
+    assert numpy.array_equal(U_new,numpy.column_stack((U,default_U[:,K:])))
+    assert numpy.array_equal(V_new,numpy.column_stack((V,default_V[:,K:])))
@@ -0,0 +1,44 @@
+"""
+Tests for the class holding the preallocated buffers of the models.
+"""
+
+import numpy
+from BNMTF.code.workspace import Workspace
+
+
+I,J,K = 4,3,2
+R = numpy.arange(I*J,dtype=float).reshape((I,J))
+M = numpy.array([[1,0,1],[1,1,1],[0,0,1],[1,1,0]],dtype=float)
+A = numpy.arange(I*K,dtype=float).reshape((I,K)) / 10.
+B = numpy.arange(J*K,dtype=float).reshape((J,K)) / 5.
+
+
+""" Test that buffers are reused, and reallocated when the shape changes """
+def test_get():
+    workspace = Workspace()
+    buffer = workspace.get('work',(I,J))
+    assert buffer.shape == (I,J)
+    assert workspace.get('work',(I,J)) is buffer
+    assert workspace.get('other',(I,J)) is not buffer
+    assert workspace.get('work',(J,I)).shape == (J,I)
+    assert Workspace(numpy.float32).get('work',(I,J)).dtype == numpy.float32
+    
+
+""" Test the operations against their numpy equivalents """
+def test_operations():
+    workspace = Workspace()
+    assert numpy.array_equal(workspace.dot('work',A,B.T), numpy.dot(A,B.T))
+    assert numpy.array_equal(workspace.outer('work',A[:,0],B[:,1]), numpy.outer(A[:,0],B[:,1]))
+    assert numpy.array_equal(workspace.multiply('work',M,B[:,0]), M*B[:,0])
+    assert numpy.array_equal(workspace.multiply('work',M,A[:,1][:,None]), (M.T*A[:,1]).T)
+    assert numpy.array_equal(workspace.residual('work',R,A,B.T), R-numpy.dot(A,B.T))
+    assert numpy.array_equal(workspace.masked_residual('work',M,R,A,B), M*(R-numpy.dot(A,B.T)))
+    
+    # All of these should have been written into the same buffer
+    assert len(workspace.buffers) == 1
+    
+def test_dot_integers():
+    workspace = Workspace()
+    A_int, B_int = numpy.ones((I,K),dtype=int), numpy.ones((J,K),dtype=int)
+    assert numpy.array_equal(workspace.dot('work',A_int,B_int.T), K*numpy.ones((I,J)))
+    assert workspace.dot('work',A_int,B_int.T).dtype == float
@@ -0,0 +1,89 @@
+"""
+Tests for the methods generating and manipulating the masks, in mask.py
+"""
+
+from BNMTF.cross_validation import mask
+import numpy
+
+
+""" Test splitting the observed entries into folds """
+def test_compute_folds():
+    I,J,no_folds = 6,5,3
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    folds_M = mask.compute_folds(I,J,no_folds,M)
+    assert len(folds_M) == no_folds
+    for fold_M in folds_M:
+        assert fold_M.dtype == bool and fold_M.shape == (I,J)
+        assert fold_M.sum() == 9
+    # The folds are disjoint, and together cover all observed entries
+    assert numpy.array_equal(sum([fold_M.astype(int) for fold_M in folds_M]), M)
+    
+def test_compute_Ms():
+    folds_M = [numpy.array([[1,0],[0,0]]),numpy.array([[0,1],[0,1]]),numpy.array([[0,0],[1,0]])]
+    expected_Ms = [numpy.array([[0,1],[1,1]]),numpy.array([[1,0],[1,0]]),numpy.array([[1,1],[0,1]])]
+    Ms = mask.compute_Ms(folds_M)
+    for M,expected_M in zip(Ms,expected_Ms):
+        assert M.dtype == bool
+        assert numpy.array_equal(M,expected_M)
+    
+    
+""" Test packing the masks into bits """
+def test_pack_M():
+    I,J = 7,13
+    M = numpy.random.rand(I,J) < 0.5
+    packed_M = mask.pack_M(M)
+    assert packed_M.shape == (I,2) and packed_M.dtype == numpy.uint8
+    assert numpy.array_equal(mask.unpack_M(packed_M,J),M)
+    
+    
+""" Test the indices of the observed entries per row and column """
+def test_nonzero_row_column_indices():
+    M = numpy.array([[1,0,1],[0,0,1],[1,1,1],[0,1,0]])
+    assert [list(indices) for indices in mask.nonzero_row_indices(M)] == [[0,2],[2],[0,1,2],[1]]
+    assert [list(indices) for indices in mask.nonzero_column_indices(M)] == [[0,2],[2,3],[0,1,2]]
+    
+    
+""" Test the fold-label matrix """
+def test_compute_fold_labels():
+    I,J,no_folds = 6,5,4
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    fold_labels = mask.compute_fold_labels(I,J,no_folds,M,seed=1)
+    assert fold_labels.dtype == numpy.int8
+    assert numpy.array_equal(fold_labels == -1, M == 0)
+    assert sorted([(fold_labels == fold).sum() for fold in range(0,no_folds)]) == [6,7,7,7]
+    # The same seed gives the same folds
+    assert numpy.array_equal(fold_labels,mask.compute_fold_labels(I,J,no_folds,M,seed=1))
+    
+    for fold in range(0,no_folds):
+        (M_train,M_test) = mask.fold_Ms(fold_labels,fold)
+        assert numpy.array_equal(M_test,fold_labels == fold)
+        assert numpy.array_equal(M_train,(M == 1) & (fold_labels != fold))
+        
+    folds_M = mask.compute_folds(I,J,no_folds,M,seed=1)
+    assert all([numpy.array_equal(fold_M,fold_labels == fold) for fold,fold_M in enumerate(folds_M)])
+    
+    
+""" Test the other mask methods """
+def test_generate_M():
+    I,J = 10,20
+    M = mask.generate_M(I,J,0.3,seed=0)
+    assert M.shape == (I,J) and M.sum() == 140
+    assert numpy.array_equal(M,mask.generate_M(I,J,0.3,seed=0))
+    
+def test_calc_inverse_M():
+    M = numpy.array([[1,0,1],[0,0,1]])
+    assert numpy.array_equal(mask.calc_inverse_M(M),[[0,1,0],[1,1,0]])
+    
+def test_nonzero_indices():
+    M = numpy.array([[1,0,1],[0,0,1]])
+    assert mask.nonzero_indices(M) == [(0,0),(0,2),(1,2)]
+    
+def test_recover_predictions():
+    M = numpy.array([[1,0,1],[0,0,1]])
+    X_true = [[1,2,3],[4,5,6]]
+    X_pred = [[1.5,2.5,3.5],[4.5,5.5,6.5]]
+    assert mask.recover_predictions(M,X_true,X_pred) == [(2,2.5),(4,4.5),(5,5.5)]
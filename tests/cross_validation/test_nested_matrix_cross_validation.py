@@ -0,0 +1,72 @@
+"""
+Tests for the nested cross-validation, in nested_matrix_cross_validation.py
+"""
+
+from BNMTF.cross_validation.nested_matrix_cross_validation import MatrixNestedCrossValidation
+from BNMTF.cross_validation import mask
+from BNMTF.tests.cross_validation.test_parallel_matrix_cross_validation import MeanModel
+import numpy, pytest, time
+
+
+""" Test running the outer folds in parallel """
+def test_run_parallel_outer(tmpdir):
+    I,J,K = 10,8,3
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    parameter_search = [{'offset':1.},{'offset':0.}]
+    files_nested_performances = [str(tmpdir.join('fold_%s.txt' % i)) for i in range(0,K)]
+    
+    numpy.random.seed(0)
+    nested = MatrixNestedCrossValidation(MeanModel,X,M,K,4,parameter_search,{'iterations':10},
+                                         str(tmpdir.join('performances.txt')),files_nested_performances,parallel_outer=True)
+    nested.run()
+    
+    # The outer folds are the first ones drawn, and the best parameters are always offset 0
+    numpy.random.seed(0)
+    fold_labels = mask.compute_fold_labels(I,J,K,M)
+    expected_MSEs = []
+    for i in range(0,K):
+        (train,test) = mask.fold_Ms(fold_labels,i)
+        model = MeanModel(X,train,offset=0.)
+        model.train(iterations=10)
+        expected_MSEs.append(model.predict(test)['MSE'])
+    assert numpy.allclose(nested.all_performances['MSE'],expected_MSEs)
+    assert numpy.allclose(nested.average_performances['MSE'],numpy.mean(expected_MSEs))
+    
+    for file_nested_performances in files_nested_performances:
+        lines = open(file_nested_performances).readlines()
+        assert lines[-1].endswith("Best parameters: {'offset': 0.0}. \n")
+    
+    
+# A model whose performances cannot be sent back from the processes
+class UnpicklableModel(MeanModel):
+    def predict(self,M_pred):
+        return { 'MSE' : lambda: 0. }
+
+# A model that takes too long to train
+class SlowModel(MeanModel):
+    def train(self,iterations):
+        time.sleep(5)
+
+
+""" Test that errors in the pool reach us, rather than leaving us waiting """
+def test_run_parallel_outer_errors(tmpdir):
+    I,J,K = 10,8,3
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    files_nested_performances = [str(tmpdir.join('fold_%s.txt' % i)) for i in range(0,K)]
+    
+    nested = MatrixNestedCrossValidation(UnpicklableModel,X,M,K,2,[{'offset':0.}],{'iterations':10},
+                                         str(tmpdir.join('performances.txt')),files_nested_performances,parallel_outer=True)
+    with pytest.raises(Exception) as error:
+        nested.run()
+    assert "Error sending result" in str(error.value)
+    
+    start = time.time()
+    nested = MatrixNestedCrossValidation(SlowModel,X,M,K,2,[{'offset':0.}],{'iterations':10},
+                                         str(tmpdir.join('performances.txt')),files_nested_performances,parallel_outer=True,timeout=0.5)
+    with pytest.raises(Exception) as error:
+        nested.run()
+    assert str(error.value) == "No training finished within 0.5 seconds, a process may have been killed."
+    assert time.time() - start < 4
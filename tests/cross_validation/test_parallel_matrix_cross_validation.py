@@ -0,0 +1,124 @@
+"""
+Tests for the parallel cross-validation, in parallel_matrix_cross_validation.py
+"""
+
+from BNMTF.cross_validation.parallel_matrix_cross_validation import ParallelMatrixCrossValidation, run_fold
+from BNMTF.cross_validation.matrix_cross_validation import MatrixCrossValidation
+from BNMTF.cross_validation import mask
+import numpy, os, tempfile
+
+
+# Model predicting the mean of the training entries plus an offset
+class MeanModel:
+    def __init__(self,X,M,offset):
+        (self.X,self.M,self.offset) = (numpy.array(X),numpy.array(M,dtype=bool),offset)
+        
+    def train(self,iterations):
+        self.mean = self.X[self.M].mean() + self.offset
+        
+    def predict(self,M_pred):
+        M_pred = numpy.array(M_pred,dtype=bool)
+        return { 'MSE' : ((self.X[M_pred] - self.mean)**2).mean() }
+
+
+""" Test running one fold from the stored data and fold-label files """
+def test_run_fold(tmpdir):
+    I,J,K = 6,5,3
+    X = numpy.arange(I*J,dtype=float).reshape((I,J))
+    fold_labels = mask.compute_fold_labels(I,J,K,seed=0)
+    (file_X,file_fold_labels) = (str(tmpdir.join('X.npy')),str(tmpdir.join('fold_labels.npy')))
+    numpy.save(file_X,X)
+    numpy.save(file_fold_labels,fold_labels)
+    
+    for fold in range(0,K):
+        performances = run_fold({ 'parameters':{'offset':1.}, 'fold':fold, 'file_X':file_X, 'file_fold_labels':file_fold_labels, 
+                                  'method':MeanModel, 'train_config':{'iterations':10} })
+        (train,test) = mask.fold_Ms(fold_labels,fold)
+        model = MeanModel(X,train,offset=1.)
+        model.train(iterations=10)
+        assert performances == model.predict(test)
+        
+
+""" Test running the cross-validation, and that the temporary files are removed """
+def test_run(tmpdir,monkeypatch):
+    monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+    I,J,K = 10,8,4
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    parameter_search = [{'offset':0.},{'offset':1.}]
+    
+    crossval = ParallelMatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},str(tmpdir.join('performances.txt')),P=2)
+    crossval.run()
+    for parameters in parameter_search:
+        assert len(crossval.all_performances[crossval.JSON(parameters)]['MSE']) == K
+    assert crossval.find_best_parameters('MSE',low_better=True)[0] == {'offset':0.}
+    assert os.listdir(str(tmpdir)) == ['performances.txt']
+    
+    
+""" Test that a failing parameter setting is logged, and the others are still run """
+def test_run_exception(tmpdir):
+    I,J,K = 10,8,4
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    parameter_search = [{'offset':0.},{'offset':'wrong'},{'offset':1.}]
+    file_performance = str(tmpdir.join('performances.txt'))
+    
+    crossval = ParallelMatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},file_performance,P=3)
+    crossval.run()
+    assert len(crossval.performances['MSE']) == 2
+    lines = open(file_performance).readlines()
+    assert lines[0].startswith("Tried parameters {'offset': 0.0}. Average performances:")
+    assert lines[2].startswith("Tried parameters {'offset': 'wrong'} but got exception:")
+    assert lines[3].startswith("Tried parameters {'offset': 1.0}. Average performances:")
+    
+    
+""" Test that a resumed parallel cross-validation gives the same performances on the same folds """
+def test_run_resume(tmpdir):
+    I,J,K = 10,8,4
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    parameter_search = [{'offset':0.},{'offset':1.}]
+    (file_performance,file_results) = (str(tmpdir.join('performances.txt')),str(tmpdir.join('results.jsonl')))
+    
+    crossval = ParallelMatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},file_performance,P=2,file_results=file_results)
+    crossval.run()
+    lines = open(file_results).readlines()
+    assert len(lines) == 2*K
+    open(file_results,'w').writelines(lines[:K+1])
+    log = open(file_performance).read()
+    assert log != ""
+    
+    resumed = ParallelMatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},file_performance,P=2,file_results=file_results)
+    resumed.run()
+    assert len(open(file_results).readlines()) == 2*K
+    assert open(file_performance).read().startswith(log) and len(open(file_performance).read()) > len(log)
+    for parameters in parameter_search:
+        assert sorted(resumed.all_performances[resumed.JSON(parameters)]['MSE']) == sorted(crossval.all_performances[crossval.JSON(parameters)]['MSE'])
+    assert resumed.find_best_parameters('MSE',low_better=True) == crossval.find_best_parameters('MSE',low_better=True)
+    
+    
+# Model predicting the mean of the training entries plus noise drawn from its seed
+class NoisyMeanModel(MeanModel):
+    def train(self,iterations,seed):
+        self.mean = self.X[self.M].mean() + numpy.random.RandomState(seed).rand()
+        
+""" Test that with a seed the parallel cross-validation gives the same performances as the sequential one """
+def test_run_seed(tmpdir):
+    I,J,K = 10,8,4
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    parameter_search = [{'offset':0.},{'offset':1.}]
+    
+    crossvals = [
+        MatrixCrossValidation(NoisyMeanModel,X,M,K,parameter_search,{'iterations':10},str(tmpdir.join('performances.txt')),seed=3),
+        ParallelMatrixCrossValidation(NoisyMeanModel,X,M,K,parameter_search,{'iterations':10},str(tmpdir.join('performances_parallel.txt')),P=3,seed=3)
+    ]
+    for crossval in crossvals:
+        numpy.random.seed(len(crossvals))
+        crossval.run()
+    for parameters in parameter_search:
+        (performances,performances_parallel) = [crossval.all_performances[crossval.JSON(parameters)]['MSE'] for crossval in crossvals]
+        assert len(set(performances)) == K
+        assert sorted(performances) == sorted(performances_parallel)
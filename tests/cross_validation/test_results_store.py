@@ -0,0 +1,87 @@
+"""
+Tests for the results store of the cross-validation, in results_store.py, and
+for resuming a cross-validation from it.
+"""
+
+from BNMTF.cross_validation.results_store import ResultsStore
+from BNMTF.cross_validation.matrix_cross_validation import MatrixCrossValidation
+import numpy
+
+
+# Model predicting the mean of the training entries plus an offset, counting the trainings
+class MeanModel:
+    trainings = 0
+    
+    def __init__(self,X,M,offset):
+        (self.X,self.M,self.offset) = (numpy.array(X),numpy.array(M,dtype=bool),offset)
+        
+    def train(self,iterations):
+        MeanModel.trainings += 1
+        self.mean = self.X[self.M].mean() + self.offset
+        
+    def predict(self,M_pred):
+        M_pred = numpy.array(M_pred,dtype=bool)
+        return { 'MSE' : ((self.X[M_pred] - self.mean)**2).mean() }
+
+
+""" Test adding results, and reading them back from the file """
+def test_add(tmpdir):
+    filename = str(tmpdir.join('results.jsonl'))
+    store = ResultsStore(filename)
+    assert store.seed('{"K": 1}') is None
+    assert store.completed('{"K": 1}') == {}
+    
+    store.add('{"K": 1}',0,123,{'MSE':1.5},0.1)
+    store.add('{"K": 1}',2,123,{'MSE':2.5},0.2)
+    store.add('{"K": 2}',0,456,{'MSE':3.5},0.3)
+    assert store.completed('{"K": 1}') == {0:{'MSE':1.5},2:{'MSE':2.5}}
+    
+    # Ignore a final line that was only partially written
+    open(filename,'a').write('{"fold": 1, "hash": ')
+    store = ResultsStore(filename)
+    assert store.completed('{"K": 1}') == {0:{'MSE':1.5},2:{'MSE':2.5}}
+    assert store.completed('{"K": 2}') == {0:{'MSE':3.5}}
+    assert store.seed('{"K": 1}') == 123
+    assert store.seed('{"K": 2}') == 456
+    
+    
+""" Test that a resumed cross-validation only runs the folds not in the store, on the same folds """
+def test_resume(tmpdir):
+    I,J,K = 10,8,4
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    parameter_search = [{'offset':0.},{'offset':1.}]
+    (file_performance,file_results) = (str(tmpdir.join('performances.txt')),str(tmpdir.join('results.jsonl')))
+    
+    MeanModel.trainings = 0
+    crossval = MatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},file_performance,file_results)
+    crossval.run()
+    assert MeanModel.trainings == 2*K
+    (best_parameters,best_performance) = crossval.find_best_parameters('MSE',low_better=True)
+    assert best_parameters == {'offset':0.}
+    
+    # Remove the last two folds from the store, as if the run was interrupted
+    lines = open(file_results).readlines()
+    open(file_results,'w').writelines(lines[:-2])
+    
+    MeanModel.trainings = 0
+    resumed = MatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},file_performance,file_results)
+    resumed.run()
+    assert MeanModel.trainings == 2
+    assert resumed.all_performances == crossval.all_performances
+    assert resumed.find_best_parameters('MSE',low_better=True) == (best_parameters,best_performance)
+    
+    
+""" Test that the best parameters are only chosen from the parameter settings whose folds are all done """
+def test_find_best_parameters(tmpdir):
+    I,J,K = 10,8,4
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    parameter_search = [{'offset':'wrong'},{'offset':2.},{'offset':1.}]
+    crossval = MatrixCrossValidation(MeanModel,X,M,K,parameter_search,{'iterations':10},
+                                     str(tmpdir.join('performances.txt')),str(tmpdir.join('results.jsonl')))
+    crossval.run()
+    (best_parameters,best_performance) = crossval.find_best_parameters('MSE',low_better=True)
+    assert best_parameters == {'offset':1.}
+    assert best_performance == crossval.average_performances[crossval.JSON({'offset':1.})]['MSE']
@@ -3,8 +3,11 @@ Test the grid search for BNMTF, in grid_search_bnmtf.py
 """
 
 from BNMTF.grid_search.greedy_search_bnmtf import GreedySearch
+from BNMTF.grid_search.successive_halving import SuccessiveHalving
 from BNMTF.code.bnmtf_vb_optimised import bnmtf_vb_optimised
-import numpy, pytest, random
+from BNMTF.code.fit_cache import FitCache
+from BNMTF.grid_search.grid_search_bnmtf import GridSearch
+import numpy, pytest, random, os, tempfile, time
 
 classifier = bnmtf_vb_optimised
 
@@ -62,6 +65,133 @@ def test_search():
     assert len(greedysearch.all_values('BIC')) == 6
     
     
+def test_search_parallel(tmpdir,monkeypatch):
+    # Check that the parallel search takes the same steps and gives the same performances, and removes its files
+    monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+    I,J = 20,18
+    values_K = [1,2,3,4]
+    values_L = [1,2,3]
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.dot(numpy.random.rand(I,4),3*numpy.random.rand(4,4)),numpy.random.rand(J,4).T)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    initFG = 'random'
+    initS = 'random'
+    iterations = 10
+    restarts = 2
+    
+    greedysearch = GreedySearch(classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts,seed=5)
+    greedysearch.search('MSE')
+    assert len(greedysearch.all_values('MSE')) > 4
+    for P in [2,7]:
+        parallel = GreedySearch(classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts,seed=5,P=P)
+        parallel.search('MSE')
+        for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+            assert parallel.all_values(metric) == greedysearch.all_values(metric)
+        assert os.listdir(str(tmpdir)) == []
+        
+def test_cancel_resubmit(tmpdir,monkeypatch):
+    # Check that resubmitting a cancelled (K,L) does not revive the tasks of its cancelled submission
+    monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+    I,J = 10,9
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    greedysearch = GreedySearch(classifier,[1,2],[1,2],R,numpy.ones((I,J)),priors,'random','random',5,restarts=2,seed=1,P=2)
+    greedysearch.run_args, greedysearch.quality_args = {'iterations':5}, {}
+    greedysearch.start_pool()
+    try:
+        greedysearch.pool.apply_async(time.sleep,(1,))  # keep a process busy, so the tasks stay queued
+        greedysearch.submit(2,2)
+        greedysearch.prefetch([],[])
+        assert (2,2) not in greedysearch.pending and greedysearch.cancelled[(2,2,0)] == True
+        
+        greedysearch.submit(2,2)
+        assert greedysearch.tokens[(2,2)] == (2,2,1)
+        assert greedysearch.cancelled[(2,2,0)] == True and greedysearch.cancelled[(2,2,1)] == False
+        assert greedysearch.train_KL_parallel(2,2) is not None
+        assert greedysearch.tokens == {}
+    finally:
+        greedysearch.stop_pool()
+    
+    
+        
+def test_search_warm_start():
+    # Check that only the first values are initialised from scratch, and the others from the closest smaller fit
+    class WarmClassifier(classifier):
+        warm_starts = []
+        def initialise_warm(self,model,warm_start='split',seed=None):
+            WarmClassifier.warm_starts.append(((model.K,model.L),(self.K,self.L)))
+            classifier.initialise_warm(self,model,warm_start,seed)
+    I,J = 20,18
+    values_K = [1,2,3,4]
+    values_L = [1,2,3]
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.dot(numpy.random.rand(I,4),3*numpy.random.rand(4,4)),numpy.random.rand(J,4).T)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    
+    greedysearch = GreedySearch(WarmClassifier,values_K,values_L,R,M,priors,'random','random',iterations=10,seed=5,warm_start='split',warm_iterations=5)
+    greedysearch.search('MSE')
+    tried = [(K,L) for (K,L,MSE) in greedysearch.all_values('MSE')]
+    assert len(tried) >= 4
+    assert [KL for (_,KL) in WarmClassifier.warm_starts] == tried[1:]
+    assert WarmClassifier.warm_starts[:3] == [((1,1),(2,1)),((1,1),(1,2)),((2,1),(2,2))]
+        
+        
+def test_search_halving():
+    # Check that with successive halving we find the same best values, and only store the values we trained fully
+    I,J = 20,18
+    values_K = [1,2,3,4]
+    values_L = [1,2,3]
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.dot(numpy.random.rand(I,4),3*numpy.random.rand(4,4)),numpy.random.rand(J,4).T)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    iterations = 10
+    
+    greedysearch = GreedySearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations,seed=5)
+    greedysearch.search('MSE')
+    halving = GreedySearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations,seed=5,halving=SuccessiveHalving(2,eta=3))
+    halving.search('MSE')
+    
+    assert halving.best_value('MSE') == greedysearch.best_value('MSE')
+    assert halving.halved == {}
+    for (K,L,MSE) in halving.all_values('MSE'):
+        assert greedysearch.train_KL(K,L)['MSE'] == MSE
+        
+        
+def test_search_cache(tmpdir,monkeypatch):
+    # Check that the greedy search reuses the fits of a grid search with the same seed and values
+    I,J = 10,9
+    values_K = [1,2,3]
+    values_L = [1,2,3]
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    cache = FitCache(str(tmpdir))
+    
+    gridsearch = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',2,restarts=2,seed=4,cache=cache)
+    gridsearch.search()
+    monkeypatch.setattr(classifier,'run',lambda self,*args,**kwargs: pytest.fail("Should have used the cache."))
+    greedysearch = GreedySearch(classifier,values_K,values_L,R,M,priors,'random','random',2,restarts=2,seed=4,cache=cache)
+    greedysearch.search('BIC')
+    for (K,L,BIC) in greedysearch.all_values('BIC'):
+        assert BIC == gridsearch.all_values('BIC')[values_K.index(K),values_L.index(L)]
+    
+    with pytest.raises(AssertionError) as error:
+        GreedySearch(classifier,values_K,values_L,R,M,priors,'random','random',2,halving=SuccessiveHalving(1),cache=cache)
+    assert str(error.value) == "The fit cache cannot be combined with warm starts or successive halving."
+    
+    
+def test_next_neighbours():
+    I,J = 10,9
+    values_K = [1,2,4,5]
+    values_L = [5,4,3]
+    greedysearch = GreedySearch(classifier,values_K,values_L,numpy.ones((I,J)),numpy.ones((I,J)),{},'exp','exp',1)
+    assert greedysearch.next_neighbours(0,0) == [(1,3),(2,3),(4,5),(4,4),(4,3)]
+    assert greedysearch.next_neighbours(2,1) == []
+    
 def test_all_values():
     I,J = 10,9
     values_K = [1,2,4,5]
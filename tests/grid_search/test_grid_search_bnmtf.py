@@ -3,8 +3,10 @@ Test the grid search for BNMTF, in grid_search_bnmtf.py
 """
 
 from BNMTF.grid_search.grid_search_bnmtf import GridSearch
+from BNMTF.grid_search.successive_halving import SuccessiveHalving
 from BNMTF.code.bnmtf_vb_optimised import bnmtf_vb_optimised
-import numpy, pytest
+from BNMTF.code.fit_cache import FitCache
+import numpy, pytest, os, tempfile
 
 classifier = bnmtf_vb_optimised
 
@@ -52,6 +54,135 @@ def test_search():
     gridsearch.search()
     
     
+def test_search_seed():
+    # Check that searches with the same seed give the same performances, whatever the global random state
+    I,J = 10,9
+    values_K = [1,2]
+    values_L = [2,3]
+    R = 2*numpy.ones((I,J))
+    R[0,0] = 1
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    initFG = 'random'
+    initS = 'random'
+    iterations = 2
+    restarts = 2
+    
+    searches = []
+    for global_seed in [0,1]:
+        numpy.random.seed(global_seed)
+        gridsearch = GridSearch(classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts,seed=7)
+        gridsearch.search()
+        searches.append(gridsearch)
+    for metric in ['BIC','AIC','loglikelihood','MSE']:
+        assert numpy.array_equal(searches[0].all_values(metric),searches[1].all_values(metric))
+    assert searches[0].seeds[(1,2)] != searches[0].seeds[(2,3)]
+    
+def test_search_parallel(tmpdir,monkeypatch):
+    # Check that the parallel search gives the same performances as the sequential one, and removes its files
+    monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+    I,J = 10,9
+    values_K = [1,2]
+    values_L = [2,3]
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    initFG = 'random'
+    initS = 'random'
+    iterations = 2
+    restarts = 3
+    
+    gridsearch = GridSearch(classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts,seed=7)
+    gridsearch.search()
+    parallel = GridSearch(classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts,seed=7,P=3)
+    parallel.search()
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert numpy.array_equal(gridsearch.all_values(metric),parallel.all_values(metric))
+    assert os.listdir(str(tmpdir)) == []
+    
+def test_search_warm_start():
+    # Check that each (K,L) is initialised from the closest smaller fit in the previous or current row
+    class WarmClassifier(classifier):
+        warm_starts = []
+        def initialise_warm(self,model,warm_start='split',seed=None):
+            WarmClassifier.warm_starts.append(((model.K,model.L),(self.K,self.L)))
+            classifier.initialise_warm(self,model,warm_start,seed)
+    I,J = 10,9
+    values_K = [1,2,3]
+    values_L = [1,3]
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    
+    gridsearch = GridSearch(WarmClassifier,values_K,values_L,R,M,priors,'random','random',iterations=2,warm_start='split',warm_iterations=1)
+    gridsearch.search()
+    assert WarmClassifier.warm_starts == [((1,1),(1,3)),((1,1),(2,1)),((1,3),(2,3)),((2,1),(3,1)),((2,3),(3,3))]
+    assert sorted(gridsearch.fits.keys()) == [(2,1),(2,3),(3,1),(3,3)]
+    assert not numpy.isnan(gridsearch.all_values('MSE')).any()
+    
+    with pytest.raises(AssertionError) as error:
+        GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations=2,P=2,warm_start='split')
+    assert str(error.value) == "Warm starts are only supported for P = 1."
+    
+    
+def test_search_halving():
+    # Check that successive halving finds the same best K and L, with the same performances for them, for fewer iterations
+    I,J = 20,18
+    values_K = [1,2,3,4]
+    values_L = [1,2,3]
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.dot(numpy.random.rand(I,3),3*numpy.random.rand(3,2)),numpy.random.rand(J,2).T)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    iterations = 30
+    
+    gridsearch = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations,seed=3)
+    gridsearch.search()
+    halving = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations,seed=3,halving=SuccessiveHalving(5,eta=3))
+    halving.search()
+    
+    (best_K,best_L) = gridsearch.best_value('BIC')
+    (ik,il) = (values_K.index(best_K),values_L.index(best_L))
+    assert halving.best_value('BIC') == (best_K,best_L)
+    assert halving.budgets[ik,il] == iterations
+    assert halving.budgets.sum() < len(values_K)*len(values_L)*iterations
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert halving.all_values(metric)[ik,il] == gridsearch.all_values(metric)[ik,il]
+    
+    with pytest.raises(AssertionError) as error:
+        GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations,P=2,halving=SuccessiveHalving(5))
+    assert str(error.value) == "Successive halving is only supported for P = 1."
+    
+    
+def test_search_cache(tmpdir,monkeypatch):
+    # Check that the fits of a sequential search are reused by a parallel one, which gives the same performances
+    monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+    I,J = 10,9
+    values_K = [1,2]
+    values_L = [2,3]
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    folder = str(tmpdir.join('fits'))
+    
+    gridsearch = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',2,restarts=2,seed=7,cache=FitCache(folder))
+    gridsearch.search()
+    assert len(os.listdir(folder)) == 16
+    monkeypatch.setattr(classifier,'run',lambda self,*args,**kwargs: pytest.fail("Should have used the cache."))
+    for P in [1,2]:
+        cached = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',2,restarts=2,seed=7,P=P,cache=FitCache(folder))
+        cached.search()
+        for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+            assert numpy.array_equal(gridsearch.all_values(metric),cached.all_values(metric))
+    assert sorted(os.listdir(str(tmpdir))) == ['fits']
+    
+    # The processes add the fits they train
+    monkeypatch.undo()
+    parallel = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',2,restarts=2,seed=8,P=2,cache=FitCache(folder))
+    parallel.search()
+    assert len(os.listdir(folder)) == 32
+    
+    
 def test_all_values():
     I,J = 10,9
     values_K = [1,2,4,5]
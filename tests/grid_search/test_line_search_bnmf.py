@@ -3,8 +3,10 @@ Test the line search for BNMF, in line_search_bnmf.py
 """
 
 from BNMTF.grid_search.line_search_bnmf import LineSearch
+from BNMTF.grid_search.successive_halving import SuccessiveHalving
 from BNMTF.code.bnmf_vb_optimised import bnmf_vb_optimised
-import numpy, pytest
+from BNMTF.code.fit_cache import FitCache
+import numpy, pytest, os
 
 classifier = bnmf_vb_optimised
 
@@ -44,6 +46,86 @@ def test_search():
     linesearch.search()
     
     
+def test_search_warm_start():
+    # Check that each K is initialised from the best fit of the previous K, if it is smaller
+    class WarmClassifier(classifier):
+        warm_starts = []
+        def initialise_warm(self,model,warm_start='split',seed=None):
+            WarmClassifier.warm_starts.append((model.K,self.K,warm_start))
+            classifier.initialise_warm(self,model,warm_start,seed)
+    I,J = 10,9
+    values_K = [1,2,4,3]
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    
+    linesearch = LineSearch(WarmClassifier,values_K,R,M,priors,'random',iterations=3,restarts=2,warm_start='prior',warm_iterations=1)
+    assert linesearch.warm_iterations == 1
+    linesearch.search()
+    assert WarmClassifier.warm_starts == [(1,2,'prior'),(1,2,'prior'),(2,4,'prior'),(2,4,'prior')]
+    assert len(linesearch.all_values('MSE')) == 4
+    
+    
+def test_search_halving():
+    # Check that successive halving finds the same best K, with the same performances for it, for fewer iterations
+    I,J = 20,15
+    values_K = [1,2,3,4,5,6]
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.rand(I,3),numpy.random.rand(J,3).T)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    iterations, restarts = 40, 2
+    
+    linesearch = LineSearch(classifier,values_K,R,M,priors,'random',iterations,restarts,seed=3)
+    linesearch.search()
+    halving = LineSearch(classifier,values_K,R,M,priors,'random',iterations,restarts,seed=3,halving=SuccessiveHalving(5,eta=2))
+    halving.search()
+    
+    best_K = linesearch.best_value('BIC')
+    assert halving.best_value('BIC') == best_K
+    assert halving.budgets[values_K.index(best_K)] == iterations
+    assert sum(halving.budgets) < len(values_K)*iterations
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert halving.all_values(metric)[values_K.index(best_K)] == linesearch.all_values(metric)[values_K.index(best_K)]
+    
+    with pytest.raises(AssertionError) as error:
+        LineSearch(classifier,values_K,R,M,priors,'random',iterations,warm_start='split',halving=SuccessiveHalving(5))
+    assert str(error.value) == "Warm starts and successive halving cannot be combined."
+    
+    
+def test_search_cache(tmpdir):
+    # Check that a second search takes all fits from the cache, and gives the same performances
+    class CountingClassifier(classifier):
+        runs = 0
+        def run(self,*args,**kwargs):
+            CountingClassifier.runs += 1
+            return classifier.run(self,*args,**kwargs)
+    I,J = 10,9
+    values_K = [1,2,3]
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    cache = FitCache(str(tmpdir))
+    
+    linesearch = LineSearch(CountingClassifier,values_K,R,M,priors,'random',3,restarts=2,seed=1,cache=cache)
+    linesearch.search()
+    assert CountingClassifier.runs == 6 and len(os.listdir(str(tmpdir))) == 12
+    cached = LineSearch(CountingClassifier,values_K,R,M,priors,'random',3,restarts=2,seed=1,cache=FitCache(str(tmpdir)))
+    cached.search()
+    assert CountingClassifier.runs == 6
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert cached.all_values(metric) == linesearch.all_values(metric)
+    
+    # Unseeded fits and other settings are not taken from the cache
+    LineSearch(CountingClassifier,values_K,R,M,priors,'random',3,restarts=2,cache=cache).search()
+    LineSearch(CountingClassifier,values_K,R,M,priors,'random',4,restarts=2,seed=1,cache=cache).search()
+    assert CountingClassifier.runs == 18 and len(os.listdir(str(tmpdir))) == 24
+    
+    with pytest.raises(AssertionError) as error:
+        LineSearch(classifier,values_K,R,M,priors,'random',3,warm_start='split',cache=cache)
+    assert str(error.value) == "The fit cache cannot be combined with warm starts or successive halving."
+    
+    
 def test_all_values():
     I,J = 10,9
     values_K = [1,2,4,5]
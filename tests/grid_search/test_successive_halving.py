@@ -0,0 +1,46 @@
+"""
+Test the successive halving for the model selection, in successive_halving.py
+"""
+
+from BNMTF.grid_search.successive_halving import SuccessiveHalving
+import pytest
+
+
+def test_init():
+    halving = SuccessiveHalving(10)
+    assert halving.min_iterations == 10
+    assert halving.eta == 3
+    assert halving.metric == 'BIC'
+
+    with pytest.raises(AssertionError) as error:
+        SuccessiveHalving(0)
+    assert str(error.value) == "Minimum number of iterations should be at least 1, but is 0."
+    with pytest.raises(AssertionError) as error:
+        SuccessiveHalving(10,eta=1)
+    assert str(error.value) == "Eta should be greater than 1, but is 1."
+
+
+def test_run():
+    # Candidate c has quality c, so the lowest ones are kept
+    trained, finished = [], []
+    train = lambda candidate,iterations: trained.append((candidate,iterations))
+    finish = lambda candidate,iterations: finished.append((candidate,iterations))
+
+    halving = SuccessiveHalving(10,eta=3)
+    budgets = halving.run([8,1,7,3,5,2,6,4,9],train,lambda candidate: candidate,100,finish)
+    assert budgets == { 1:100, 2:30, 3:30, 4:10, 5:10, 6:10, 7:10, 8:10, 9:10 }
+    assert trained == [(8,10),(1,10),(7,10),(3,10),(5,10),(2,10),(6,10),(4,10),(9,10),(1,20),(3,20),(2,20),(1,70)]
+    assert sorted(finished) == sorted(budgets.items())
+    assert finished[-1] == (1,100)
+
+
+def test_run_small():
+    # With a single candidate, or min_iterations above the total, we train for all iterations
+    trained = []
+    train = lambda candidate,iterations: trained.append((candidate,iterations))
+    assert SuccessiveHalving(10,eta=2).run(['a'],train,lambda candidate: 0,50) == { 'a':50 }
+    assert trained == [('a',10),('a',40)]
+    assert SuccessiveHalving(100).run(['a','b'],train,lambda candidate: 0,50) == { 'a':50, 'b':50 }
+
+    # Ties are kept in the order of the candidates
+    assert SuccessiveHalving(5,eta=2).run(['a','b','c','d'],train,lambda candidate: 0,20) == { 'a':20, 'b':10, 'c':5, 'd':5 }